@@ -14,10 +14,16 @@
 
 
 import argparse
+import array
+import atexit
 from collections import Counter
 import datetime
+from operator import attrgetter
+import os
 import pickle
+import signal
 import struct
+import subprocess
 try:
     from inspect import getfullargspec
 except ImportError:
@@ -53,17 +59,201 @@ if not sys.stderr.isatty():
     sys.stderr = Unbuffered(sys.stderr)
 
 
+# Types registered with `register_type`, looked up by exact type when
+# serializing and by tag when deserializing.
+_registered_types = {}
+_registered_tags = []
+
+# Registered payloads start with a zero byte, which never begins a pickle,
+# followed by the type's tag and its struct-packed fields.
+_REGISTERED_HEADER = struct.Struct(">BH")
+
+# Header of the frames written by stream encoders: frame size, event time and
+# key length, followed by the key and the payload.
+_STREAM_MESSAGE_HEADER = struct.Struct(">IqI")
+
+
+class _RegisteredType(object):
+    def __init__(self, cls, fields, struct_fmt, tag, build=None):
+        self.cls = cls
+        self.build = cls if build is None else build
+        self.body = struct.Struct(struct_fmt)
+        self.header = _REGISTERED_HEADER.pack(0, tag)
+        if len(fields) == 1:
+            get = attrgetter(fields[0])
+            self.values = lambda o: (get(o),)
+        else:
+            self.values = attrgetter(*fields)
+
+
+def register_type(cls, fields, struct_fmt):
+    """
+    Serialize instances of `cls` as a short tag followed by the attributes
+    named in `fields`, packed with the `struct` format `struct_fmt`, instead
+    of pickling them. Deserializing calls `cls(*values)`, so `fields` must
+    be the constructor's arguments, in order. Tags are assigned in
+    registration order, so every worker must register the same types in the
+    same order, which is the case when registration happens at module level
+    in the application module. Only instances of exactly `cls` are affected;
+    everything else is pickled.
+    """
+    if cls in _registered_types:
+        print("\nAPI_Error: {} is already registered.".format(cls.__name__))
+        raise WallarooParameterError()
+    fields = list(fields)
+    s = _compile_struct(struct_fmt)
+    if len(fields) != _struct_item_count(s):
+        print("\nAPI_Error: register_type format '{}' has {} items but {} "
+              "fields were given.".format(struct_fmt, _struct_item_count(s),
+                                          len(fields)))
+        raise WallarooParameterError()
+    entry = _RegisteredType(cls, fields, struct_fmt, len(_registered_tags))
+    _registered_types[cls] = entry
+    _registered_tags.append(entry)
+    return cls
+
+
 def serialize(o):
-    s = pickle.dumps(o)
-    return s
+    entry = _registered_types.get(type(o))
+    if entry is not None:
+        return entry.header + entry.body.pack(*entry.values(o))
+    return pickle.dumps(o, pickle.HIGHEST_PROTOCOL)
 
 
 def deserialize(bs):
     # print('DBG: deserialize len: {}'.format(len(bs)))
     # print('DBG: deserialize: {}'.format(bs))
+    if bs[:1] == b'\x00':
+        _, tag = _REGISTERED_HEADER.unpack_from(bs)
+        entry = _registered_tags[tag]
+        return entry.build(*entry.body.unpack_from(bs,
+                                                   _REGISTERED_HEADER.size))
     return pickle.loads(bs)
 
 
+# Default values of `State` fields, by struct format character
+_FIELD_DEFAULTS = {'?': False, 'c': b'\x00', 's': b'', 'p': b'',
+                   'e': 0.0, 'f': 0.0, 'd': 0.0}
+
+
+class _StateType(type):
+    """
+    Builds the slots and the struct layout of `State` subclasses from their
+    `fields`, and registers them with the built-in serializer.
+    """
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get('fields')
+        if fields is not None:
+            names = []
+            codes = []
+            defaults = []
+            for field in fields:
+                code = field[1]
+                names.append(field[0])
+                codes.append(code)
+                defaults.append(field[2] if len(field) > 2 else
+                                _FIELD_DEFAULTS.get(code[-1:], 0))
+            inherited = set()
+            for base in bases:
+                inherited.update(getattr(base, '_field_names', ()))
+            namespace['__slots__'] = tuple(n for n in names
+                                           if n not in inherited)
+            namespace['_field_names'] = tuple(names)
+            namespace['_field_defaults'] = tuple(defaults)
+            namespace['_struct_fmt'] = '>' + ''.join(codes)
+        else:
+            namespace.setdefault('__slots__', ())
+        cls = super(_StateType, mcs).__new__(mcs, name, bases, namespace)
+        if cls._field_names:
+            _register_state_type(cls)
+        return cls
+
+
+def _register_state_type(cls):
+    s = _compile_struct(cls._struct_fmt)
+    if len(cls._field_names) != _struct_item_count(s):
+        print("\nAPI_Error: the fields of {} have {} struct items for {} "
+              "fields.".format(cls.__name__, _struct_item_count(s),
+                               len(cls._field_names)))
+        raise WallarooParameterError()
+    entry = _RegisteredType(cls, cls._field_names, cls._struct_fmt,
+                            len(_registered_tags), build=cls._restore)
+    _registered_types[cls] = entry
+    _registered_tags.append(entry)
+
+
+_setattr = object.__setattr__
+
+
+class _StateBase(object):
+    __slots__ = ('_dirty',)
+    _field_names = ()
+    _field_defaults = ()
+
+    def __init__(self, *args, **kwargs):
+        names = self._field_names
+        if len(args) > len(names):
+            raise TypeError("{}() takes at most {} arguments ({} given)"
+                            .format(type(self).__name__, len(names),
+                                    len(args)))
+        for name, value in zip(names, args):
+            _setattr(self, name, value)
+        for name, default in zip(names[len(args):],
+                                 self._field_defaults[len(args):]):
+            _setattr(self, name, kwargs.pop(name, default))
+        if kwargs:
+            raise TypeError("{}() got unexpected fields {}".format(
+                type(self).__name__, ", ".join(sorted(kwargs))))
+        _setattr(self, '_dirty', True)
+
+    @classmethod
+    def _restore(cls, *values):
+        state = cls(*values)
+        _setattr(state, '_dirty', False)
+        return state
+
+    def __setattr__(self, name, value):
+        _setattr(self, name, value)
+        _setattr(self, '_dirty', True)
+
+    def is_dirty(self):
+        """
+        Whether a field was set since the state was created, restored from
+        a snapshot, or last marked clean. Wallaroo marks a state clean when
+        it checkpoints it, and doesn't serialize it again while it's clean.
+        """
+        return self._dirty
+
+    def mark_clean(self):
+        _setattr(self, '_dirty', False)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(n, getattr(self, n)) for n in self._field_names))
+
+
+State = _StateType('State', (_StateBase,), {
+    '__doc__': """
+    Base class for compact state objects.
+
+    Subclasses declare their fields as a `fields` sequence of
+    `(name, struct_format)` or `(name, struct_format, default)` tuples, in
+    the order of the constructor's arguments:
+
+        class SymbolData(wallaroo.State):
+            fields = [("last_bid", "d"), ("last_offer", "d"),
+                      ("should_reject_trades", "?", True)]
+
+    Fields are stored in `__slots__`, so instances have no `__dict__`, and
+    a state is serialized as a packed struct record instead of a pickle.
+    Fields without a default start as zero, `False` or empty bytes.
+    Setting a field marks the state dirty, see `is_dirty`.
+    Like `register_type`, subclasses must be defined in the same order on
+    every worker, which is the case when they're defined at module level.
+    """,
+    '__module__': __name__})
+
+
 class WallarooParameterError(Exception):
     pass
 
@@ -72,11 +262,17 @@ def source(name, source_config):
     return Pipeline.from_source(name, source_config)
 
 
-def build_application(app_name, pipeline):
+def build_application(app_name, pipeline, fuse_computations=False):
+    """
+    If `fuse_computations` is true, consecutive stateless computations
+    (not `computation_multi`) are run as a single step named after all of
+    them, so the data passed between them stays in Python. The fused step
+    replaces theirs in the topology and in metrics.
+    """
     if not pipeline._is_closed():
         print("\nAPI_Error: An application must end with to_sink/s.")
         raise WallarooParameterError()
-    return pipeline.__to_tuple__(app_name)
+    return pipeline.__to_tuple__(app_name, fuse_computations)
 
 
 def range_windows(wrange):
@@ -97,8 +293,8 @@ class Pipeline(object):
                                       source_config.to_tuple()))
         return Pipeline(pipeline_tree)
 
-    def __to_tuple__(self, app_name):
-        return self._pipeline_tree.to_tuple(app_name)
+    def __to_tuple__(self, app_name, fuse_computations=False):
+        return self._pipeline_tree.to_tuple(app_name, fuse_computations)
 
     def _is_closed(self):
         return self._pipeline_tree.is_closed
@@ -107,7 +303,12 @@ class Pipeline(object):
         return self.clone()._to(computation)
 
     def _to(self, computation):
-        if isinstance(computation, StateComputation):
+        if isinstance(computation, (ComputationBatch, StateComputationBatch)):
+            self._pipeline_tree.add_stage(("to_batch", computation,
+                                           computation.batch_size,
+                                           computation.batch_delay,
+                                           computation.is_stateful))
+        elif isinstance(computation, StateComputation):
             self._pipeline_tree.add_stage(("to_state", computation))
         elif isinstance(computation, RangeWindows):
             self._pipeline_tree.add_stage(("to_range_windows",
@@ -275,7 +476,18 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
         # Attach the computation to the class
         # TODO: maybe move this to machida, using PyObject_IsInstance
         # instead of PyObject_HasAttrString
-        if issubclass(base_cls, ComputationMulti):
+        if issubclass(base_cls, (ComputationBatch, StateComputationBatch)):
+            C.batch_size = kwargs.pop('batch_size')
+            C.batch_delay = kwargs.pop('batch_delay')
+            processes = kwargs.pop('processes', None)
+            if processes and processes > 1:
+                C.processes = processes
+                C._batch_module = func.__module__
+                C._compute_batch_local = comp
+                C.compute_batch = _pooled_compute_batch
+            else:
+                C.compute_batch = comp
+        elif issubclass(base_cls, ComputationMulti):
             C.compute_multi = comp
         else:
             C.compute = comp
@@ -286,8 +498,8 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
             def extract_key(self, data):
                 res = func(data)
                 if isinstance(res, int):
-                    return chr(res)
-                return res
+                    res = chr(res)
+                return self._intern(res)
 
     # Case 3: Encoder
     elif issubclass(base_cls, Encoder):
@@ -310,13 +522,10 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
                         # point seconds that Python uses.
                         event_time = int(event_time.timestamp() * 1000)
                     encoded_key = key.encode() if key else ''.encode()
-                    return struct.pack(
-                        '>IqI{}s{}s'.format(len(encoded_key), len(encoded)),
+                    return _STREAM_MESSAGE_HEADER.pack(
                         len(encoded) + 8 + len(encoded_key) + 8, # total frame size
                         event_time, # 64bit event_time
-                        len(encoded_key),
-                        encoded_key,
-                        encoded) # final payload, variable size as formatted above
+                        len(encoded_key)) + encoded_key + encoded
 
         # OctetEncoder
         elif issubclass(base_cls, OctetEncoder):
@@ -330,20 +539,36 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
         if issubclass(base_cls, OctetDecoder):
             header_length = kwargs['header_length']
             length_fmt = kwargs['length_fmt']
+            _zero_copy = kwargs.get('zero_copy', False)
+            _accept = kwargs.get('accept')
+            _accept_prefix = None
+            if isinstance(_accept, bytes):
+                _accept_prefix = _accept
+                _accept = _starts_with(_accept)
 
             class C(base_cls):
+                zero_copy = _zero_copy
+                accept_prefix = _accept_prefix
+                # Machida reads common length formats natively instead of
+                # calling payload_length for every message.
+                length_fmt = kwargs['length_fmt']
+
                 def header_length(self):
                     return header_length
 
                 def payload_length(self, bs):
-                    return struct.unpack(length_fmt, bs)[0]
+                    return struct.unpack_from(length_fmt, bs)[0]
 
                 def decode(self, bs):
+                    if _accept is not None and not _accept(bs):
+                        return None
                     return func(bs)
 
         # ConnectorDecoder
         elif issubclass(base_cls, ConnectorDecoder):
             class C(base_cls):
+                length_fmt = ">I"
+
                 def header_length(self):
                     # struct.calcsize('<I')
                     return 4
@@ -364,6 +589,186 @@ def _wallaroo_wrap(name, func, base_cls, **kwargs):
     return c
 
 
+# Worker pools for `computation_batch(..., processes=N)`, keyed by
+# computation name. They are started lazily, on the first batch, so that
+# nothing is started while the application module is imported.
+_batch_pools = {}
+
+
+class _BatchPool(object):
+    """
+    Computes the chunks of a batch on `processes - 1` Python subprocesses
+    while the calling process computes the first chunk itself.
+
+    The subprocesses run a fresh interpreter rather than a fork of the
+    Wallaroo worker, which is multithreaded and has its sockets open. Each
+    of them imports the module that defines the computation, like a Wallaroo
+    worker imports the application module, and is sent the pickled
+    computation once, when it starts. They exit when their stdin is closed,
+    which also happens if the Wallaroo worker dies without closing the
+    pool.
+    """
+    def __init__(self, computation, processes):
+        self._computation = computation
+        # False while workers may have replies that were not read yet
+        self.in_step = True
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(p or os.getcwd()
+                                            for p in sys.path)
+        payload = (pickle.dumps(computation._batch_module,
+                                pickle.HIGHEST_PROTOCOL) +
+                   pickle.dumps(computation, pickle.HIGHEST_PROTOCOL))
+        self._workers = []
+        try:
+            for _ in range(processes - 1):
+                worker = subprocess.Popen(
+                    [_python_executable(), "-c",
+                     "import wallaroo; wallaroo._run_batch_worker()"],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    close_fds=True, env=env)
+                self._workers.append(worker)
+                worker.stdin.write(payload)
+                worker.stdin.flush()
+        except Exception:
+            self.close()
+            raise
+
+    def map(self, chunks):
+        """
+        Return the results of computing each of `chunks`, in order.
+        """
+        self.in_step = False
+        workers = self._workers[:len(chunks) - 1]
+        for worker, chunk in zip(workers, chunks[1:]):
+            pickle.dump(chunk, worker.stdin, pickle.HIGHEST_PROTOCOL)
+            worker.stdin.flush()
+        try:
+            results = [self._computation._compute_batch_local(chunks[0])]
+        except Exception:
+            # Read the workers' replies before raising, so that the next
+            # batch doesn't read them instead of its own
+            self._read_results(workers)
+            self.in_step = True
+            raise
+        replies = self._read_results(workers)
+        self.in_step = True
+        errors = [res for ok, res in replies if not ok]
+        results.extend(res for ok, res in replies if ok)
+        if errors:
+            raise RuntimeError("{} failed in a batch worker:\n{}".format(
+                self._computation.name(), errors[0]))
+        return results
+
+    def _read_results(self, workers):
+        """
+        Read one `(ok, result or traceback)` reply from each of `workers`.
+        """
+        return [pickle.load(worker.stdout) for worker in workers]
+
+    def close(self):
+        for worker in self._workers:
+            try:
+                worker.stdin.close()
+            except (IOError, OSError):
+                pass
+        for worker in self._workers:
+            if worker.poll() is None:
+                try:
+                    worker.terminate()
+                except OSError:
+                    pass
+            worker.wait()
+            worker.stdout.close()
+        self._workers = []
+
+
+def _python_executable():
+    """
+    Return the path of an interpreter for the Python version we're running
+    on. In machida, `sys.executable` is not a Python interpreter, so look for
+    one in the Python installation and then on the PATH.
+    """
+    if os.path.basename(sys.executable or "").startswith("python"):
+        return sys.executable
+    name = "python{}.{}".format(*sys.version_info[:2])
+    dirs = ([os.path.join(sys.exec_prefix, "bin")] +
+            os.environ.get("PATH", "").split(os.pathsep))
+    for d in dirs:
+        path = os.path.join(d, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    raise RuntimeError("Could not find a {} interpreter".format(name))
+
+
+def _run_batch_worker():
+    """
+    The main loop of a `_BatchPool` subprocess. Import the computation's
+    module and read the pickled computation from stdin, then compute each
+    chunk read from stdin and write its result to stdout, until stdin is
+    closed.
+    """
+    import traceback
+    # The worker shuts us down, so ignore the ^C sent to its process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    inp = getattr(sys.stdin, "buffer", sys.stdin)
+    # Keep stdout for results, and send anything the computation prints to
+    # stderr instead
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    __import__(pickle.load(inp))
+    computation = pickle.load(inp)
+    while True:
+        try:
+            chunk = pickle.load(inp)
+        except EOFError:
+            return
+        try:
+            res = (True, computation._compute_batch_local(chunk))
+        except Exception:
+            res = (False, traceback.format_exc())
+        pickle.dump(res, out, pickle.HIGHEST_PROTOCOL)
+        out.flush()
+
+
+@atexit.register
+def _close_batch_pools():
+    """
+    Stop the subprocesses of every batch pool. Machida never finalizes the
+    interpreter, so it calls this from its own exit handler too.
+    """
+    while _batch_pools:
+        _batch_pools.popitem()[1].close()
+
+
+def _pooled_compute_batch(self, data):
+    """
+    Split `data` into one contiguous chunk per process, run the chunks on
+    the computation's batch pool and concatenate the results in input order.
+    """
+    if len(data) < 2:
+        return self._compute_batch_local(data)
+    step = -(-len(data) // self.processes)
+    chunks = [data[i:i + step] for i in range(0, len(data), step)]
+    name = self.name()
+    pool = _batch_pools.get(name)
+    if pool is None:
+        pool = _batch_pools[name] = _BatchPool(self, self.processes)
+    try:
+        results = pool.map(chunks)
+    except Exception:
+        if not pool.in_step:
+            # A worker died, the pipes broke or a chunk couldn't be sent:
+            # start over on the next batch
+            del _batch_pools[name]
+            pool.close()
+        raise
+    out = []
+    for res in results:
+        if res is not None:
+            out.extend(res)
+    return out
+
+
 class BaseWrapped(object):
     def __call__(self, *args):
         return self
@@ -387,13 +792,221 @@ class StateComputationMulti(StateComputation, ComputationMulti):
     pass
 
 
+class ComputationBatch(Computation):
+    pass
+
+
+class StateComputationBatch(StateComputation):
+    pass
+
+
 class Aggregation(BaseWrapped):
     def name(self):
         return self.__class__.__name__
 
 
+class VectorAggregation(Aggregation):
+    """
+    An aggregation whose accumulator keeps the values of `fields` in
+    columns, so that reductions run once per window trigger over whole
+    columns instead of once per message in `update`. Machida buffers the
+    inputs of each accumulator and appends them with a single
+    `update_batch` call when the accumulator is next combined, output or
+    checkpointed, rather than calling `update` for each of them.
+
+    Subclasses list the attributes of the input data to collect in `fields`
+    (dotted names reach into nested objects), optionally set the `array`
+    `typecode` used to store them (doubles by default), and implement
+    `output(key, columns)`. `columns[field]` is a NumPy array when NumPy is
+    installed and an `array.array` otherwise.
+    """
+    fields = ()
+    typecode = 'd'
+
+    def initial_accumulator(self):
+        return ColumnBuffer(self.fields, self.typecode)
+
+    def update(self, data, columns):
+        columns.append(data)
+
+    def update_batch(self, data, columns):
+        columns.extend(data)
+
+    def combine(self, columns1, columns2):
+        return columns1.concat(columns2)
+
+    def subtract(self, columns1, columns2):
+        # columns2 is always the earliest accumulator combined into columns1,
+        # so its rows are the first len(columns2) rows of columns1.
+        return columns1.drop(len(columns2))
+
+
+class ColumnBuffer(object):
+    """
+    The accumulator of a `VectorAggregation`: one `array.array` per field.
+
+    An accumulator is a view of rows `_start` to `_end` of columns that it
+    may share with other accumulators. Rows are only ever appended to the
+    columns, so a view never changes once it is made: `concat` appends the
+    other accumulator's rows in place unless rows were already appended past
+    this view, and `drop` only moves the start. Sliding a window then costs
+    the size of its panes rather than a copy of the whole window.
+    """
+    __slots__ = ('fields', '_columns', '_start', '_end', '_getters')
+
+    def __init__(self, fields, typecode='d', columns=None, start=0, end=None):
+        self.fields = tuple(fields)
+        if columns is None:
+            columns = [array.array(typecode) for _ in self.fields]
+        self._columns = columns
+        self._start = start
+        if end is None:
+            end = len(columns[0]) if columns else 0
+        self._end = end
+        self._getters = None
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, field):
+        col = self._columns[self.fields.index(field)]
+        start, end = self._start, self._end
+        np = _numpy()
+        if np is None:
+            return col[start:end]
+        if start == end:
+            return np.empty(0, dtype=col.typecode)
+        # Copy out of the buffer so that the array stays valid after the
+        # columns are appended to again.
+        return np.frombuffer(col, dtype=col.typecode, count=end - start,
+                             offset=start * col.itemsize).copy()
+
+    def _at_tip(self):
+        """
+        Whether rows can be appended to the columns in place, because no
+        other accumulator appended past this one's end.
+        """
+        return not self._columns or len(self._columns[0]) == self._end
+
+    def _copy_columns(self):
+        start, end = self._start, self._end
+        return [c[start:end] for c in self._columns]
+
+    def _own_tip(self):
+        if not self._at_tip():
+            self._columns = self._copy_columns()
+            self._start, self._end = 0, len(self)
+            self._getters = None
+
+    def append(self, data):
+        self._own_tip()
+        if self._getters is None:
+            self._getters = [(c.append, attrgetter(f))
+                             for c, f in zip(self._columns, self.fields)]
+        for append, get in self._getters:
+            append(get(data))
+        self._end += 1
+
+    def extend(self, data):
+        """
+        Append the values of a list of input data, one field at a time.
+        """
+        # Get every value first, so that a missing attribute leaves the
+        # columns as they were
+        values = [list(map(attrgetter(f), data)) for f in self.fields]
+        self._own_tip()
+        for c, v in zip(self._columns, values):
+            c.extend(v)
+        self._end += len(data)
+
+    def concat(self, other):
+        if not len(self):
+            columns = other._copy_columns()
+            return ColumnBuffer(self.fields, columns=columns, end=len(other))
+        if self._at_tip():
+            columns, start = self._columns, self._start
+        else:
+            columns, start = self._copy_columns(), 0
+        for c, o in zip(columns, other._columns):
+            c.extend(o[other._start:other._end])
+        return ColumnBuffer(self.fields, columns=columns, start=start,
+                            end=start + len(self) + len(other))
+
+    def drop(self, n):
+        start = self._start + n
+        if start > self._end - start:
+            # Most of the columns are dropped rows, so copy the rest out
+            columns = [c[start:self._end] for c in self._columns]
+            return ColumnBuffer(self.fields, columns=columns,
+                                end=self._end - start)
+        return ColumnBuffer(self.fields, columns=self._columns, start=start,
+                            end=self._end)
+
+    def __getstate__(self):
+        if self._start == 0 and self._at_tip():
+            return (self.fields, self._columns)
+        return (self.fields, self._copy_columns())
+
+    def __setstate__(self, state):
+        self.fields, self._columns = state
+        self._start = 0
+        self._end = len(self._columns[0]) if self._columns else 0
+        self._getters = None
+
+
+_NUMPY = []
+
+
+def _numpy():
+    """
+    Import NumPy on first use, returning None if it is not installed.
+    """
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+
 class KeyExtractor(BaseWrapped):
-    pass
+    """
+    Extracted keys are interned: an extractor remembers up to
+    `key_cache_size` of the distinct keys it returned recently and returns
+    the same object again for an equal key. Machida caches the Wallaroo key
+    it made from a key object, so a hot key isn't copied for every message.
+    """
+    key_cache_size = 4096
+    _recent_keys = None
+    _older_keys = None
+
+    def _intern(self, key):
+        # Two generations of keys approximate an LRU without reordering on
+        # every hit: once the recent keys fill half the cache they become
+        # the older keys, and older keys are moved back when they're used.
+        recent = self._recent_keys
+        if recent is None:
+            recent = self._recent_keys = {}
+            self._older_keys = {}
+        try:
+            interned = recent.get(key)
+            if interned is None:
+                interned = self._older_keys.pop(key, key)
+                if len(recent) >= self.key_cache_size // 2:
+                    self._older_keys = recent
+                    recent = self._recent_keys = {}
+                recent[key] = interned
+        except TypeError:
+            # Unhashable keys are rejected by machida
+            return key
+        return interned
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_recent_keys', None)
+        state.pop('_older_keys', None)
+        return state
 
 
 class Encoder(BaseWrapped):
@@ -401,7 +1014,17 @@ class Encoder(BaseWrapped):
 
 
 class Decoder(BaseWrapped):
-    pass
+    zero_copy = False
+    accept_prefix = None
+
+
+def _starts_with(prefix):
+    size = len(prefix)
+
+    def accept(bs):
+        # Frames may be memoryviews, which have no startswith
+        return bs[:size] == prefix
+    return accept
 
 
 class OctetDecoder(Decoder):
@@ -444,14 +1067,11 @@ class ConnectorEncoder(Encoder):
             # point seconds that Python uses.
             event_time = int(dt_to_timestamp(event_time) * 1000)
         encoded_key = key.encode() if key else ''.encode()
-        return struct.pack(
-            '>IqI{}s{}s'.format(len(encoded_key), len(encoded_data)),
+        return _STREAM_MESSAGE_HEADER.pack(
             # 1st I = message length hdr, not included in total frame size
             8 + 4 + len(encoded_key) + len(encoded_data), # total frame size
             event_time, # 64bit event_time
-            len(encoded_key),
-            encoded_key,
-            encoded_data) # final payload, variable size as formatted above
+            len(encoded_key)) + encoded_key + encoded_data
 
 
 def computation(name):
@@ -487,18 +1107,108 @@ def state_computation_multi(name, state):
     return wrapped
 
 
+def computation_batch(name, batch_size=100, batch_delay=None,
+                      processes=None):
+    """
+    Like `computation`, but the decorated function receives a list of up to
+    `batch_size` inputs and returns a list of outputs (`None` entries are
+    dropped). Each step buffers its inputs, whatever their keys, and calls
+    into Python once per batch, flushing a partial batch `batch_delay`
+    nanoseconds (1ms by default) after its first input arrived.
+
+    If `processes` is greater than 1, each batch is split into that many
+    chunks, computed in parallel by this interpreter and `processes - 1`
+    Python subprocesses, so that the computation can use more than one core.
+    Outputs are returned in the same order as the inputs.
+    """
+    batch_size, batch_delay = _validate_batch_params(name, batch_size,
+                                                     batch_delay)
+    if processes is not None and (not isinstance(processes, int) or
+                                  processes < 1):
+        print("\nAPI_Error: processes for {0} must be a positive integer."
+              .format(name))
+        raise WallarooParameterError()
+    if processes is not None and processes > 1:
+        try:
+            _python_executable()
+        except RuntimeError as err:
+            print("\nAPI_Error: processes for {0} needs a Python "
+                  "interpreter to run: {1}.".format(name, err))
+            raise WallarooParameterError()
+    def wrapped(func):
+        _validate_arity_compatability(name, func, 1)
+        C = _wallaroo_wrap(name, func, ComputationBatch,
+                           batch_size=batch_size, batch_delay=batch_delay,
+                           processes=processes)
+        return C()
+    return wrapped
+
+
+def state_computation_batch(name, state, batch_size=100, batch_delay=None):
+    """
+    Like `state_computation`, but the decorated function receives a list of
+    inputs for a single key along with that key's state. Inputs are buffered
+    per key, and partial batches are flushed every `batch_delay`
+    nanoseconds (1ms by default).
+    """
+    batch_size, batch_delay = _validate_batch_params(name, batch_size,
+                                                     batch_delay)
+    def wrapped(func):
+        _validate_arity_compatability(name, func, 2)
+        C = _wallaroo_wrap(name, func, StateComputationBatch,
+                           state_class=state, batch_size=batch_size,
+                           batch_delay=batch_delay)
+        return C()
+    return wrapped
+
+
+def _validate_batch_params(name, batch_size, batch_delay):
+    if batch_delay is None:
+        batch_delay = milliseconds(1)
+    if not isinstance(batch_size, int) or batch_size < 1:
+        print("\nAPI_Error: batch_size for {0} must be a positive integer."
+              .format(name))
+        raise WallarooParameterError()
+    if not isinstance(batch_delay, int) or batch_delay < 1:
+        print("\nAPI_Error: batch_delay for {0} must be a positive number of "
+              "nanoseconds.".format(name))
+        raise WallarooParameterError()
+    return (batch_size, batch_delay)
+
+
 def key_extractor(func):
     _validate_arity_compatability(func.__name__, func, 1)
     C = _wallaroo_wrap(func.__name__, func, KeyExtractor)
     return C()
 
 
-def decoder(header_length, length_fmt):
+def decoder(header_length, length_fmt, zero_copy=False, accept=None):
+    """
+    If `zero_copy` is true, the decoder is passed a read-only `memoryview`
+    over Wallaroo's receive buffer instead of a `bytes` copy of each frame.
+    The view is only valid while the decoder runs, so anything kept from it
+    must be copied (for example with `struct.unpack_from` or `bytes()`).
+    The view itself is released when the decoder returns. A slice of it, or
+    another object still using its buffer, fails the decode with a
+    `BufferError`.
+
+    `accept` drops frames before they are decoded. It is either a function
+    of the frame's bytes that returns false for frames to drop, or a
+    `bytes` prefix that frames must start with. Machida checks a prefix
+    itself, so dropped frames never reach Python at all.
+    """
     def wrapped(func):
         _validate_arity_compatability(func.__name__, func, 1)
+        if not (accept is None or isinstance(accept, bytes) or
+                callable(accept)):
+            print("\nAPI_Error: accept for {0} must be a bytes prefix or a "
+                  "function.".format(func.__name__))
+            raise WallarooParameterError()
         C = _wallaroo_wrap(func.__name__, func, OctetDecoder,
                            header_length=header_length,
-                           length_fmt=length_fmt)
+                           length_fmt=length_fmt,
+                           zero_copy=zero_copy,
+                           accept=accept)
         return C()
     return wrapped
 
@@ -509,6 +1219,73 @@ def encoder(func):
     return C()
 
 
+def struct_decoder(fmt, cls, header_length=4, length_fmt=">I"):
+    """
+    Build a decoder for messages with a fixed binary layout. `fmt` is the
+    `struct` format of the payload, which is unpacked in a single
+    `unpack_from` call, and `cls` is called with the unpacked values in order
+    to build each message. A class with `__slots__` or a `namedtuple` makes a
+    compact record type. Pad bytes (`x`) can be used to skip fields.
+    """
+    s = _compile_struct(fmt)
+    if not callable(cls):
+        print("\nAPI_Error: struct_decoder cls must be callable.")
+        raise WallarooParameterError()
+    unpack_from = s.unpack_from
+
+    def struct_decode(bs):
+        return cls(*unpack_from(bs))
+
+    # unpack_from copies every field out of the buffer, so it is safe to
+    # decode straight from the receive buffer.
+    C = _wallaroo_wrap(struct_decode.__name__, struct_decode, OctetDecoder,
+                       header_length=header_length, length_fmt=length_fmt,
+                       zero_copy=True)
+    return C()
+
+
+def struct_encoder(fmt, fields, length_fmt=">I"):
+    """
+    Build an encoder for messages with a fixed binary layout. `fields` lists
+    the attribute of the output data to pack for each item in the `struct`
+    format `fmt`; dotted names such as `"order.side"` reach into nested
+    objects. Unless `length_fmt` is `None`, the payload is prefixed with its
+    length packed with `length_fmt`.
+    """
+    s = _compile_struct(fmt)
+    fields = list(fields)
+    if len(fields) != _struct_item_count(s):
+        print("\nAPI_Error: struct_encoder format '{}' has {} items but {} "
+              "fields were given.".format(fmt, _struct_item_count(s),
+                                          len(fields)))
+        raise WallarooParameterError()
+    header = struct.pack(length_fmt, s.size) if length_fmt else b''
+    get = attrgetter(*fields)
+    pack = s.pack
+
+    if len(fields) == 1:
+        def struct_encode(data):
+            return header + pack(get(data))
+    else:
+        def struct_encode(data):
+            return header + pack(*get(data))
+
+    C = _wallaroo_wrap(struct_encode.__name__, struct_encode, OctetEncoder)
+    return C()
+
+
+def _compile_struct(fmt):
+    try:
+        return struct.Struct(fmt)
+    except struct.error as err:
+        print("\nAPI_Error: invalid struct format '{}': {}".format(fmt, err))
+        raise WallarooParameterError()
+
+
+def _struct_item_count(s):
+    return len(s.unpack(b'\x00' * s.size))
+
+
 class TCPSourceConfig(object):
     def __init__(self, name, host, port, decoder, valid=True, parallelism=10, max_size=16384, max_received_count=50):
         self._host = host
@@ -718,10 +1495,31 @@ class _PipelineTree(object):
         self.es[self.root_idx].append(p_graph.root_idx + diff)
         return self
 
-    def to_tuple(self, app_name):
+    def to_tuple(self, app_name, fuse_computations=False):
         p_tree = self.clone()
+        if fuse_computations:
+            p_tree.fuse_computations()
         return (app_name, p_tree.root_idx, p_tree.vs, p_tree.es)
 
+    def fuse_computations(self):
+        """
+        Replace every run of consecutive stateless computations in a node
+        with a single `_FusedComputation` stage.
+        """
+        for idx, stages in enumerate(self.vs):
+            fused = []
+            run = []
+            for stage in stages:
+                if _is_fusable(stage):
+                    run.append(stage[1])
+                    continue
+                fused.extend(_fuse(run))
+                run = []
+                fused.append(stage)
+            fused.extend(_fuse(run))
+            self.vs[idx] = fused
+        return self
+
     def clone(self):
         new_vs = []
         new_es = []
@@ -759,6 +1557,47 @@ class _PipelineTree(object):
         return sinks
 
 
+def _is_fusable(stage):
+    return (stage[0] == "to" and isinstance(stage[1], Computation) and
+            not isinstance(stage[1], ComputationMulti))
+
+
+def _fuse(computations):
+    if len(computations) < 2:
+        return [("to", c) for c in computations]
+    return [("to", _FusedComputation(computations))]
+
+
+class _FusedComputation(Computation):
+    """
+    Stateless computations run one after the other in a single step. A
+    computation returning None drops the message, as it would on its own.
+    """
+    def __init__(self, computations):
+        self.computations = tuple(computations)
+        self._compute_fns = None
+
+    def name(self):
+        return "+".join(c.name() for c in self.computations)
+
+    def compute(self, data):
+        fns = self._compute_fns
+        if fns is None:
+            fns = self._compute_fns = [c.compute for c in self.computations]
+        for compute in fns:
+            data = compute(data)
+            if data is None:
+                return None
+        return data
+
+    def __getstate__(self):
+        return self.computations
+
+    def __setstate__(self, state):
+        self.computations = state
+        self._compute_fns = None
+
+
 class RangeWindowsBuilder(object):
     def __init__(self, wrange):
         self.range = wrange
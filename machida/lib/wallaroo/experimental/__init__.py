@@ -15,13 +15,19 @@
 import argparse
 import asynchat
 import asyncore
-from collections import namedtuple
+from collections import deque, namedtuple
 from datetime import datetime
+import errno
 import inspect
 import logging
 import os
 from select import select
 import socket
+try:
+    import selectors
+except ImportError:
+    # Python 2: SinkConnector falls back to select()
+    selectors = None
 import struct
 import sys
 import threading
@@ -35,6 +41,7 @@ import traceback
 import wallaroo
 from wallaroo import dt_to_timestamp
 from  . import connector_wire_messages as cwm
+from .batching import batches
 
 # get a version comptible base metaclass
 if sys.version_info.major == 2:
@@ -184,15 +191,329 @@ def _asyncore_loop(sentinel, timeout, socket_map):
         None
 
 
-class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
+class _FrameBuffer(bytearray):
+    """
+    A `bytearray` that `_SendBuffer` allocated for small frames, and so may
+    clear and reuse once it has been sent.
+    """
+    pass
+
+
+class _SendBuffer(object):
+    """
+    Outgoing frames waiting to be written to a socket.
+
+    Small frames are appended to a shared `_FrameBuffer`, which is reused
+    once it has been sent. Frames of at least `_COPY_LIMIT` bytes are kept as
+    chunks of their own and handed to `socket.sendmsg` alongside the rest
+    without being copied. A partial send only moves an offset into the first
+    chunk.
+    """
+    _COPY_LIMIT = 16384
+    # Most platforms limit sendmsg to 1024 buffers
+    _MAX_CHUNKS = 1024
+
+    def __init__(self):
+        self._chunks = deque()
+        self._tail = None  # the _FrameBuffer that small frames are added to
+        self._spare = _FrameBuffer()
+        self._offset = 0  # bytes of the first chunk that were already sent
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if len(data) >= self._COPY_LIMIT:
+            self._chunks.append(data)
+            self._tail = None
+        else:
+            if self._tail is None:
+                if self._spare is not None:
+                    self._tail, self._spare = self._spare, None
+                else:
+                    self._tail = _FrameBuffer()
+                self._chunks.append(self._tail)
+            self._tail += data
+        self.size += len(data)
+
+    def clear(self):
+        self._chunks.clear()
+        self._tail = None
+        self._spare = _FrameBuffer()
+        self._offset = 0
+        self.size = 0
+
+    def send(self, sock, sent_data=None):
+        """
+        Send as much as the socket accepts and return the number of bytes
+        sent. The bytes are also appended to `sent_data` if it is a list.
+        """
+        if not self.size:
+            return 0
+        buffers = [memoryview(self._chunks[0])[self._offset:]]
+        try:
+            if hasattr(sock, 'sendmsg') and len(self._chunks) > 1:
+                for i in range(1, min(len(self._chunks), self._MAX_CHUNKS)):
+                    buffers.append(self._chunks[i])
+                sent = sock.sendmsg(buffers)
+            else:
+                sent = sock.send(buffers[0])
+            if sent_data is not None:
+                # A generator, as a Python 2 list comprehension would leak
+                # its view of the first chunk
+                sent_data.append(b''.join(
+                    memoryview(b).tobytes() for b in buffers)[:sent])
+        finally:
+            # The view of the first chunk has to go before it can grow again
+            del buffers
+        self._consume(sent)
+        return sent
+
+    def _consume(self, sent):
+        self.size -= sent
+        chunks = self._chunks
+        while sent:
+            remaining = len(chunks[0]) - self._offset
+            if sent < remaining:
+                self._offset += sent
+                return
+            sent -= remaining
+            self._offset = 0
+            done = chunks.popleft()
+            if done is self._tail:
+                self._tail = None
+            if type(done) is _FrameBuffer:
+                # keep the buffer to avoid reallocating it for the next
+                # frames. Large frames belong to the caller and are left as
+                # they are.
+                del done[:]
+                self._spare = done
+
+
+class _AtLeastOnceProtocol(BaseMeta):
+    """
+    Stream bookkeeping shared by the at-least-once source connectors.
+
+    Subclasses provide the transport: `_write(data)` queues an encoded frame
+    for sending, and incoming NotifyAck and Ack messages are passed to
+    `_handle_notify_ack` and `_handle_ack`.
+    """
+    ###########################
+    # Incoming communications #
+    ###########################
+
+    def _handle_notify_ack(self, msg):
+        logging.debug("NOTIFYack {}".format(msg))
+        old = self._streams.get(msg.stream_id, None)
+        if old is not None:
+            new = Stream(old.id, old.name, msg.point_of_ref,
+                         msg.notify_success)
+            self._streams[old.id] = new
+            self.stream_added(new)
+            if new.is_open:
+                self.stream_opened(new)
+            else:
+                logging.info("Stream {} id {} added to _retry_notify".format(old.name, msg.stream_id))
+                self._retry_notify[msg.stream_id] = new
+        else:
+            # shouldn't get an ack for a stream we never notified
+            # but it's not strictly an error, so don't crash
+            logging.warning("received a NotifyAck for a stream that wasn't"
+                " notified: {}".format(msg))
+
+    def _handle_ack(self, msg):
+        self.credits += msg.credits
+        for (stream_id, point_of_ref) in msg.acks:
+            # Try to get old stream data
+            old = self._streams.get(stream_id, None)
+            if old:
+                if point_of_ref != old.point_of_ref:
+                    new = Stream(stream_id, old.name, point_of_ref,
+                                 old.is_open)
+                    self._streams[stream_id] = new
+                else:
+                    new = old
+                self.stream_acked(new)
+        # Use this ack as a substitute for a timer that will
+        # trigger retrying these stream ID notifications.
+        for stream in self._retry_notify.values():
+            logging.info("_retry_notify for {} id {}".format(stream.name, stream.id))
+            self.notify(stream.id, stream.name, stream.point_of_ref)
+        self._retry_notify = {}
+
+    ##########################
+    # Outoing communications #
+    ##########################
+
+    def write(self, msg):
+        if isinstance(msg, cwm.Message):
+            # TODO: what to do when stream is closed?
+            # For now: if stream isn't open (or doesn't exist), raise error
+            # In the future, maybe this should automatically send a notify
+            try:
+                if self._streams[msg.stream_id].is_open:
+                    ##logging.debug("write: encode: {}".format(msg))
+                    data = cwm.Frame.encode(msg)
+                    self._write(data)
+                    # use up 1 credit
+                    self.credits -= 1
+                else:
+                    raise
+            except:
+                raise ProtocolError("Message {} cannot be sent. Stream ({}) is "
+                                    "not in an open state. Use notify() to "
+                                    "open it."
+                                    .format(msg, msg.stream_id))
+        elif isinstance(msg, cwm.MessageBatch):
+            stream = self._streams.get(msg.stream_id)
+            if stream is None or not stream.is_open:
+                raise ProtocolError("MessageBatch for stream {} cannot be "
+                                    "sent. The stream is not in an open "
+                                    "state. Use notify() to open it."
+                                    .format(msg.stream_id))
+            data = cwm.Frame.encode(msg)
+            self._write(data)
+            # use up 1 credit per batch, or 1 per message if negotiated
+            if self._credit_per_message:
+                self.credits -= len(msg)
+            else:
+                self.credits -= 1
+        elif isinstance(msg, cwm.Notify):
+            # write the message
+            data = cwm.Frame.encode(msg)
+            self._write(data)
+            # use up 1 credit
+            self.credits -= 1
+        elif isinstance(msg, (cwm.EosMessage, cwm.Error)):
+            # write the message
+            data = cwm.Frame.encode(msg)
+            self._write(data)
+        else:
+            raise ProtocolError("Can only send message types {{Notify, "
+                                "Message, MessageBatch, EosMessage, Error}}. "
+                                "Received {}".format(msg))
+
+    def notify(self, stream_id, stream_name=None, point_of_ref=None):
+        old = self._streams.get(stream_id, None)
+        if old:
+            if point_of_ref is None:
+                raise ConnectorError("Cannot update a stream without a valid "
+                                     "point_of_ref value")
+            new = Stream(stream_id,
+                         old.name if old is not None else stream_name,
+                         (point_of_ref if point_of_ref is not None else
+                          old.point_of_ref),
+                         old.is_open)
+        else:
+            if stream_name is None:
+                raise ConnectorError("Cannot notify a new stream without "
+                                     "a Stream name!")
+            new = Stream(stream_id,
+                         stream_name,
+                         0 if point_of_ref is None else point_of_ref,
+                         False)
+
+        # update locally and call stream_added
+        self._streams[new.id] = new
+        self.stream_added(new)
+
+        # send to wallaroo worker
+        logging.debug("sending NOTIFY: {} on {}".format(cwm.Notify(new.id, new.name, new.point_of_ref), self._conn))
+        self.write(cwm.Notify(new.id,
+                              new.name,
+                              new.point_of_ref))
+
+    def end_of_stream(self, stream_id):
+        """
+        Send an EOS message for a stream_id.
+        """
+        # TODO: Wallaroo needs to ack and connector should implement a
+        # stream_ended(stream) method.
+        # Without this, there is a race condition around end of streams and
+        # restarts which can result in the tail end of a stream not being resent
+        # if it was EOSd before a restart, but the rollback is to before the EOS.
+        msg = cwm.EosMessage(
+            stream_id = stream_id)
+        logging.info("Sending End of Stream {}".format(msg))
+        self.write(msg)
+
+    ###########################
+    # User extensible methods #
+    ###########################
+
+    def handle_invalid_message(self, msg):
+        logging.warning(ProtocolError(
+            "Received an unrecognized message: {}".format(msg)))
+
+    def handle_restarted(self, streams):
+        """
+        Logic to execute after successfully completing a restart
+
+        The default is to send a new notify for every known stream.
+        User may override this to provide their own logic based on the state
+        of their sources.
+        """
+        # if restarting, send new notifys for existing streams to reopen them
+        for stream in streams.values():
+            self.notify(stream.id, stream.name, stream.point_of_ref)
+
+    ########################
+    # User defined methods #
+    ########################
+
+    def stream_added(self, stream):
+        """
+        Action to take when a new stream is added [optional]
+        """
+        pass
+
+    def stream_removed(self, stream):
+        """
+        Action to take when a stream is removed [optional]
+        """
+        pass
+
+    @abstractmethod
+    def stream_opened(self, stream):
+        """
+        Action to take when a stream status changes from closed to open
+        [required]
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_closed(self, stream):
+        """
+        Action to take when a stream status changes from open to closed
+        [required]
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_acked(self, stream):
+        """
+        Action to take when a stream's point of reference is updated
+        [required]
+        """
+        raise NotImplementedError
+
+
+class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector,
+                                 _AtLeastOnceProtocol):
     def __init__(self, version, cookie, program_name, instance_name,
-                 host, port, delay=0):
+                 host, port, delay=0, credit_mode=cwm.CREDITS_PER_FRAME,
+                 high_water=65536):
 
         self.data = None
         # connection details are given from the base
         self._host = host
         self._port = int(port)  # convert port to int
         self.credits = 0
+        # The credit mode requested in Hello, and the one Wallaroo granted
+        # in Ok
+        self.credit_mode = credit_mode
+        self._credit_per_message = False
         self.version = version
         self.cookie = cookie
         self.program_name = program_name
@@ -201,6 +522,10 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         self._previous_ts = 0
 
         self._write_lock = threading.Lock()
+        # Encoded frames waiting to be sent. `handle_write` stops pulling
+        # messages from `__next__` once `high_water` bytes are queued.
+        self._out = _SendBuffer()
+        self._high_water = high_water
 
         # Stream details
         # live streams for this connection
@@ -316,7 +641,8 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
             self.handle_restart(msg)
         # messages that should only go connector->wallaroo
         # Notify, Hello, Message
-        elif isinstance(msg, (cwm.Hello, cwm.Message, cwm.EosMessage, cwm.Notify)):
+        elif isinstance(msg, (cwm.Hello, cwm.Message, cwm.MessageBatch,
+                              cwm.EosMessage, cwm.Notify)):
             # send error to wallaroo then shutdown and raise a protocol
             # exception
             try:
@@ -337,50 +663,13 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         else:
             # deposit the credits
             self.credits += msg.initial_credits
+            self._credit_per_message = (
+                msg.credit_mode == cwm.CREDITS_PER_MESSAGE)
             # set handshake_complete
             self.handshake_complete = True
             # set terminator to 4 to expect the next message's header
             self.set_terminator(4)
 
-    def _handle_notify_ack(self, msg):
-        logging.debug("NOTIFYack {}".format(msg))
-        old = self._streams.get(msg.stream_id, None)
-        if old is not None:
-            new = Stream(old.id, old.name, msg.point_of_ref,
-                         msg.notify_success)
-            self._streams[old.id] = new
-            self.stream_added(new)
-            if new.is_open:
-                self.stream_opened(new)
-            else:
-                logging.info("Stream {} id {} added to _retry_notify".format(old.name, msg.stream_id))
-                self._retry_notify[msg.stream_id] = new
-        else:
-            # shouldn't get an ack for a stream we never notified
-            # but it's not strictly an error, so don't crash
-            logging.warning("received a NotifyAck for a stream that wasn't"
-                " notified: {}".format(msg))
-
-    def _handle_ack(self, msg):
-        self.credits += msg.credits
-        for (stream_id, point_of_ref) in msg.acks:
-            # Try to get old stream data
-            old = self._streams.get(stream_id, None)
-            if old:
-                if point_of_ref != old.point_of_ref:
-                    new = Stream(stream_id, old.name, point_of_ref,
-                                 old.is_open)
-                    self._streams[stream_id] = new
-                else:
-                    new = old
-                self.stream_acked(new)
-        # Use this ack as a substitute for a timer that will
-        # trigger retrying these stream ID notifications.
-        for stream in self._retry_notify.values():
-            logging.info("_retry_notify for {} id {}".format(stream.name, stream.id))
-            self.notify(stream.id, stream.name, stream.point_of_ref)
-        self._retry_notify = {}
-
     ##########################
     # Outoing communications #
     ##########################
@@ -412,7 +701,7 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
 
         self.in_handshake = True
         hello = cwm.Hello(self.version, self.cookie, self.program_name,
-                          self.instance_name)
+                          self.instance_name, self.credit_mode)
         data = cwm.Frame.encode(hello)
         self._conn.sendall(data)
         if self.data is not None:
@@ -459,13 +748,11 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
                     self._previous_ts = t
                     # continue
                 try:
-                    while self.credits > 0:
-                        msg = self.__next__()
-                        #if msg is not None: logging.debug("ITER msg = {}".format(msg))
-                        if msg:
-                            self.write(msg)
-                        else:
-                            break
+                    # Keep the socket fed: send whenever the buffer reaches
+                    # the high water mark, and stop when the socket is full
+                    # or credits or messages run out.
+                    while self._fill() and self.initiate_send():
+                        pass
                     self.initiate_send()
                 except StopIteration:
                     self.initiate_send()
@@ -473,6 +760,43 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
             else:
                 self.initiate_send()
 
+    def _fill(self):
+        """
+        Encode messages from `__next__` into the output buffer while there
+        are credits, until `high_water` bytes are queued. Return True if it
+        stopped at the high water mark, and may be called again once the
+        buffer has been sent.
+        """
+        out = self._out
+        next_frame = self._next_frame
+        high_water = self._high_water
+        while self.credits > 0:
+            if out.size >= high_water:
+                return True
+            frame = next_frame()
+            if frame is None:
+                break
+            if frame:
+                out.append(frame)
+                self.credits -= 1
+        return False
+
+    def _next_frame(self):
+        """
+        Return the encoded frame of the next Message from `__next__`, or None
+        if there is nothing to send right now. Other messages are passed to
+        `write` and an empty frame is returned in their place.
+        """
+        msg = self.__next__()
+        if not msg:
+            return None
+        if type(msg) is cwm.Message:
+            stream = self._streams.get(msg.stream_id)
+            if stream is not None and stream.is_open:
+                return msg.encode_frame()
+        self.write(msg)
+        return b''
+
     def shutdown(self, error=None):
         logging.info("AtLeastOnceConnector.shutdown(error={})".format(error))
         if self._async_init:
@@ -486,8 +810,8 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
             # If this is a clean shutdown, try to synchronously send any
             # remaining data that was queued
             try:
-                while self.producer_fifo:
-                    self._conn.sendall(self.producer_fifo.popleft())
+                while self._out:
+                    self._out.send(self._conn, self.data)
             except:
                 pass
         if isinstance(error, cwm.Error):
@@ -506,97 +830,45 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
     def writable(self):
         return self.credits >= 0
 
-    def write(self, msg):
-        if isinstance(msg, cwm.Message):
-            # TODO: what to do when stream is closed?
-            # For now: if stream isn't open (or doesn't exist), raise error
-            # In the future, maybe this should automatically send a notify
-            try:
-                if self._streams[msg.stream_id].is_open:
-                    ##logging.debug("write: encode: {}".format(msg))
-                    data = cwm.Frame.encode(msg)
-                    self._write(data)
-                    # use up 1 credit
-                    self.credits -= 1
-                else:
-                    raise
-            except:
-                raise ProtocolError("Message {} cannot be sent. Stream ({}) is "
-                                    "not in an open state. Use notify() to "
-                                    "open it."
-                                    .format(msg, msg.stream_id))
-        elif isinstance(msg, cwm.Notify):
-            # write the message
-            data = cwm.Frame.encode(msg)
-            self._write(data)
-            # use up 1 credit
-            self.credits -= 1
-        elif isinstance(msg, (cwm.EosMessage, cwm.Error)):
-            # write the message
-            data = cwm.Frame.encode(msg)
-            self._write(data)
-        else:
-            raise ProtocolError("Can only send message types {{Notify, "
-                                "Message, EosMessage, Error}}. Received {}".format(msg))
-
     def _write(self, data):
         """
         Replaces asynchat.async_chat.push, which does a synchronous send
         i.e. without calling `initiate_send()` at the end
         """
         self._sent += 1
-        self.producer_fifo.append(data)
+        self._out.append(data)
 
     def initiate_send(self):
-        if self.connected:
-            # collect data up to 65kb in size, send, repeat, until empty
-            obs = self.ac_out_buffer_size
-            q = self.producer_fifo
-            data = []
-            data_len = 0
-            while q:
-                b = q.popleft()
-                if b is None:
-                    self.handle_close()
-                    return
-                elif not b:
-                    continue
-                if not isinstance(b, bytes):
-                    b = b.encode()
-                if data_len + len(b) > obs:
-                    joined = b''.join(data)
-                    if len(joined) > 0:
-                        res = self._send(joined)
-                        if res != len(joined):
-                            logging.info("initiate_send: socket send 1 returned {}".format(res))
-                            return
-                        data = [b]
-                        data_len = len(b)
-                else:
-                    data.append(b)
-                    data_len += len(b)
-            if data:
-                joined = b''.join(data)
-                res = self._send(joined)
-                if res != len(joined):
-                    logging.info("initiate_send: socket send 2 returned {}".format(res))
-                    return
-
-    def _send(self, data):
+        """
+        Send queued frames until the buffer is empty or the socket would
+        block. Return True if everything was sent.
+        """
+        if not self.connected:
+            return False
+        out = self._out
+        while out:
+            if not self._send():
+                logging.debug("initiate_send: socket is full with {} bytes "
+                              "queued".format(len(out)))
+                return False
+        return True
+
+    def _send(self):
         try:
-            # This is the call to asyncore that actually writes to the socket
-            res = self.send(data)
-            if self.data is not None:
-                self.data.append(data)
-            return res
-        except OSError:
+            return self._out.send(self.socket, self.data)
+        except socket.error as err:
+            if err.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return 0
+            elif err.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
             return self.handle_error()
 
     def pending_sends(self):
         """
         Are there any pending sends
         """
-        if len(self.producer_fifo) > 0:
+        if len(self._out) > 0:
             return True
         else:
             return False
@@ -605,70 +877,10 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         logging.warning("Sending error message: {}".format(message))
         self.shutdown(error=message)
 
-    def notify(self, stream_id, stream_name=None, point_of_ref=None):
-        old = self._streams.get(stream_id, None)
-        if old:
-            if point_of_ref is None:
-                raise ConnectorError("Cannot update a stream without a valid "
-                                     "point_of_ref value")
-            new = Stream(stream_id,
-                         old.name if old is not None else stream_name,
-                         (point_of_ref if point_of_ref is not None else
-                          old.point_of_ref),
-                         old.is_open)
-        else:
-            if stream_name is None:
-                raise ConnectorError("Cannot notify a new stream without "
-                                     "a Stream name!")
-            new = Stream(stream_id,
-                         stream_name,
-                         0 if point_of_ref is None else point_of_ref,
-                         False)
-
-        # update locally and call stream_added
-        self._streams[new.id] = new
-        self.stream_added(new)
-
-        # send to wallaroo worker
-        logging.debug("sending NOTIFY: {} on {}".format(cwm.Notify(new.id, new.name, new.point_of_ref), self._conn))
-        self.write(cwm.Notify(new.id,
-                              new.name,
-                              new.point_of_ref))
-
-    def end_of_stream(self, stream_id):
-        """
-        Send an EOS message for a stream_id.
-        """
-        # TODO: Wallaroo needs to ack and connector should implement a
-        # stream_ended(stream) method.
-        # Without this, there is a race condition around end of streams and
-        # restarts which can result in the tail end of a stream not being resent
-        # if it was EOSd before a restart, but the rollback is to before the EOS.
-        msg = cwm.EosMessage(
-            stream_id = stream_id)
-        logging.info("Sending End of Stream {}".format(msg))
-        self.write(msg)
-
     ###########################
     # User extensible methods #
     ###########################
 
-    def handle_restarted(self, streams):
-        """
-        Logic to execute after successfully completing a restart
-
-        The default is to send a new notify for every known stream.
-        User may override this to provide their own logic based on the state
-        of their sources.
-        """
-        # if restarting, send new notifys for existing streams to reopen them
-        for stream in streams.values():
-            self.notify(stream.id, stream.name, stream.point_of_ref)
-
-    def handle_invalid_message(self, msg):
-        logging.warning(ProtocolError(
-            "Received an unrecognized message: {}".format(msg)))
-
     def handle_restart(self, msg):
         logging.warning("Received RESTART message. Closing streams and "
             "reinitiating handshake.")
@@ -708,12 +920,8 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
                 self._streams[sid] = new
                 self.stream_closed(new)
 
-        logging.debug("Popping the producer_fifo")
-        c = 0
-        while self.producer_fifo:
-            self.producer_fifo.popleft()
-            c = c + 1
-        logging.debug("Popping the producer_fifo: count = {}".format(c))
+        logging.debug("Dropping {} unsent bytes".format(len(self._out)))
+        self._out.clear()
         self.discard_buffers()
         self._retry_notify = {}
 
@@ -782,45 +990,77 @@ class AtLeastOnceSourceConnector(asynchat.async_chat, BaseConnector, BaseMeta):
         self.error = _value
         self.close()
 
-    ########################
-    # User defined methods #
-    ########################
+class _RecvBuffer(object):
+    """
+    Bytes received on one connection that have not been decoded yet.
 
-    def stream_added(self, stream):
-        """
-        Action to take when a new stream is added [optional]
-        """
-        pass
+    Data is received straight into a preallocated `bytearray`, and complete
+    frames are read from it by offset. Undecoded bytes are only moved when
+    the end of the buffer is reached, to its front, and the buffer doubles
+    in size when more than half of it is a single incomplete frame.
+    """
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._start = 0  # first byte that has not been decoded
+        self._end = 0  # end of the received bytes
 
-    def stream_removed(self, stream):
-        """
-        Action to take when a stream is removed [optional]
-        """
-        pass
+    def __len__(self):
+        return self._end - self._start
 
-    @abstractmethod
-    def stream_opened(self, stream):
+    def recv_from(self, sock):
         """
-        Action to take when a stream status changes from closed to open
-        [required]
-        """
-        raise NotImplementedError
-
-    @abstractmethod
-    def stream_closed(self, stream):
+        Receive into the free end of the buffer. Return the number of bytes
+        received, 0 if the connection was closed.
         """
-        Action to take when a stream status changes from open to closed
-        [required]
-        """
-        raise NotImplementedError
+        if self._end == len(self._buf):
+            self._make_room()
+        view = memoryview(self._buf)
+        try:
+            received = sock.recv_into(view[self._end:])
+        finally:
+            del view
+        self._end += received
+        return received
+
+    def _make_room(self):
+        buf = self._buf
+        pending = self._end - self._start
+        if pending > len(buf) // 2:
+            grown = bytearray(len(buf) * 2)
+            grown[:pending] = buf[self._start:self._end]
+            self._buf = grown
+        else:
+            buf[:pending] = buf[self._start:self._end]
+        self._start = 0
+        self._end = pending
 
-    @abstractmethod
-    def stream_acked(self, stream):
+    def frames(self, decoder):
         """
-        Action to take when a stream's point of reference is updated
-        [required]
+        Yield the payload of each complete frame in the buffer, using
+        `decoder`'s header to find where frames end.
         """
-        raise NotImplementedError
+        # Slicing a view copies each payload once, where slicing the
+        # bytearray would copy it into a new bytearray first.
+        view = memoryview(self._buf)
+        header_length = decoder.header_length()
+        length_fmt = getattr(decoder, 'length_fmt', None)
+        if length_fmt is not None:
+            length = struct.Struct(length_fmt).unpack_from
+        else:
+            length = lambda view, offset: (decoder.payload_length(
+                view[offset:offset + header_length].tobytes()),)
+        try:
+            while self._end - self._start >= header_length:
+                start = self._start + header_length
+                end = start + length(view, self._start)[0]
+                if end > self._end:
+                    break
+                self._start = end
+                yield view[start:end].tobytes()
+        finally:
+            del view
+        if self._start == self._end:
+            self._start = self._end = 0
 
 
 class SinkConnector(object):
@@ -844,7 +1084,9 @@ class SinkConnector(object):
         self._acceptor = None
         self._connections = []
         self._buffers = {}
-        self._pending = []
+        # Messages that were decoded but not read yet
+        self._pending = deque()
+        self._selector = selectors.DefaultSelector() if selectors else None
 
     def listen(self, host=None, port=None, backlog=0):
         acceptor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -853,15 +1095,69 @@ class SinkConnector(object):
         acceptor.listen(backlog)
         self._acceptor = acceptor
         self._connections.append(acceptor)
+        if self._selector is not None:
+            self._selector.register(acceptor, selectors.EVENT_READ)
 
     def read(self, timeout=None):
+        """
+        Return the next message, waiting for one for as long as it takes.
+        """
         while True:
-            for socket in self._pending:
-                ok, message = self._read_one(socket)
-                if ok: return message
-            self._select_any(timeout)
+            messages = self.read_batch(1, timeout)
+            if messages:
+                return messages[0]
+
+    def read_batch(self, max_messages=None, timeout=None):
+        """
+        Return a list of up to `max_messages` decoded messages, or all of
+        those that have been received if `max_messages` is None. Wait up to
+        `timeout` seconds, or indefinitely if it is None, for at least one
+        message to arrive. An empty list is returned if none did.
+        """
+        pending = self._pending
+        if not pending:
+            deadline = None if timeout is None else time.time() + timeout
+            while not pending:
+                if deadline is None:
+                    self._select_any()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining < 0:
+                        break
+                    self._select_any(remaining)
+        if max_messages is None or max_messages >= len(pending):
+            messages = list(pending)
+            pending.clear()
+            return messages
+        return [pending.popleft() for _ in range(max_messages)]
 
     def _select_any(self, timeout=None):
+        """
+        Wait for connections to become readable, then receive from each of
+        them and decode every complete frame.
+        """
+        for socket in self._readable(timeout):
+            if socket is self._acceptor:
+                conn, _addr = socket.accept()
+                self._setup_connection(conn)
+                continue
+            buffered = self._buffers[socket]
+            try:
+                received = buffered.recv_from(socket)
+            except (IOError, OSError) as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    continue
+                received = 0
+            if not received:
+                self._teardown_connection(socket)
+                continue
+            self._decode_buffered(buffered)
+
+    def _readable(self, timeout):
+        if self._selector is not None:
+            return [key.fileobj for key, _events
+                    in self._selector.select(timeout)]
         readable, _, exceptional = select(self._connections, [], self._connections, timeout)
         for socket in exceptional:
             if socket is self._acceptor:
@@ -869,40 +1165,27 @@ class SinkConnector(object):
                 raise UnexpectedSocketError()
             else:
                 self._teardown_connection(socket)
-        for socket in readable:
-            if socket is self._acceptor:
-                conn, _addr = socket.accept()
-                self._setup_connection(conn)
-            else:
-                buffered = self._buffers[socket] + socket.recv(4096)
-                self._buffers[socket] = buffered
-                self._pending.append(socket)
-
-    def _read_one(self, socket):
-        buffered = self._buffers[socket]
-        header_len = self._decoder.header_length()
-        if len(buffered) < header_len:
-            self._buffers[socket] = buffered
-            return (False, None)
-        expected = self._decoder.payload_length(buffered[:header_len])
-        if len(buffered) < header_len + expected:
-            self._buffers[socket] = buffered
-            return (False, None)
-        data = buffered[header_len:header_len+expected]
-        buffered = buffered[header_len + expected:]
-        self._buffers[socket] = buffered
-        if len(buffered) < header_len:
-            self._pending.remove(socket)
-        return (True, self._decoder.decode(data))
+        return [socket for socket in readable
+                if socket is self._acceptor or socket in self._buffers]
+
+    def _decode_buffered(self, buffered):
+        decode = self._decoder.decode
+        append = self._pending.append
+        for payload in buffered.frames(self._decoder):
+            append(decode(payload))
 
     def _setup_connection(self, conn):
         conn.setblocking(0)
         self._connections.append(conn)
-        self._buffers[conn] = b""
+        self._buffers[conn] = _RecvBuffer()
+        if self._selector is not None:
+            self._selector.register(conn, selectors.EVENT_READ)
 
     def _teardown_connection(self, conn):
         self._connections.remove(conn)
         del self._buffers[conn]
+        if self._selector is not None:
+            self._selector.unregister(conn)
         conn.close()
 
 
@@ -928,3 +1211,204 @@ def _parse_connector_prefix(args):
     parser.add_argument('--connector', dest='connector_name')
     params = parser.parse_known_args(args)[0]
     return params.connector_name
+
+
+if sys.version_info >= (3, 5):
+    from .async_connector import AsyncAtLeastOnceSourceConnector
+
+
+class _ChunkedSocket(object):
+    """
+    Hands out the given chunks of bytes, one per `recv_into` call.
+    """
+    def __init__(self, chunks):
+        self.chunks = deque(chunks)
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.popleft()
+        size = min(len(chunk), len(view))
+        view[:size] = chunk[:size]
+        if size < len(chunk):
+            self.chunks.appendleft(chunk[size:])
+        return size
+
+
+@wallaroo.decoder(header_length=4, length_fmt=">I")
+def _test_decoder(bs):
+    return bs
+
+
+class _ShortHeaderDecoder(object):
+    """
+    A decoder without a `length_fmt`, whose frames have 2 byte headers.
+    """
+    def header_length(self):
+        return 2
+
+    def payload_length(self, bs):
+        return struct.unpack(">H", bs)[0]
+
+
+def _framed(*payloads):
+    return b"".join(struct.pack(">I", len(p)) + p for p in payloads)
+
+
+def test_recv_buffer_frames_split_across_reads():
+    data = _framed(b"hello", b"", b"wallaroo")
+    buffered = _RecvBuffer()
+    sock = _ChunkedSocket([data[:2], data[2:7], data[7:14], data[14:]])
+    frames = []
+    while buffered.recv_from(sock):
+        frames.extend(buffered.frames(_test_decoder))
+    assert(frames == [b"hello", b"", b"wallaroo"])
+    assert(len(buffered) == 0 and buffered._start == buffered._end == 0)
+
+
+def test_recv_buffer_payload_length():
+    # Without a length_fmt the decoder's payload_length() reads the header
+    buffered = _RecvBuffer()
+    buffered.recv_from(_ChunkedSocket([b"\x00\x03abc\x00\x01"]))
+    assert(list(buffered.frames(_ShortHeaderDecoder())) == [b"abc"])
+    assert(len(buffered) == 2)
+
+
+def test_recv_buffer_moves_and_grows():
+    buffered = _RecvBuffer(16)
+    sock = _ChunkedSocket([_framed(b"abcdefgh", b"xy")])
+    buffered.recv_from(sock)
+    assert(list(buffered.frames(_test_decoder)) == [b"abcdefgh"])
+    # The rest of the second frame is moved to the front of the buffer
+    buffered.recv_from(sock)
+    assert(len(buffered._buf) == 16 and buffered._start == 0)
+    assert(list(buffered.frames(_test_decoder)) == [b"xy"])
+    # A frame larger than half of the buffer makes it grow
+    sock = _ChunkedSocket([_framed(b"z" * 40)])
+    sizes = []
+    frames = []
+    while not frames:
+        assert(buffered.recv_from(sock))
+        sizes.append(len(buffered._buf))
+        frames = list(buffered.frames(_test_decoder))
+    assert(frames == [b"z" * 40] and sizes == [16, 32, 64])
+
+
+def _sink_connector(decoder):
+    connector = SinkConnector.__new__(SinkConnector)
+    connector._decoder = decoder
+    connector._acceptor = None
+    connector._connections = []
+    connector._buffers = {}
+    connector._pending = deque()
+    connector._selector = selectors.DefaultSelector() if selectors else None
+    return connector
+
+
+def test_sink_connector_read_batch():
+    connector = _sink_connector(_test_decoder)
+    sender, receiver = socket.socketpair()
+    try:
+        connector._setup_connection(receiver)
+        # Nothing arrives before the timeout
+        start = time.time()
+        assert(connector.read_batch(timeout=0.05) == [])
+        assert(time.time() - start >= 0.04)
+        sender.sendall(_framed(b"a", b"b", b"c"))
+        assert(connector.read_batch(2, timeout=1) == [b"a", b"b"])
+        # Messages that were decoded already are returned without waiting
+        assert(connector.read_batch(2, timeout=0) == [b"c"])
+        sender.sendall(_framed(b"d", b"e"))
+        assert(connector.read_batch(timeout=1) == [b"d", b"e"])
+        sender.sendall(_framed(b"f"))
+        assert(connector.read() == b"f")
+        # A closed connection is torn down
+        sender.close()
+        assert(connector.read_batch(timeout=0.05) == [])
+        assert(not connector._buffers and not connector._connections)
+    finally:
+        sender.close()
+        for conn in connector._connections:
+            conn.close()
+
+
+class _ShortWriteSocket(object):
+    """
+    Accepts at most `limit` bytes per call, and records what it was sent and
+    how many buffers each `sendmsg` call was given.
+    """
+    def __init__(self, limit, sendmsg=True):
+        self.limit = limit
+        self.received = bytearray()
+        self.buffer_counts = []
+        if sendmsg:
+            self.sendmsg = self._sendmsg
+
+    def send(self, data):
+        return self._accept([data])
+
+    def _sendmsg(self, buffers):
+        self.buffer_counts.append(len(buffers))
+        return self._accept(buffers)
+
+    def _accept(self, buffers):
+        data = b"".join(memoryview(b).tobytes() for b in buffers)
+        data = data[:self.limit]
+        self.received += data
+        return len(data)
+
+
+def _drain(out, sock):
+    sent_data = []
+    while out:
+        assert(out.send(sock, sent_data) > 0)
+    return b"".join(sent_data)
+
+
+def test_send_buffer_short_writes():
+    for sendmsg in (True, False):
+        out = _SendBuffer()
+        out._COPY_LIMIT = 8
+        frames = [b"ab", b"cde", b"0123456789", b"f", bytearray(b"x" * 12),
+                  b"ghij"]
+        for frame in frames:
+            out.append(frame)
+        assert(len(out) == sum(len(f) for f in frames))
+        # Small frames share chunks, large ones are chunks of their own
+        assert(len(out._chunks) == 5)
+        sock = _ShortWriteSocket(3, sendmsg)
+        sent_data = _drain(out, sock)
+        assert(bytes(sock.received) == b"".join(bytes(f) for f in frames))
+        assert(sent_data == bytes(sock.received))
+        assert(len(out) == 0 and not out._chunks and out._offset == 0)
+
+
+def test_send_buffer_caps_sendmsg_buffers():
+    out = _SendBuffer()
+    out._COPY_LIMIT = 1
+    out._MAX_CHUNKS = 4
+    frames = [str(i).encode() for i in range(10)]
+    for frame in frames:
+        out.append(frame)
+    sock = _ShortWriteSocket(100)
+    _drain(out, sock)
+    assert(bytes(sock.received) == b"".join(frames))
+    assert(sock.buffer_counts == [4, 4, 2])
+
+
+def test_send_buffer_reuses_its_own_buffers():
+    out = _SendBuffer()
+    out._COPY_LIMIT = 8
+    out.append(b"abc")
+    tail = out._tail
+    large = bytearray(b"y" * 10)
+    out.append(large)
+    _drain(out, _ShortWriteSocket(4))
+    # The buffer it allocated is cleared and reused for the next frames,
+    # the caller's bytearray is left alone
+    assert(large == bytearray(b"y" * 10))
+    assert(out._spare is tail and len(tail) == 0)
+    out.append(b"de")
+    assert(out._tail is tail and tail == b"de")
+    out.clear()
+    assert(len(out) == 0 and out._tail is None)
@@ -0,0 +1,433 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+An asyncio implementation of the at-least-once source connector protocol.
+
+This module requires Python 3.5 or later. It is re-exported from
+`wallaroo.experimental` when available.
+"""
+
+import asyncio
+import errno
+import logging
+
+from . import (_AtLeastOnceProtocol,
+               connector_wire_messages as cwm,
+               ConnectorError,
+               ProtocolError,
+               Stream)
+
+
+class AsyncAtLeastOnceSourceConnector(_AtLeastOnceProtocol):
+    """
+    AsyncAtLeastOnceSourceConnector
+
+    The at-least-once source connector protocol on an asyncio event loop.
+    Streams, credits, acks and restarts behave as in
+    `AtLeastOnceSourceConnector`, and the same `stream_*` callbacks must be
+    implemented.
+
+    Nothing polls: `run()` sleeps until Wallaroo grants credits, a message is
+    written or the connection changes. Frames are coalesced into writes of up
+    to `_FLUSH_SIZE` bytes, and `run()` waits for the socket's write buffer to
+    drain below `high_water` bytes before producing more.
+
+    If the class has a `__next__` method, `run()` consumes from it while
+    credits are available, until it raises StopIteration. `__next__` may
+    return None when it has nothing to send, in which case it is called again
+    after `idle_timeout` seconds or as soon as anything else happens.
+    Otherwise, messages are sent with `write(msg)` from other coroutines on
+    the same loop, and `run()` returns once `shutdown()` is called.
+
+    ```
+    client = MyConnector("0.0.1", "cookie", "program", "instance",
+                         "127.0.0.1", 7100)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(client.connect())
+    client.notify(1, "stream-1")
+    loop.run_until_complete(client.run())
+    ```
+    """
+    # Frames are coalesced into writes of about this size, as asynchat does
+    # with its output buffer.
+    _FLUSH_SIZE = 65536
+
+    def __init__(self, version, cookie, program_name, instance_name,
+                 host, port, credit_mode=cwm.CREDITS_PER_FRAME,
+                 high_water=None, idle_timeout=0.01):
+        self._host = host
+        self._port = int(port)
+        self.credits = 0
+        # The credit mode requested in Hello, and the one Wallaroo granted
+        # in Ok
+        self.credit_mode = credit_mode
+        self._credit_per_message = False
+        self.version = version
+        self.cookie = cookie
+        self.program_name = program_name
+        self.instance_name = instance_name
+        self._high_water = high_water
+        self._idle_timeout = idle_timeout
+
+        # Stream details
+        # live streams for this connection
+        self._streams = {}  # {stream_id: Stream}
+        self._retry_notify = {} # {stream_id: Stream}
+
+        self.handshake_complete = False
+        self.error = None
+
+        self._reader = None
+        self._conn = None  # the connection's StreamWriter
+        self._reader_task = None
+        self._restart = None
+        self._wakeup = None
+        self._stopping = False
+        self._out = []
+        self._out_size = 0
+
+    ###########################
+    # Incoming communications #
+    ###########################
+
+    async def _read_frame(self):
+        header = await self._reader.readexactly(4)
+        frame = await self._reader.readexactly(cwm.Frame.read_header(header))
+        return cwm.Frame.decode(frame)
+
+    async def _read_loop(self):
+        """
+        Handle incoming frames until the connection is lost or restarted.
+        Errors are left on the task for `run()` to pick up.
+        """
+        try:
+            while True:
+                msg = await self._read_frame()
+                if isinstance(msg, cwm.Restart):
+                    self._restart = msg
+                    return
+                self._handle_frame(msg)
+        finally:
+            self._wake()
+
+    def _handle_frame(self, msg):
+        # Ok, Error, NotifyAck, Ack, Restart
+        if isinstance(msg, cwm.Ok):
+            raise ProtocolError("Got an Ok message outside of a handshake")
+        elif isinstance(msg, cwm.Error):
+            raise ConnectorError(msg.message)
+        elif isinstance(msg, cwm.NotifyAck):
+            self._handle_notify_ack(msg)
+        elif isinstance(msg, cwm.Ack):
+            self._handle_ack(msg)
+        # messages that should only go connector->wallaroo
+        elif isinstance(msg, (cwm.Hello, cwm.Message, cwm.MessageBatch,
+                              cwm.EosMessage, cwm.Notify)):
+            self.write(cwm.Error("Received an illegal message on the "
+                                 "connector side: {}".format(msg)))
+            raise ProtocolError(
+                "{} should never be received at the connector.".format(msg))
+        else: # handle unknown messages
+            self.handle_invalid_message(msg)
+
+    def _handle_notify_ack(self, msg):
+        super(AsyncAtLeastOnceSourceConnector, self)._handle_notify_ack(msg)
+        self._wake()
+
+    def _handle_ack(self, msg):
+        super(AsyncAtLeastOnceSourceConnector, self)._handle_ack(msg)
+        self._wake()
+
+    ##########################
+    # Outoing communications #
+    ##########################
+
+    async def connect(self):
+        """
+        Connect to Wallaroo and complete the Hello/Ok handshake.
+        """
+        self.handshake_complete = False
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        if self._high_water is not None:
+            writer.transport.set_write_buffer_limits(high=self._high_water)
+        self._reader = reader
+        self._conn = writer
+        writer.write(cwm.Frame.encode(cwm.Hello(
+            self.version, self.cookie, self.program_name, self.instance_name,
+            self.credit_mode)))
+        try:
+            msg = await self._read_frame()
+            if isinstance(msg, cwm.Error):
+                raise ConnectorError(msg.message)
+            elif not isinstance(msg, cwm.Ok):
+                raise ProtocolError("Expected an Ok message in the handshake."
+                                    " Received {}".format(msg))
+        except Exception:
+            writer.close()
+            self._conn = None
+            raise
+        # deposit the credits
+        self.credits += msg.initial_credits
+        self._credit_per_message = (
+            msg.credit_mode == cwm.CREDITS_PER_MESSAGE)
+        self.handshake_complete = True
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        logging.debug("Connected to {}:{}".format(self._host, self._port))
+
+    def _write(self, data):
+        self._out.append(data)
+        self._out_size += len(data)
+        self._wake()
+
+    async def _flush(self):
+        if self._out:
+            data = b''.join(self._out)
+            self._out = []
+            self._out_size = 0
+            self._conn.write(data)
+        # Only blocks while the transport holds more than its high water mark
+        await self._conn.drain()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _produce(self):
+        """
+        Write messages from `__next__` while there are credits, until about
+        `_FLUSH_SIZE` bytes are queued. Return the number of messages written.
+        """
+        count = 0
+        while self.credits > 0 and self._out_size < self._FLUSH_SIZE:
+            msg = self.__next__()
+            if not msg:
+                break
+            self.write(msg)
+            count += 1
+        return count
+
+    async def run(self):
+        """
+        Send messages until the source is exhausted or `shutdown()` is called,
+        reconnecting after a Restart or a lost connection.
+        """
+        if self._conn is None:
+            await self.connect()
+        producing = hasattr(self, '__next__')
+        try:
+            while not self._stopping:
+                self._wakeup.clear()
+                if self._reader_task.done():
+                    await self._reconnect()
+                    continue
+                try:
+                    count = self._produce() if producing else 0
+                except StopIteration:
+                    await self.shutdown()
+                    break
+                try:
+                    await self._flush()
+                except ConnectionError:
+                    # the read loop will see the connection go as well
+                    await self._reader_task
+                    continue
+                if count and self.credits > 0:
+                    continue
+                if producing and self.credits > 0:
+                    await self._wait(self._idle_timeout)
+                else:
+                    await self._wait(None)
+        except Exception as err:
+            self.error = err
+            await self.shutdown()
+            raise
+
+    async def shutdown(self, error=None):
+        """
+        Close the connection. On a clean shutdown any queued frames are sent
+        first; if `error` is a `cwm.Error` it is sent to Wallaroo instead.
+        """
+        logging.info("AsyncAtLeastOnceConnector.shutdown(error={})"
+                     .format(error))
+        self._stopping = True
+        self._wake()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._conn is None:
+            return
+        if isinstance(error, cwm.Error):
+            self._out = [cwm.Frame.encode(error)]
+        elif error is not None:
+            self._out = []
+        try:
+            await self._flush()
+        except ConnectionError:
+            pass
+        self._conn.close()
+        self._conn = None
+
+    ################
+    # Reconnecting #
+    ################
+
+    async def _reconnect(self):
+        try:
+            # re-raises whatever stopped the read loop
+            self._reader_task.result()
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            logging.error("Connection lost: {}".format(err))
+        restart, self._restart = self._restart, None
+        if restart is not None:
+            logging.warning("Received RESTART message. Closing streams and "
+                            "reinitiating handshake.")
+        self._close_common()
+        # optionally update target host and port
+        if restart is not None and restart.address:
+            logging.info("Updating target address from {}:{} to {}"
+                         .format(self._host, self._port, restart.address))
+            host, port = restart.address.split(':')
+            self._host = host
+            self._port = int(port)
+        else:
+            await asyncio.sleep(0.1)
+        while True:
+            try:
+                await self.connect()
+                break
+            except OSError as err:
+                if err.errno not in (errno.ECONNREFUSED, errno.ECONNRESET):
+                    raise
+                logging.debug("_reconnect: {}".format(err))
+                await asyncio.sleep(1.0)
+        self.handle_restarted(self._streams)
+
+    def _close_common(self):
+        # reset credits
+        self.credits = 0
+        self._conn.close()
+        self._conn = None
+        # close streams
+        for sid, stream in list(self._streams.items()):
+            if stream.is_open:
+                new = Stream(stream.id, stream.name, stream.point_of_ref, False)
+                self._streams[sid] = new
+                self.stream_closed(new)
+        self._out = []
+        self._out_size = 0
+        self._retry_notify = {}
+
+
+class _TestConnector(AsyncAtLeastOnceSourceConnector):
+    def __init__(self, port, count):
+        super(_TestConnector, self).__init__(
+            "v", "cookie", "program", "instance", "127.0.0.1", port)
+        self.events = []
+        self._count = count
+        self._next_id = 1
+
+    def __next__(self):
+        if not self._streams[1].is_open:
+            return None
+        if self._next_id > self._count:
+            raise StopIteration
+        msg = cwm.Message(1, self._next_id, 0, None, b'x' * self._next_id)
+        self._next_id += 1
+        return msg
+
+    def stream_opened(self, stream):
+        self.events.append(('opened', stream.point_of_ref))
+        # resume after the last message Wallaroo acked
+        self._next_id = stream.point_of_ref + 1
+
+    def stream_closed(self, stream):
+        self.events.append(('closed', stream.point_of_ref))
+
+    def stream_acked(self, stream):
+        self.events.append(('acked', stream.point_of_ref))
+
+
+def test_async_source_connector():
+    """
+    Run the connector against a fake Wallaroo worker that grants 2 credits
+    at a time, acks each message it receives, and restarts the connection
+    once along the way.
+    """
+    loop = asyncio.new_event_loop()
+    received = []
+    hellos = []
+
+    async def worker(reader, writer):
+        async def read():
+            header = await reader.readexactly(4)
+            return cwm.Frame.decode(await reader.readexactly(
+                cwm.Frame.read_header(header)))
+
+        def send(msg):
+            writer.write(cwm.Frame.encode(msg))
+
+        hellos.append(await read())
+        send(cwm.Ok(2))
+        try:
+            while True:
+                msg = await read()
+                if isinstance(msg, cwm.Notify):
+                    send(cwm.NotifyAck(True, msg.stream_id,
+                                       msg.point_of_ref))
+                    send(cwm.Ack(1, []))
+                elif isinstance(msg, cwm.Message):
+                    received.append(msg.message_id)
+                    send(cwm.Ack(1, [(msg.stream_id, msg.message_id)]))
+                    if msg.message_id == 3 and len(hellos) == 1:
+                        send(cwm.Restart())
+                        await writer.drain()
+                        writer.close()
+                        return
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(worker, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        client = _TestConnector(port, 6)
+        await client.connect()
+        client.notify(1, b"stream-1")
+        await asyncio.wait_for(client.run(), 10)
+        server.close()
+        await server.wait_closed()
+        return client
+
+    try:
+        client = loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+    assert(len(hellos) == 2)
+    assert(hellos[0] == cwm.Hello("v", "cookie", "program", "instance"))
+    # After the restart the stream is reopened at the last acked message and
+    # sending resumes from there. Messages sent while the restart was in
+    # flight may be sent again.
+    assert(received[:3] == [1, 2, 3])
+    assert(sorted(set(received)) == [1, 2, 3, 4, 5, 6])
+    assert(client.events.count(('opened', 3)) == 1)
+    assert(('closed', 3) in client.events)
+    assert(client.error is None)
@@ -0,0 +1,129 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Batching for sink connectors that write to stores with bulk APIs.
+
+`batches` is re-exported from `wallaroo.experimental`.
+"""
+
+import time
+
+
+def batches(connector, max_messages=500, max_latency=1.0, max_bytes=None,
+            size=None):
+    """
+    Yield lists of messages read from `connector`, a `SinkConnector`.
+
+    A batch is yielded as soon as it holds `max_messages` messages, or
+    `max_latency` seconds after its first message was read, whichever comes
+    first. If `max_bytes` is given, `size(message)` is called for every
+    message, and a batch is also yielded before the next message would take
+    it past `max_bytes`. A message larger than `max_bytes` is yielded on its
+    own.
+    """
+    if max_messages < 1:
+        raise ValueError("max_messages must be at least 1")
+    if max_bytes is not None and size is None:
+        raise ValueError("max_bytes requires a size function")
+    batch = []
+    batch_bytes = 0
+    deadline = None
+    while True:
+        timeout = None if deadline is None else deadline - time.time()
+        messages = connector.read_batch(max_messages - len(batch),
+                                        None if timeout is None
+                                        else max(timeout, 0))
+        for message in messages:
+            if max_bytes is not None:
+                message_bytes = size(message)
+                if batch and batch_bytes + message_bytes > max_bytes:
+                    yield batch
+                    batch = []
+                    batch_bytes = 0
+                batch_bytes += message_bytes
+            if not batch:
+                deadline = time.time() + max_latency
+            batch.append(message)
+        if batch and (len(batch) >= max_messages or
+                      time.time() >= deadline or
+                      (max_bytes is not None and batch_bytes >= max_bytes)):
+            yield batch
+            batch = []
+            batch_bytes = 0
+            deadline = None
+
+
+class _Closed(Exception):
+    pass
+
+
+class _FakeSink(object):
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.calls = []
+
+    def read_batch(self, max_messages=None, timeout=None):
+        self.calls.append((max_messages, timeout))
+        if not self.reads:
+            raise _Closed()
+        messages = self.reads.pop(0)
+        if not messages and timeout:
+            time.sleep(timeout)
+        return messages
+
+
+def _collect(sink, **kwargs):
+    out = []
+    try:
+        for batch in batches(sink, **kwargs):
+            out.append(batch)
+    except _Closed:
+        pass
+    return out
+
+
+def test_batches_max_messages():
+    sink = _FakeSink([[1, 2], [3], [4, 5, 6], [7]])
+    assert(_collect(sink, max_messages=3, max_latency=60) ==
+           [[1, 2, 3], [4, 5, 6]])
+    # Never asks for more messages than fit in the batch
+    assert([n for n, _ in sink.calls] == [3, 1, 3, 3, 2])
+    assert(sink.calls[0][1] is None and sink.calls[1][1] > 59)
+
+
+def test_batches_max_latency():
+    sink = _FakeSink([[1], [], [2, 3], []])
+    assert(_collect(sink, max_messages=10, max_latency=0.01) ==
+           [[1], [2, 3]])
+    # Blocks while there's no batch, then waits out the latency
+    assert(sink.calls[0] == (10, None))
+    assert(0 <= sink.calls[1][1] <= 0.01)
+
+
+def test_batches_max_bytes():
+    sink = _FakeSink([[b"aa", b"bbb", b"c", b"dddddd", b"ee"], []])
+    assert(_collect(sink, max_messages=10, max_latency=0.01, max_bytes=5,
+                    size=len) ==
+           [[b"aa", b"bbb"], [b"c"], [b"dddddd"], [b"ee"]])
+
+
+def test_batches_invalid():
+    for kwargs in ({"max_messages": 0}, {"max_bytes": 10}):
+        try:
+            next(batches(_FakeSink([]), **kwargs))
+        except ValueError:
+            pass
+        else:
+            assert(False)
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 import struct
 import itertools
 import logging
+import sys
 
 try:
     from StringIO import StringIO
@@ -9,54 +10,101 @@ except ImportError:
     from io import BytesIO as StringIO
 
 
+# Precompiled layouts of the fixed-size parts of frames. Decoders read them
+# in place with `unpack_from`, only slicing out variable-length fields. All
+# integers are big endian.
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+_U64 = struct.Struct('>Q')
+_FRAME_HEADER = struct.Struct('>IB')  # frame length, frame tag
+_NOTIFY_ACK = struct.Struct('>?QQ')
+_MESSAGE_HEADER = struct.Struct('>QQqH')  # stream, message id, time, key len
+# A whole Message frame: frame length, frame tag and the message header
+_MESSAGE_FRAME = struct.Struct('>IBQQqH')
+_MESSAGE_FRAME_TAG = 5
+_ACK_HEADER = struct.Struct('>II')
+_ACK_ITEM = struct.Struct('>QQ')
+
+
+def _pack_short_bytes(b):
+    return _U16.pack(len(b)) + b
+
+
+def _unpack_short_bytes(bs, offset):
+    """
+    Return the U16 length-prefixed field at `offset`, and the offset just
+    after it.
+    """
+    end = offset + 2 + _U16.unpack_from(bs, offset)[0]
+    return bs[offset + 2:end], end
+
+
+# How a MessageBatch is charged against the connector's credits. Hello
+# requests a mode and Ok replies with the one Wallaroo will use. Every other
+# frame always costs one credit.
+CREDITS_PER_FRAME = 0
+CREDITS_PER_MESSAGE = 1
+
+
+def _encode_credit_mode(credit_mode):
+    # The credit mode is an optional trailing byte, left off for the default
+    # so that peers which predate it see the same bytes as before.
+    if credit_mode == CREDITS_PER_FRAME:
+        return b''
+    return _U8.pack(credit_mode)
+
+
+def _decode_credit_mode(bs, offset):
+    if len(bs) > offset:
+        return _U8.unpack_from(bs, offset)[0]
+    return CREDITS_PER_FRAME
+
+
 class Hello(object):
     """
     Hello(version: String, cookie: String, program_name: String,
-          instance_name: String)
+          instance_name: String, credit_mode: U8)
     """
-    def __init__(self, version, cookie, program_name, instance_name):
+    def __init__(self, version, cookie, program_name, instance_name,
+                 credit_mode=CREDITS_PER_FRAME):
         self.version = version
         self.cookie = cookie
         self.program_name = program_name
         self.instance_name = instance_name
+        self.credit_mode = credit_mode
 
     def __str__(self):
         return ("Hello(version={!r}, cookie={!r}, program_name={!r}, "
-                "instance_name={!r})"
+                "instance_name={!r}, credit_mode={!r})"
                 .format(self.version, self.cookie, self.program_name,
-                        self.instance_name))
+                        self.instance_name, self.credit_mode))
 
     def __eq__(self, other):
         return (self.version == other.version and
                 self.cookie == other.cookie and
                 self.program_name == other.program_name and
-                self.instance_name == other.instance_name)
+                self.instance_name == other.instance_name and
+                self.credit_mode == other.credit_mode)
 
     def encode(self):
-        v, c, p, i = map(lambda x: x.encode(),
-                         (self.version,
-                          self.cookie,
-                          self.program_name,
-                          self.instance_name))
-        return struct.pack(">H{}sH{}sH{}sH{}s"
-                           .format(*map(len, (v, c, p, i))),
-                           len(v), v,
-                           len(c), c,
-                           len(p), p,
-                           len(i), i)
+        return b''.join(
+            [_pack_short_bytes(x.encode())
+             for x in (self.version, self.cookie, self.program_name,
+                       self.instance_name)] +
+            [_encode_credit_mode(self.credit_mode)])
 
     @staticmethod
     def decode(bs):
-        reader = StringIO(bs)
-        version_length = struct.unpack(">H", reader.read(2))[0]
-        version = reader.read(version_length).decode()
-        cookie_length = struct.unpack(">H", reader.read(2))[0]
-        cookie = reader.read(cookie_length).decode()
-        program_name_length = struct.unpack(">H", reader.read(2))[0]
-        program_name = reader.read(program_name_length).decode()
-        instance_name_length = struct.unpack(">H", reader.read(2))[0]
-        instance_name = reader.read(instance_name_length).decode()
-        return Hello(version, cookie, program_name, instance_name)
+        fields = []
+        offset = 0
+        for _ in range(4):
+            field, offset = _unpack_short_bytes(bs, offset)
+            fields.append(field.decode())
+        version, cookie, program_name, instance_name = fields
+        credit_mode = _decode_credit_mode(bs, offset)
+        return Hello(version, cookie, program_name, instance_name,
+                     credit_mode)
 
 
 def test_hello():
@@ -75,31 +123,39 @@ def test_hello():
     assert(decoded.instance_name == instance)
     assert(hello == decoded)
     assert(str(hello) == str(decoded))
+    assert(decoded.credit_mode == CREDITS_PER_FRAME)
+    hello = Hello(version, cookie, program, instance, CREDITS_PER_MESSAGE)
+    encoded = hello.encode()
+    assert(len(encoded) == 13)
+    assert(Hello.decode(encoded) == hello)
 
 
 class Ok(object):
     """
-    Ok(initial_credits: U32)
+    Ok(initial_credits: U32, credit_mode: U8)
 
    """
-    def __init__(self, initial_credits):
+    def __init__(self, initial_credits, credit_mode=CREDITS_PER_FRAME):
         self.initial_credits = initial_credits
+        self.credit_mode = credit_mode
 
     def __str__(self):
-        return ("Ok(initial_credits={!r})"
-                .format(self.initial_credits))
+        return ("Ok(initial_credits={!r}, credit_mode={!r})"
+                .format(self.initial_credits, self.credit_mode))
 
     def __eq__(self, other):
-        return (self.initial_credits == other.initial_credits)
+        return (self.initial_credits == other.initial_credits and
+                self.credit_mode == other.credit_mode)
 
     def encode(self):
-        return (struct.pack('>I', self.initial_credits))
+        return (_U32.pack(self.initial_credits) +
+                _encode_credit_mode(self.credit_mode))
 
     @staticmethod
     def decode(bs):
-        reader = StringIO(bs)
-        initial_credit = struct.unpack(">I", reader.read(4))[0]
-        return Ok(initial_credit)
+        initial_credit = _U32.unpack_from(bs, 0)[0]
+        credit_mode = _decode_credit_mode(bs, _U32.size)
+        return Ok(initial_credit, credit_mode)
 
 
 def test_ok():
@@ -113,6 +169,8 @@ def test_ok():
     assert(decoded.initial_credits == ic)
     assert(decoded == ok)
     assert(str(decoded) == str(ok))
+    ok = Ok(ic, CREDITS_PER_MESSAGE)
+    assert(Ok.decode(ok.encode()) == ok)
 
 
 class Error(object):
@@ -129,17 +187,12 @@ class Error(object):
         return self.message == other.message
 
     def encode(self):
-        encoded = self.message.encode()
-        return struct.pack(">H{}s".format(len(encoded)),
-                           len(encoded),
-                           encoded)
+        return _pack_short_bytes(self.message.encode())
 
     @staticmethod
     def decode(bs):
-        reader = StringIO(bs)
-        msg_length = struct.unpack(">H", reader.read(2))[0]
-        msg = reader.read(msg_length).decode()
-        return Error(msg)
+        msg, _ = _unpack_short_bytes(bs, 0)
+        return Error(msg.decode())
 
 
 def test_error():
@@ -174,19 +227,15 @@ class Notify(object):
                 self.point_of_ref == other.point_of_ref)
 
     def encode(self):
-        return struct.pack(">QH{}sQ".format(len(self.stream_name)),
-                           self.stream_id,
-                           len(self.stream_name),
-                           self.stream_name,
-                           self.point_of_ref)
+        return b''.join((_U64.pack(self.stream_id),
+                         _pack_short_bytes(self.stream_name),
+                         _U64.pack(self.point_of_ref)))
 
     @staticmethod
     def decode(bs):
-        reader = StringIO(bs)
-        stream_id = struct.unpack(">Q", reader.read(8))[0]
-        stream_name_length = struct.unpack(">H", reader.read(2))[0]
-        stream_name = reader.read(stream_name_length)
-        point_of_ref = struct.unpack(">Q", reader.read(8))[0]
+        stream_id = _U64.unpack_from(bs, 0)[0]
+        stream_name, offset = _unpack_short_bytes(bs, _U64.size)
+        point_of_ref = _U64.unpack_from(bs, offset)[0]
         return Notify(stream_id, stream_name, point_of_ref)
 
 
@@ -227,18 +276,13 @@ class NotifyAck(object):
                 self.point_of_ref == other.point_of_ref)
 
     def encode(self):
-        return struct.pack('>?QQ',
-                           self.notify_success,
-                           self.stream_id,
-                           self.point_of_ref)
+        return _NOTIFY_ACK.pack(self.notify_success,
+                                self.stream_id,
+                                self.point_of_ref)
 
     @staticmethod
     def decode(bs):
-        reader = StringIO(bs)
-        notify_success = struct.unpack(">?", reader.read(1))[0]
-        stream_id = struct.unpack(">Q", reader.read(8))[0]
-        point_of_ref = struct.unpack(">Q", reader.read(8))[0]
-        return NotifyAck(notify_success, stream_id, point_of_ref)
+        return NotifyAck(*_NOTIFY_ACK.unpack_from(bs, 0))
 
 
 def test_notify_ack():
@@ -262,7 +306,7 @@ class Message(object):
     """
     Message(stream_id: int, message_id: int,
             event_time: int, key: (bytes | None),
-            message: (bytes | None))
+            message: (bytes | memoryview | None))
     """
 
     def __init__(self, stream_id, message_id, event_time,
@@ -274,10 +318,11 @@ class Message(object):
             self.key = key
         else:
             raise TypeError("Parameter key must be either None or bytes")
-        if message is None or isinstance(message, bytes):
+        if message is None or isinstance(message, (bytes, memoryview)):
             self.message = message
         else:
-            raise TypeError("Parameter message must be either None or bytes")
+            raise TypeError("Parameter message must be either None, bytes "
+                            "or a memoryview")
 
     def __str__(self):
         return ("Message(stream_id={!r}, message_id={!r}, event_time"
@@ -296,31 +341,29 @@ class Message(object):
                 self.message == other.message)
 
     def encode(self):
-        sid = struct.pack('>Q', self.stream_id)
-        messageid = struct.pack('>Q', self.message_id)
-        event_time = struct.pack('>q', self.event_time)
-        if self.key is None:
-            k = b''
-        else:
-            k = self.key
-        key = struct.pack('>H{}s'.format(len(k)), len(k), k)
-        msg = self.message if self.message else b''
-        return b''.join((sid, messageid, event_time, key, msg))
+        k = self.key or b''
+        return (_MESSAGE_HEADER.pack(self.stream_id, self.message_id,
+                                     self.event_time, len(k)) +
+                k + (self.message or b''))
+
+    def encode_frame(self):
+        """
+        Encode this message as a complete frame. See `encode_message_frame`.
+        """
+        return encode_message_frame(self.stream_id, self.message_id,
+                                    self.event_time, self.key, self.message)
 
     @classmethod
     def decode(cls, bs):
-        reader = StringIO(bs)
-        stream_id = struct.unpack('>Q', reader.read(8))[0]
-        message_id = struct.unpack('>Q', reader.read(8))[0]
-        event_time = struct.unpack('>q', reader.read(8))[0]
-        key_length = struct.unpack('>H', reader.read(2))[0]
+        (stream_id, message_id, event_time,
+         key_length) = _MESSAGE_HEADER.unpack_from(bs, 0)
+        offset = _MESSAGE_HEADER.size
         if key_length > 0:
-            key = reader.read(key_length)
+            key = bs[offset:offset + key_length]
+            offset += key_length
         else:
             key = None
-        message = reader.read()
-        if message == b'':
-            message = None
+        message = bs[offset:] or None
         return cls(stream_id, message_id, event_time, key, message)
 
 
@@ -361,6 +404,11 @@ def test_message():
     assert(str(decoded) == str(msg))
     # Test that all messages frame encode/decode correctly
     _test_frame_encode_decode(msg)
+    if sys.version_info.major > 2:
+        # On Python 3 a message may be a view of a larger buffer
+        view = memoryview(b'>' + message)[1:]
+        assert(Message(stream_id, message_id, event_time, key,
+                       view).encode() == encoded)
 
     for stream_id in [0, 42, 9111222333444]:
         for message_id in [0, 52, 8111222333444]:
@@ -396,6 +444,148 @@ def test_message():
                         _test_frame_encode_decode(partial_msg)
 
 
+def encode_message_frame(stream_id, message_id, event_time, key, message):
+    """
+    Encode a complete Message frame, length header included, from the
+    message's fields. Message frames make up most of the traffic on a
+    connection, so this packs the frame header and the message header in one
+    go, and senders may call it without building a `Message` first.
+    """
+    k = key or b''
+    m = message or b''
+    return (_MESSAGE_FRAME.pack(_MESSAGE_HEADER.size + 1 + len(k) + len(m),
+                                _MESSAGE_FRAME_TAG, stream_id, message_id,
+                                event_time, len(k)) +
+            k + m)
+
+
+def encode_message_frames(stream_id, event_time, key, messages):
+    """
+    Encode `(message, message_id)` pairs that share a stream, event time and
+    key as consecutive Message frames.
+    """
+    k = key or b''
+    pack = _MESSAGE_FRAME.pack
+    size = _MESSAGE_HEADER.size + 1 + len(k)
+    if k:
+        return b''.join([pack(size + len(m), _MESSAGE_FRAME_TAG, stream_id,
+                              message_id, event_time, len(k)) + k + m
+                         for m, message_id in messages])
+    return b''.join([pack(size + len(m), _MESSAGE_FRAME_TAG, stream_id,
+                          message_id, event_time, 0) + m
+                     for m, message_id in messages])
+
+
+class MessageBatch(object):
+    """
+    MessageBatch(stream_id: int, messages: [Message])
+
+    Several messages of one stream in a single frame. The stream id is sent
+    once, and message ids as a base id followed by the difference between
+    each id and the one before it.
+    """
+    _HEADER = struct.Struct('>QQI')
+    _RECORD = struct.Struct('>IqH')
+    _LENGTH = struct.Struct('>I')
+
+    def __init__(self, stream_id, messages):
+        self.stream_id = stream_id
+        self.messages = list(messages)
+        for msg in self.messages:
+            if msg.stream_id != stream_id:
+                raise ValueError("Message {} does not belong to stream {}"
+                                 .format(msg, stream_id))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __str__(self):
+        return ("MessageBatch(stream_id={!r}, messages=[{}])".format(
+                    self.stream_id,
+                    ", ".join(str(m) for m in self.messages)))
+
+    def __eq__(self, other):
+        return (self.stream_id == other.stream_id and
+                self.messages == other.messages)
+
+    def encode(self):
+        base_id = self.messages[0].message_id if self.messages else 0
+        record = self._RECORD.pack
+        length = self._LENGTH.pack
+        parts = [self._HEADER.pack(self.stream_id, base_id,
+                                   len(self.messages))]
+        previous_id = base_id
+        for msg in self.messages:
+            delta = msg.message_id - previous_id
+            if not 0 <= delta <= 0xFFFFFFFF:
+                raise ValueError("Message ids in a batch must be increasing "
+                                 "by less than 2**32. Got {} after {}"
+                                 .format(msg.message_id, previous_id))
+            previous_id = msg.message_id
+            k = msg.key or b''
+            m = msg.message or b''
+            parts.append(record(delta, msg.event_time, len(k)))
+            parts.append(k)
+            parts.append(length(len(m)))
+            parts.append(m)
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, bs):
+        stream_id, message_id, count = cls._HEADER.unpack_from(bs, 0)
+        record = cls._RECORD.unpack_from
+        length = cls._LENGTH.unpack_from
+        offset = cls._HEADER.size
+        messages = []
+        for _ in range(count):
+            delta, event_time, key_length = record(bs, offset)
+            offset += cls._RECORD.size
+            key = bs[offset:offset + key_length] or None
+            offset += key_length
+            message_length = length(bs, offset)[0]
+            offset += cls._LENGTH.size
+            message = bs[offset:offset + message_length] or None
+            offset += message_length
+            message_id += delta
+            messages.append(Message(stream_id, message_id, event_time, key,
+                                    message))
+        return cls(stream_id, messages)
+
+
+def test_encode_message_frames():
+    pairs = [(b'first', 1), (b'second', 2)]
+    for key in (None, b'key'):
+        assert(encode_message_frames(7, 11, key, pairs) ==
+               b''.join(Frame.encode(Message(7, message_id, 11, key, m))
+                        for m, message_id in pairs))
+    assert(encode_message_frames(7, 11, None, []) == b'')
+
+
+def test_message_batch():
+    import pytest
+    stream_id = 42
+    msgs = [Message(stream_id, 1000, 5, b'key', b'first'),
+            Message(stream_id, 1001, 6, None, b'second'),
+            Message(stream_id, 1001 + 2**31, -7, b'k', None)]
+    batch = MessageBatch(stream_id, msgs)
+    encoded = batch.encode()
+    assert(len(encoded) == (8 + 8 + 4 +
+                            3 * (4 + 8 + 2 + 4) + 3 + 5 + 6 + 1))
+    # The per-message overhead is smaller than framing each Message.
+    assert(len(Frame.encode(batch)) <
+           sum(len(Frame.encode(m)) for m in msgs))
+    decoded = MessageBatch.decode(encoded)
+    assert(decoded == batch)
+    assert(str(decoded) == str(batch))
+    _test_frame_encode_decode(batch)
+    _test_frame_encode_decode(MessageBatch(stream_id, []))
+    with pytest.raises(ValueError):
+        MessageBatch(stream_id, [Message(stream_id + 1, 0, 0)])
+    with pytest.raises(ValueError):
+        MessageBatch(stream_id, [Message(stream_id, 2, 0),
+                                 Message(stream_id, 1, 0)]).encode()
+
+
 class EosMessage(object):
     """
     EosMessage(stream_id: int)
@@ -410,13 +600,11 @@ class EosMessage(object):
         return (self.stream_id == other.stream_id)
 
     def encode(self):
-        return struct.pack('>Q', self.stream_id)
+        return _U64.pack(self.stream_id)
 
     @classmethod
     def decode(cls, bs):
-        reader = StringIO(bs)
-        stream_id = struct.unpack('>Q', reader.read(8))[0]
-        return cls(stream_id)
+        return cls(_U64.unpack_from(bs, 0)[0])
 
 def test_eos_message():
     from itertools import chain, product
@@ -451,21 +639,16 @@ class Ack(object):
                 self.acks == other.acks)
 
     def encode(self):
-        return (struct.pack('>II', self.credits, len(self.acks)) +
-                b''.join((
-                    struct.pack('>QQ', sid, por)
-                    for sid, por in self.acks)))
+        return (_ACK_HEADER.pack(self.credits, len(self.acks)) +
+                b''.join([_ACK_ITEM.pack(sid, por)
+                          for sid, por in self.acks]))
 
     @staticmethod
     def decode(bs):
-        reader = StringIO(bs)
-        credits = struct.unpack(">I", reader.read(4))[0]
-        acks_length = struct.unpack(">I", reader.read(4))[0]
-        acks = []
-        for _ in range(acks_length):
-            stream_id = struct.unpack(">Q", reader.read(8))[0]
-            point_of_ref = struct.unpack(">Q", reader.read(8))[0]
-            acks.append((stream_id, point_of_ref))
+        credits, acks_length = _ACK_HEADER.unpack_from(bs, 0)
+        acks = [_ACK_ITEM.unpack_from(bs, _ACK_HEADER.size +
+                                      i * _ACK_ITEM.size)
+                for i in range(acks_length)]
         return Ack(credits, acks)
 
 
@@ -500,20 +683,17 @@ class Restart(object):
     def encode(self):
         if self.address is not None:
             b_addr = self.address.encode()
-            return struct.pack('>I{}s'.format(len(b_addr)),
-                               len(b_addr),
-                               b_addr)
+            return _U32.pack(len(b_addr)) + b_addr
         else:
-            return struct.pack('>I', 0)
+            return _U32.pack(0)
 
     @staticmethod
     def decode(bs):
         addr = None
         if len(bs) > 0:
-            reader = StringIO(bs)
-            a_length = struct.unpack('>I', reader.read(4))[0]
+            a_length = _U32.unpack_from(bs, 0)[0]
             if a_length > 0:
-                addr = reader.read(a_length).decode()
+                addr = bs[4:4 + a_length].decode()
         return Restart(addr)
 
 
@@ -537,24 +717,27 @@ class Frame(object):
                           (5, Message),
                           (6, Ack),
                           (7, Restart),
-                          (8, EosMessage)]
+                          (8, EosMessage),
+                          (10, MessageBatch)]
     _FRAME_TYPE_MAP = dict([(v, t) for v, t in _FRAME_TYPE_TUPLES] +
                            [(t, v) for v, t in _FRAME_TYPE_TUPLES])
 
     @classmethod
     def encode(cls, msg):
         frame_tag = cls._FRAME_TYPE_MAP[type(msg)]
+        if frame_tag == _MESSAGE_FRAME_TAG:
+            return msg.encode_frame()
         data = msg.encode()
-        return struct.pack('>IB', len(data)+1, frame_tag) + data
+        return _FRAME_HEADER.pack(len(data) + 1, frame_tag) + data
 
     @classmethod
     def decode(cls, bs): # bs does not include frame length header
-        frame_tag = struct.unpack('>B', bs[0:1])[0]
+        frame_tag = _U8.unpack_from(bs, 0)[0]
         return cls._FRAME_TYPE_MAP[frame_tag].decode(bs[1:])
 
     @staticmethod
     def read_header(bs):
-        return struct.unpack('>I', bs[:4])[0]
+        return _U32.unpack_from(bs, 0)[0]
 
 
 def _test_frame_encode_decode(msg):
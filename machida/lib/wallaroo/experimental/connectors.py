@@ -1,9 +1,19 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
 import hashlib
 import logging
 import math
-from struct import unpack
+import mmap
+import os
+from struct import Struct, unpack
 import sys
+import threading
 import time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 
 from . import (connector_wire_messages as cwm,
@@ -171,9 +181,252 @@ class FramedFileReader(BaseIter, BaseSource):
         except:
             pass
 
+try:
+    array('Q')
+    _OFFSET_TYPECODE = 'Q'
+except ValueError:
+    # Python 2 has no 'Q' arrays, but 'L' is 64 bits wide on LP64 platforms
+    _OFFSET_TYPECODE = 'L'
+
+_FRAME_HEADER = Struct('>I')
+
+
+class MmapFramedFileReader(BaseIter, BaseSource):
+    """
+    A framed file reader like `FramedFileReader` that maps the file into
+    memory instead of reading it.
+
+    Usage: `MmapFramedFileReader(filename)`.
+    The end offsets of frames are indexed as they are first needed, `chunk`
+    frames at a time, so `reset` finds the frame to resume from with a binary
+    search. On Python 3 messages are `memoryview` slices of the mapping, which
+    stay valid until the reader is garbage collected; on Python 2 they are
+    `bytes` copies.
+    """
+    def __init__(self, filename, chunk=65536):
+        self.file = open(filename, mode='rb')
+        self.name = filename.encode()
+        self.key = filename.encode()
+        self._chunk = chunk
+        self._size = os.fstat(self.file.fileno()).st_size
+        if self._size:
+            self._map = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped
+            self._map = b''
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            self._view = self._map
+        self._ends = array(_OFFSET_TYPECODE)  # end offset of each frame
+        self._indexed_to = 0  # offset of the first frame not indexed
+        self._next = 0  # index of the next frame to read
+        self._pos = 0  # offset of the next frame to read
+
+    def __str__(self):
+        return ("MmapFramedFileReader(filename: {}, closed: {}, "
+                "point_of_ref: {})".format(self.name, self.file.closed,
+                                           self.point_of_ref()))
+
+    def point_of_ref(self):
+        return self._pos
+
+    def reset(self, pos=0):
+        """
+        Resume after the frame that ends at `pos`. If `pos` isn't the end of
+        a frame, resume from the frame it falls in.
+        """
+        if pos == 18446744073709551615:
+            pos = 0
+        while self._indexed_to < pos and self._index_frames():
+            pass
+        i = bisect_left(self._ends, pos)
+        if i < len(self._ends) and self._ends[i] == pos:
+            i += 1
+        logging.debug("resetting {} from {} to frame {}".format(
+            self.__str__(), self.point_of_ref(), i))
+        self._next = i
+        self._pos = self._ends[i - 1] if i else 0
+
+    def __next__(self):
+        i = self._next
+        try:
+            end = self._ends[i]
+        except IndexError:
+            if not self._index_frames():
+                raise StopIteration
+            end = self._ends[i]
+        start = self._pos + 4
+        self._next = i + 1
+        self._pos = end
+        return (self._view[start:end], end)
+
+    def _index_frames(self):
+        """
+        Index up to `chunk` more frames. Return False at the end of the file,
+        or of its last complete frame.
+        """
+        mm = self._map
+        size = self._size
+        offset = self._indexed_to
+        unpack_from = _FRAME_HEADER.unpack_from
+        ends = []
+        append = ends.append
+        # the last offset a frame header fits at
+        last = size - 4
+        remaining = self._chunk
+        while remaining and offset <= last:
+            end = offset + 4 + unpack_from(mm, offset)[0]
+            if end > size:
+                break
+            append(end)
+            offset = end
+            remaining -= 1
+        self._ends.extend(ends)
+        self._indexed_to = offset
+        return bool(ends)
+
+    def wallaroo_acked(self, point_of_ref):
+        None
+
+    def close(self):
+        self._view = None
+        try:
+            if self._size:
+                self._map.close()
+        except BufferError:
+            # Messages that are still referenced keep the mapping open; it is
+            # unmapped when they are garbage collected.
+            pass
+        self.file.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            pass
+
+
+# time.monotonic is Python 3 only
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter: `rate` tokens are added per second, and up
+    to `burst` of them are saved up while they aren't used. `burst` defaults
+    to a tenth of a second's worth of tokens, or 1.
+
+    A message may be sent whenever the bucket isn't in debt, and is then
+    charged for in full, even if that takes the bucket into debt. This way, neither a
+    message's size nor the size of the biggest message needs to be known in
+    advance, and the rate still holds over time.
+
+    If `count_bytes` is true, each message costs its length in tokens,
+    otherwise it costs 1. Share one bucket between several `RateLimitedSource`
+    instances to limit their aggregate rate.
+    """
+    def __init__(self, rate, burst=None, count_bytes=False, clock=_clock):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None
+                           else max(self.rate / 10, 1))
+        self.count_bytes = count_bytes
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """
+        Return the number of seconds until a message may be sent, or 0 if it
+        may be sent now.
+        """
+        self._refill()
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    def charge(self, value):
+        self._tokens -= len(value) if self.count_bytes else 1
+
+    def wait(self):
+        """
+        Sleep until a message may be sent.
+        """
+        delay = self.delay()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.delay()
+
+
+class RateLimitedSource(BaseIter, BaseSource):
+    """
+    Limit the rate at which messages are taken from `source`, any
+    `BaseSource`.
+
+    `records_per_sec` and `bytes_per_sec` limit this source on its own, and
+    each of the `shared` `TokenBucket`s limits it together with the other
+    sources that share that bucket.
+
+    While any limit is reached, `__next__` returns `(None, point_of_ref)`
+    instead of blocking, and `ready_in()` returns the number of seconds until
+    the source may send again. `MultiSourceConnector` sleeps for that long
+    once all of its sources are limited, rather than polling them.
+    """
+    def __init__(self, source, records_per_sec=None, bytes_per_sec=None,
+                 shared=()):
+        self.source = source
+        self.name = source.name
+        self.key = source.key
+        self.buckets = list(shared)
+        if records_per_sec is not None:
+            self.buckets.append(TokenBucket(records_per_sec))
+        if bytes_per_sec is not None:
+            self.buckets.append(TokenBucket(bytes_per_sec, count_bytes=True))
+
+    def __str__(self):
+        return "RateLimitedSource({})".format(self.source)
+
+    def ready_in(self):
+        delay = 0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.delay())
+        return delay
+
+    def __next__(self):
+        for bucket in self.buckets:
+            if bucket.delay():
+                return (None, self.source.point_of_ref())
+        value, point_of_ref = next(self.source)
+        if value is not None:
+            for bucket in self.buckets:
+                bucket.charge(value)
+        return (value, point_of_ref)
+
+    def point_of_ref(self):
+        return self.source.point_of_ref()
+
+    def reset(self, pos=0):
+        self.source.reset(pos)
+
+    def wallaroo_acked(self, point_of_ref):
+        self.source.wallaroo_acked(point_of_ref)
+
+    def close(self):
+        self.source.close()
+
+
 class ThrottledFileReader(BaseIter, BaseSource):
     """
-    An throttled ile reader iterator with a resettable position, capable
+    An throttled file reader iterator with a resettable position, capable
     of reading files with records delimited by:
       * length-framed data
       * ASCII data separated by newlines
@@ -182,21 +435,19 @@ class ThrottledFileReader(BaseIter, BaseSource):
     """
     def __init__(self, filename,
                  limit_rate=999999999, is_framed=False, is_text_lines=False):
-        self.file = open(filename, mode='r')
+        self.file = open(filename, mode='rb')
         self.name = filename.encode()
         self.key = filename.encode()
         self.limit_rate = limit_rate
         self.is_framed = is_framed
         self.is_text_lines = is_text_lines
         self.last_acked = None
-        self.count = 0
-        self.time_1st_iter = None
-        self.bytes_read = 0
-        self.buf = ""
+        self._bucket = TokenBucket(limit_rate, count_bytes=True)
 
     def __str__(self):
-        return ("FramedFileReader(filename: {}, closed: {}, point_of_ref: {})"
-                .format(self.name, self.file.closed, self.point_of_ref()))
+        return ("ThrottledFileReader(filename: {}, closed: {}, "
+                "point_of_ref: {})".format(self.name, self.file.closed,
+                                           self.point_of_ref()))
 
     def point_of_ref(self):
         try:
@@ -214,18 +465,13 @@ class ThrottledFileReader(BaseIter, BaseSource):
                     .format(self.__str__(), self.point_of_ref(), pos))
         self.file.seek(pos)
 
-    def __next__(self):
-        self.count = self.count + 1
-        now = time.time()
-
-        if self.count == 1:
-            self.time_1st_iter = now
+    def ready_in(self):
+        return self._bucket.delay()
 
-        read_rate = self.bytes_read / max(0.000001, now - self.time_1st_iter)
-        if read_rate > self.limit_rate:
-            # We need to "yield" by returning None occasionaly in order to
-            # permit MultiSourceConnector to perform it's sleep & re-try
-            # goop for this iterator.
+    def __next__(self):
+        if self._bucket.delay():
+            # MultiSourceConnector uses ready_in() to sleep until we may
+            # send again
             return (None, self.file.tell())
 
         read_offset = self.file.tell()
@@ -241,17 +487,7 @@ class ThrottledFileReader(BaseIter, BaseSource):
         if not b:
             raise StopIteration
 
-        ## Roughly every minute, reset our basis for calculating the
-        ## sending rate. Otherwise the amount of elapsed time can
-        ## get big enough to make an issue out of floating point
-        ## rounding error?  In the event that single framed messages
-        ## or ASCII lines are bigger than this factor, then our
-        ## throttle's effectiveness will be hurt.
-        if self.bytes_read > (self.limit_rate * 60):
-            self.bytes_read = 0
-            self.time_1st_iter = now - 0.001
-
-        self.bytes_read += len(b)
+        self._bucket.charge(b)
         ##logging.debug("__next__ b = {}".format(b))
         return (b, read_offset)
 
@@ -267,6 +503,141 @@ class ThrottledFileReader(BaseIter, BaseSource):
         except:
             pass
 
+class _PrefetchPool(object):
+    """
+    Daemon threads that read ahead from `_PrefetchedSource`s on request.
+    """
+    def __init__(self, threads):
+        self._requests = Queue()
+        for _ in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def request(self, source):
+        self._requests.put(source)
+
+    def _run(self):
+        while True:
+            self._requests.get()._prefetch()
+
+
+class _PrefetchedSource(BaseIter, BaseSource):
+    """
+    Wraps a source for `MultiSourceConnector` so that it is read ahead by a
+    `_PrefetchPool`. Messages are handed out from a buffer of up to `depth`
+    of them, which is refilled once it drops below half of that. If the
+    buffer was found empty, `on_ready` is called from the pool's thread as
+    soon as it has messages again.
+    """
+    def __init__(self, source, pool, depth, on_ready=None):
+        self.source = source
+        self.name = source.name
+        self.key = source.key
+        self._pool = pool
+        self._depth = depth
+        self._on_ready = on_ready
+        # Held while the source is called. Acquired before _buffer_lock when
+        # both are needed.
+        self._source_lock = threading.Lock()
+        self._buffer_lock = threading.Lock()
+        self._buffer = deque()  # (value, point_of_ref) pairs
+        self._error = None  # raised by the source, e.g. StopIteration
+        self._requested = False
+        self._waiting = False  # whether __next__ found the buffer empty
+        # Bumped by reset, so that reads from before it are discarded
+        self._generation = 0
+        self._point_of_ref = source.point_of_ref()
+
+    def __str__(self):
+        return "_PrefetchedSource({})".format(self.source)
+
+    def point_of_ref(self):
+        """
+        The point of reference of the last message handed out, not of the
+        last one read.
+        """
+        return self._point_of_ref
+
+    def __next__(self):
+        value = None
+        with self._buffer_lock:
+            buffer = self._buffer
+            if buffer:
+                value, self._point_of_ref = buffer.popleft()
+            elif self._error is not None:
+                raise self._error
+            else:
+                self._waiting = True
+            request = (len(buffer) < self._depth // 2 and
+                       not self._requested)
+            if request:
+                self._requested = True
+        if request:
+            self._pool.request(self)
+        return (value, self._point_of_ref)
+
+    def _prefetch(self):
+        values = []
+        error = None
+        with self._source_lock:
+            generation = self._generation
+            wanted = self._depth - len(self._buffer)
+            try:
+                while len(values) < wanted:
+                    value = next(self.source)
+                    if value[0] is None:
+                        break
+                    values.append(value)
+            except Exception as err:
+                error = err
+        with self._buffer_lock:
+            self._requested = False
+            if generation == self._generation:
+                self._buffer.extend(values)
+                if error is not None:
+                    self._error = error
+            wake = self._waiting and (self._buffer or
+                                      self._error is not None)
+            if wake:
+                self._waiting = False
+        if wake and self._on_ready is not None:
+            self._on_ready()
+
+    def ready_in(self):
+        """
+        0 if there are messages to hand out, otherwise the wrapped source's
+        `ready_in()` if it has one. The wrapped source isn't asked while it
+        is being read from, since a message may be on its way.
+        """
+        if self._buffer or self._error is not None:
+            return 0
+        ready_in = getattr(self.source, 'ready_in', None)
+        if ready_in is None or not self._source_lock.acquire(False):
+            return 0
+        try:
+            return ready_in()
+        finally:
+            self._source_lock.release()
+
+    def reset(self, pos=0):
+        with self._source_lock:
+            with self._buffer_lock:
+                self._generation += 1
+                self._buffer.clear()
+                self._error = None
+            self.source.reset(pos)
+            self._point_of_ref = self.source.point_of_ref()
+
+    def wallaroo_acked(self, point_of_ref):
+        with self._source_lock:
+            self.source.wallaroo_acked(point_of_ref)
+
+    def close(self):
+        with self._source_lock:
+            self.source.close()
+
+
 class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
     """
     MultiSourceConnector
@@ -275,6 +646,22 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
     AtLeastOnceSourceConnector protocol and superclass.
     New sources may be added at any point.
 
+    Only sources whose streams are open are polled. Each one's turn is
+    `weight` messages long when sending one message per `__next__` call,
+    and `weight * burst` messages long when filling the output buffer
+    directly, where `weight` and `burst` (`_BURST` by default) are given to
+    `add_source`.
+
+    With `prefetch` set to a number of threads, sources are read ahead, up
+    to `prefetch_depth` messages each, on that many background threads, and
+    the connector only takes the messages that were read. This keeps slow
+    sources from holding up the others. A stream whose source has nothing
+    read ahead is set aside until the background thread has read more, and
+    the connector waits for that rather than polling it. Prefetched sources are called from
+    both the background threads and the connector's thread, one at a time,
+    so sources that share state with each other (such as the
+    `KafkaPartitionSource`s of one `KafkaFetcher`) should not be prefetched.
+
     An iterator interface is used to read and send the next datum to the
     Wallaroo source, for use with an external loop, such as
     ```
@@ -299,8 +686,17 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
     print("Reached the end of all files. Shutting down.")
     ```
     """
+    # Messages taken from one source at a time when filling the output buffer
+    _BURST = 64
+    # Longest that _fill waits for sources to have messages, so that acks
+    # are still handled promptly
+    _MAX_IDLE_SLEEP = 0.05
+    # How often sources that return nothing, but don't say when they will
+    # have more, are polled
+    _IDLE_POLL = 0.001
+
     def __init__(self, version, cookie, program_name, instance_name, host,
-                 port, delay=0):
+                 port, delay=0, prefetch=0, prefetch_depth=None):
         AtLeastOnceSourceConnector.__init__(self,
                                             version,
                                             cookie,
@@ -312,14 +708,27 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         self.sources = {} # stream_id: [source instance, acked point of ref]
         self.closed_sources = {} # stream_id: acked point of ref
         self.keys = []
-        self._idx = -1
+        # Open streams, in the order they take turns in. The stream at the
+        # front is the one whose turn it is. With prefetch, streams with
+        # nothing read ahead are moved to _parked instead, and are queued in
+        # _woken by the prefetch threads once they have messages again.
+        self._ready = deque()
+        self._parked = set()
+        self._woken = deque()
+        self._wakeup = threading.Event()
+        self._next_sweep = 0  # when parked streams are polled again
+        self._turn = 0  # messages left in the current __next__ turn
+        self._weights = {}  # {stream_id: messages per __next__ turn}
+        self._quanta = {}  # {stream_id: messages per _fill turn}
+        self._prefetch_pool = _PrefetchPool(prefetch) if prefetch else None
+        self._prefetch_depth = prefetch_depth or 2 * self._BURST
         self.joining = set()
         self.open = set()
         self.pending_eos_ack = {}  # {stream_id: point_of_ref}
         self.closed = set()
         self._added_source = False
 
-    def add_source(self, source):
+    def add_source(self, source, weight=1, burst=None):
         self._added_source = True
         # add to self.sources
         _id = self.get_id(source.name)
@@ -327,6 +736,15 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         if _id in self.sources:
             raise ConnectorError("Cannot add Source {}. A source exists"
                 " with that ID: {}".format(source, self.sources[_id]))
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        self._weights[_id] = max(1, int(round(weight)))
+        self._quanta[_id] = max(1, int(round(weight *
+                                             (burst or self._BURST))))
+        if self._prefetch_pool is not None:
+            source = _PrefetchedSource(source, self._prefetch_pool,
+                                       self._prefetch_depth,
+                                       lambda: self._stream_ready(_id))
         self.sources[_id] = [source, source.point_of_ref()]
         self.keys.append(_id)
         # add to joining set so we can control the starting sequence
@@ -343,9 +761,10 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         if _id in self.sources:
             # Remove it from the open set
             if _id in self.open:
-                self.open.remove(_id)
-                # Add it to the set of sources pending closing
-                point_of_ref = source.point_of_ref()
+                self._close_stream(_id)
+                # Add it to the set of sources pending closing. The source
+                # we were given may have been prefetched from further.
+                point_of_ref = self.sources[_id][0].point_of_ref()
                 self.pending_eos_ack[_id] = point_of_ref
                 # send end of stream/EOS message
                 self.end_of_stream(stream_id = _id) # aka EosMessage
@@ -363,12 +782,8 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
             # close and remove the source
             _, acked = self.sources.pop(key, (None, None))
             try:
-                idx = self.keys.index(key) # value error
-                self.keys.pop(idx) # index error
-                if self._idx >= idx:
-                    # to avoid skipping in the round-robin sender
-                    self._idx -= 1
-            except (ValueError, IndexError):
+                self.keys.remove(key) # value error
+            except ValueError:
                 # print warning
                 logging.warning("Tried to delete source {} with key {} but "
                   "could not find it in keys collection: {}"
@@ -388,22 +803,83 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         h.update(bs)
         return int(h.hexdigest()[:16], 16)
 
+    def _open_stream(self, stream_id):
+        if stream_id not in self.open:
+            self.open.add(stream_id)
+            self._ready.append(stream_id)
+
+    def _close_stream(self, stream_id):
+        self.open.remove(stream_id)
+        if stream_id in self._parked:
+            self._parked.remove(stream_id)
+        else:
+            self._ready.remove(stream_id)
+        self._turn = 0
+
+    def _park_stream(self):
+        """
+        Set aside the stream at the front of the ready queue, whose
+        prefetched source has nothing to send.
+        """
+        self._parked.add(self._ready.popleft())
+        self._turn = 0
+
+    def _stream_ready(self, stream_id):
+        """
+        Called from a prefetch thread once a parked stream's source has
+        messages again.
+        """
+        self._woken.append(stream_id)
+        self._wakeup.set()
+
+    def _wake_streams(self):
+        """
+        Move parked streams back to the ready queue once their sources have
+        messages again. Streams whose sources are neither woken nor rate
+        limited are also moved back every `_MAX_IDLE_SLEEP` seconds, so that
+        they are read ahead again, as are rate limited ones once their limit
+        lets them send.
+        """
+        parked = self._parked
+        ready = self._ready
+        woken = self._woken
+        while woken:
+            stream_id = woken.popleft()
+            if stream_id in parked:
+                parked.remove(stream_id)
+                ready.append(stream_id)
+        if parked and time.time() >= self._next_sweep:
+            delay = self._MAX_IDLE_SLEEP
+            for stream_id in list(parked):
+                source_delay = self.sources[stream_id][0].ready_in()
+                if source_delay <= 0:
+                    parked.remove(stream_id)
+                    ready.append(stream_id)
+                elif source_delay < delay:
+                    delay = source_delay
+            self._next_sweep = time.time() + delay
+
     # Make this class an iterable:
     def __next__(self):
-        if len(self.keys) > 0:
-            # get next position
-            self._idx = (self._idx + 1) % len(self.keys)
-            # get key of that position
-            key = self.keys[self._idx]
-            # if stream is not in an open state, return nothing.
-            if not key in self.open:
-                return None
+        if self._parked:
+            self._wake_streams()
+        ready = self._ready
+        if ready:
+            if self._turn <= 0:
+                # next stream's turn
+                ready.rotate(-1)
+                self._turn = self._weights[ready[0]]
+            key = ready[0]
+            self._turn -= 1
             try:
                 # get source at key
                 source = self.sources[key][0]
                 # get value from source
                 value, point_of_ref = next(source)
                 if value is None:
+                    if self._prefetch_pool is not None:
+                        self._park_stream()
+                    self._turn = 0
                     return None
                 # send it as a message
                 msg = cwm.Message(
@@ -419,10 +895,9 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
                 if source:
                     self.remove_source(source)
                 return None
-            except IndexError:
-                # Index might have overflowed due to manual remove_source
-                # will be corrected in the next iteration
-                return None
+        elif self.keys:
+            # No streams are open yet, or none has anything to send
+            return None
         elif not self._added_source:
             # In very fast select loops, we might reach the end condition
             # before we have a chance to add our first source, so keep
@@ -438,6 +913,86 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
             logging.debug("keys: {}, joining: {}, open: {}, pending_eos_ack: {}, closed: {}, _added_source: {}".format(self.keys, self.joining, self.open, self.pending_eos_ack, self.closed, self._added_source))
             raise StopIteration
 
+    def _fill(self):
+        """
+        Encode messages straight into the output buffer, bypassing
+        `__next__` and `write`. Each open source in turn gives up to its
+        weighted burst of messages, as long as there are credits for them.
+        Once none of them has anything to send, it waits for one that may.
+        """
+        out = self._out
+        high_water = self._high_water
+        encode = cwm.encode_message_frames
+        ready = self._ready
+        quanta = self._quanta
+        prefetched = self._prefetch_pool is not None
+        if self._parked:
+            self._wake_streams()
+        idle = 0  # sources in a row that had nothing to send
+        while self.credits > 0:
+            if out.size >= high_water:
+                return True
+            if not ready:
+                if self._parked:
+                    self._wait_for_prefetch()
+                elif not self.keys:
+                    # __next__ raises StopIteration once all sources are done
+                    self.__next__()
+                return False
+            if idle >= len(ready):
+                self._sleep_until_ready()
+                return False
+            ready.rotate(-1)
+            key = ready[0]
+            source = self.sources[key][0]
+            # (value, point_of_ref) pairs
+            values = []
+            exhausted = False
+            try:
+                for _ in range(min(self.credits, quanta[key])):
+                    value = next(source)
+                    if value[0] is None:
+                        break
+                    values.append(value)
+            except StopIteration:
+                exhausted = True
+            if values:
+                out.append(encode(key, 0, source.key, values))
+                self.credits -= len(values)
+                idle = 0
+            elif prefetched and not exhausted:
+                self._park_stream()
+            else:
+                idle += 1
+            if exhausted:
+                self.remove_source(source)
+        return False
+
+    def _sleep_until_ready(self):
+        """
+        Once no open source had anything to send, sleep until the first of
+        them may, instead of polling them until then. Sources that have a
+        `ready_in()` method are rate limited when it returns more than 0;
+        others are polled again after `_IDLE_POLL` seconds.
+        """
+        delay = self._MAX_IDLE_SLEEP
+        for key in self.open:
+            ready_in = getattr(self.sources[key][0], 'ready_in', None)
+            source_delay = ready_in() if ready_in is not None else 0
+            if source_delay <= 0:
+                source_delay = self._IDLE_POLL
+            delay = min(delay, source_delay)
+        time.sleep(delay)
+
+    def _wait_for_prefetch(self):
+        """
+        Once every open stream is parked, wait until a prefetch thread wakes
+        one of them, or until they are due to be polled again.
+        """
+        self._wakeup.wait(max(0, self._next_sweep - time.time()))
+        self._wakeup.clear()
+        self._wake_streams()
+
     def stream_added(self, stream):
         logging.debug("MultiSourceConnector added {}".format(stream))
         source, acked = self.sources.get(stream.id, (None, None))
@@ -462,7 +1017,7 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
                 self.joining.remove(stream.id)
                 if stream.point_of_ref != source.point_of_ref():
                     source.reset(stream.point_of_ref)
-            self.open.add(stream.id)
+            self._open_stream(stream.id)
         else:
             raise ConnectorError("Stream {} was opened for unknown source. "
                                  "Please use the add_source interface."
@@ -474,7 +1029,7 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
         if source:
             if stream.id in self.open:
                 # source was open so move it back to joining state
-                self.open.remove(stream.id)
+                self._close_stream(stream.id)
                 self.joining.add(stream.id)
             elif stream.id in self.pending_eos_ack:
                 # source was pending eos ack, but that was interrupted
@@ -532,3 +1087,348 @@ class MultiSourceConnector(AtLeastOnceSourceConnector, BaseIter):
                                  "Please use the add_source interface."
                                  .format(stream))
 
+
+
+class _FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class _ListSource(BaseIter, BaseSource):
+    def __init__(self, values, name=b"list"):
+        self.name = name
+        self.key = None
+        self.values = values
+        self.pos = 0
+
+    def __str__(self):
+        return "_ListSource({})".format(len(self.values))
+
+    def point_of_ref(self):
+        return self.pos
+
+    def reset(self, pos=0):
+        self.pos = pos
+
+    def __next__(self):
+        if self.pos == len(self.values):
+            raise StopIteration
+        self.pos += 1
+        return (self.values[self.pos - 1], self.pos)
+
+    def wallaroo_acked(self, point_of_ref):
+        pass
+
+
+def test_token_bucket():
+    clock = _FakeClock()
+    bucket = TokenBucket(10, burst=2, clock=clock)
+    for _ in range(3):
+        assert(bucket.delay() == 0)
+        bucket.charge(b"x")
+    assert(abs(bucket.delay() - 0.1) < 1e-3)
+    clock.now += 0.1
+    assert(bucket.delay() == 0)
+    # Tokens saved up while idle are capped at the burst size
+    clock.now += 10
+    bucket.delay()
+    assert(bucket._tokens == 2)
+
+
+def test_token_bucket_bytes():
+    clock = _FakeClock()
+    bucket = TokenBucket(100, burst=10, count_bytes=True, clock=clock)
+    # A message bigger than the burst can still be sent, into debt
+    bucket.charge(b"x" * 60)
+    assert(abs(bucket.delay() - 0.5) < 1e-3)
+    clock.now += 0.25
+    assert(abs(bucket.delay() - 0.25) < 1e-3)
+    clock.now += 0.25
+    assert(bucket.delay() == 0)
+
+
+def test_rate_limited_source():
+    clock = _FakeClock()
+    shared = TokenBucket(5, burst=2, clock=clock)
+    a = RateLimitedSource(_ListSource([b"a1", b"a2", b"a3"]), shared=[shared])
+    b = RateLimitedSource(_ListSource([b"b1", b"b2"]), shared=[shared])
+    assert(next(a) == (b"a1", 1))
+    assert(next(b) == (b"b1", 1))
+    assert(next(a) == (b"a2", 2))
+    # The aggregate limit applies to both sources
+    assert(next(b) == (None, 1))
+    assert(abs(a.ready_in() - 0.2) < 1e-3 and b.ready_in() == a.ready_in())
+    clock.now += 0.2
+    assert(next(b) == (b"b2", 2))
+    a.reset(0)
+    assert(a.point_of_ref() == 0)
+
+
+def test_throttled_file_reader_reads_bytes():
+    import os
+    import struct
+    import tempfile
+    fd, filename = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack('>I', 3) + b'\xff\x00a')
+        reader = ThrottledFileReader(filename, is_framed=True)
+        assert(next(reader) == (b'\xff\x00a', 0))
+        reader.close()
+    finally:
+        os.remove(filename)
+
+
+class _UnreadSource(_ListSource):
+    def __next__(self):
+        raise AssertionError("a stream that isn't open was read from")
+
+
+def _connector(**kwargs):
+    client = MultiSourceConnector("0.0.1", "cookie", "test", "instance",
+                                  "127.0.0.1", 0, **kwargs)
+    # Frames are only queued, never sent, without a connection
+    client._conn = None
+    return client
+
+
+def _open(client, source, **kwargs):
+    client.add_source(source, **kwargs)
+    stream_id = client.get_id(source.name)
+    client._handle_notify_ack(cwm.NotifyAck(True, stream_id, 0))
+    return stream_id
+
+
+def _sent_messages(client):
+    data = b"".join(bytes(chunk) for chunk in client._out._chunks)
+    client._out.clear()
+    messages = []
+    while data:
+        size = unpack('>I', data[:4])[0]
+        msg = cwm.Frame.decode(data[4:4 + size])
+        if isinstance(msg, cwm.Message):
+            messages.append(msg.message)
+        data = data[4 + size:]
+    return messages
+
+
+def test_weighted_fill():
+    client = _connector()
+    _open(client, _ListSource([b"a"] * 20, b"a"), burst=2)
+    _open(client, _ListSource([b"b"] * 20, b"b"), burst=2, weight=3)
+    # Streams that aren't open aren't polled
+    for i in range(100):
+        client.add_source(_UnreadSource([], "joining {}".format(i).encode()))
+    client.credits = 16
+    client._fill()
+    assert(b"".join(_sent_messages(client)) == b"bbbbbbaabbbbbbaa")
+
+
+def test_weighted_next():
+    client = _connector()
+    _open(client, _ListSource([b"a"] * 20, b"a"))
+    _open(client, _ListSource([b"b"] * 20, b"b"), weight=2)
+    client.add_source(_UnreadSource([], b"joining"))
+    assert([next(client).message for _ in range(6)] ==
+           [b"b", b"b", b"a", b"b", b"b", b"a"])
+
+
+def test_prefetch():
+    values = [str(i).encode() for i in range(1000)]
+    source = _ListSource(values, b"prefetched")
+    client = _connector(prefetch=2, prefetch_depth=50)
+    stream_id = _open(client, source)
+    client.credits = 10
+    sent = []
+    deadline = time.time() + 10
+    while len(sent) < 10 and time.time() < deadline:
+        client._fill()
+        sent.extend(_sent_messages(client))
+    assert(sent == values[:10])
+    # Prefetched messages are discarded when Wallaroo rewinds the stream
+    assert(source.pos > 10)
+    client._handle_notify_ack(cwm.NotifyAck(True, stream_id, 5))
+    assert(client.sources[stream_id][0].point_of_ref() == 5)
+    client.credits = 1000
+    while len(sent) < 1005 and time.time() < deadline:
+        client._fill()
+        sent.extend(_sent_messages(client))
+    assert(sent == values[:10] + values[5:])
+    with client._write_lock:
+        try:
+            client._fill()
+            client._fill()
+        except StopIteration:
+            pass
+
+
+class _GatedSource(_ListSource):
+    """
+    Has nothing to send until `gate` is set, and counts how often it was
+    asked.
+    """
+    def __init__(self, values, name=b"gated"):
+        _ListSource.__init__(self, values, name)
+        self.gate = threading.Event()
+        self.calls = 0
+
+    def __next__(self):
+        self.calls += 1
+        if not self.gate.is_set():
+            return (None, self.pos)
+        return _ListSource.__next__(self)
+
+
+def test_prefetch_parks_idle_streams():
+    source = _GatedSource([b"a", b"b", b"c"])
+    client = _connector(prefetch=1)
+    stream_id = _open(client, source)
+    client.credits = 10
+    # A stream with nothing read ahead is waited for, not polled
+    deadline = time.time() + 0.2
+    while time.time() < deadline:
+        client._fill()
+    assert(not _sent_messages(client) and source.calls < 20)
+    # It is woken as soon as a prefetch thread has read something
+    client._MAX_IDLE_SLEEP = 10
+    client._next_sweep = time.time() + 10
+    source.gate.set()
+    client.sources[stream_id][0]._pool.request(client.sources[stream_id][0])
+    sent = []
+    deadline = time.time() + 5
+    while len(sent) < 3 and time.time() < deadline:
+        client._fill()
+        sent.extend(_sent_messages(client))
+    assert(sent == [b"a", b"b", b"c"])
+    # The source was refilled at once, without waiting for a sweep
+    assert(deadline - time.time() > 4)
+
+
+def test_prefetched_source_ready_in():
+    clock = _FakeClock()
+    bucket = TokenBucket(5, burst=1, clock=clock)
+    limited = RateLimitedSource(_ListSource([b"a", b"b", b"c"]),
+                                shared=[bucket])
+    woken = []
+    source = _PrefetchedSource(limited, _PrefetchPool(0), 4,
+                               lambda: woken.append(True))
+    assert(source.ready_in() == 0)
+    source._prefetch()
+    assert(source.ready_in() == 0)
+    assert(next(source) == (b"a", 1))
+    assert(next(source) == (b"b", 2))
+    # The bucket is empty, so the source is rate limited
+    assert(next(source) == (None, 2))
+    assert(abs(source.ready_in() - 0.2) < 1e-3)
+    source._prefetch()
+    assert(not woken)
+    clock.now += 0.2
+    source._prefetch()
+    assert(woken == [True] and source.ready_in() == 0)
+    assert(next(source) == (b"c", 3))
+
+
+def _framed_file(payloads, trailing=b""):
+    import tempfile
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        for payload in payloads:
+            f.write(_FRAME_HEADER.pack(len(payload)) + payload)
+        f.write(trailing)
+    return filename
+
+
+def _read_all(reader):
+    # Messages are memoryviews on Python 3 and bytes on Python 2
+    return [(bytes(value), point_of_ref) for value, point_of_ref in reader]
+
+
+def test_mmap_framed_file_reader_indexes_in_chunks():
+    payloads = [str(i).encode() * i for i in range(7)]
+    filename = _framed_file(payloads)
+    try:
+        reader = MmapFramedFileReader(filename, chunk=3)
+        assert(len(reader._ends) == 0)
+        value, end = next(reader)
+        assert(bytes(value) == b"" and end == 4)
+        assert(len(reader._ends) == 3)
+        messages = _read_all(reader)
+        assert([value for value, _ in messages] == payloads[1:])
+        assert(len(reader._ends) == 7)
+        assert(messages[-1][1] == reader._size == reader.point_of_ref())
+        reader.close()
+    finally:
+        os.remove(filename)
+
+
+def test_mmap_framed_file_reader_reset():
+    payloads = [b"a", b"bb", b"ccc", b"dddd", b"eeeee"]
+    filename = _framed_file(payloads)
+    try:
+        reader = MmapFramedFileReader(filename, chunk=2)
+        ends = [end for _, end in _read_all(reader)]
+        assert(ends == [5, 11, 18, 26, 35])
+        # To the end of a frame: resume with the next one
+        reader.reset(11)
+        assert(reader.point_of_ref() == 11)
+        assert(_read_all(reader)[0] == (b"ccc", 18))
+        # Into the middle of a frame: resume with that frame
+        reader.reset(20)
+        assert(reader.point_of_ref() == 18)
+        assert(_read_all(reader)[0] == (b"dddd", 26))
+        # No point of reference: start over
+        reader.reset(18446744073709551615)
+        assert(reader.point_of_ref() == 0)
+        assert(_read_all(reader)[0] == (b"a", 5))
+        reader.close()
+        # A reset before the frames it falls in were indexed indexes them
+        reader = MmapFramedFileReader(filename, chunk=1)
+        reader.reset(26)
+        assert(_read_all(reader) == [(b"eeeee", 35)])
+        reader.close()
+    finally:
+        os.remove(filename)
+
+
+def test_mmap_framed_file_reader_truncated_frame():
+    # A frame whose payload was only partly written, and then a partial
+    # header, are not read until they are complete
+    for trailing in (_FRAME_HEADER.pack(10) + b"abc", b"\x00\x00"):
+        filename = _framed_file([b"whole"], trailing)
+        try:
+            reader = MmapFramedFileReader(filename)
+            assert(_read_all(reader) == [(b"whole", 9)])
+            reader.reset(9)
+            assert(_read_all(reader) == [])
+            reader.close()
+        finally:
+            os.remove(filename)
+
+
+def test_mmap_framed_file_reader_empty_file():
+    filename = _framed_file([])
+    try:
+        reader = MmapFramedFileReader(filename)
+        assert(_read_all(reader) == [])
+        reader.reset(0)
+        assert(reader.point_of_ref() == 0)
+        reader.close()
+    finally:
+        os.remove(filename)
+
+
+def test_mmap_framed_file_reader_close_with_live_messages():
+    filename = _framed_file([b"kept", b"other"])
+    try:
+        reader = MmapFramedFileReader(filename)
+        kept, _ = next(reader)
+        reader.close()
+        assert(reader.file.closed)
+        # Messages that are still referenced stay readable
+        assert(bytes(kept) == b"kept")
+        del kept
+    finally:
+        os.remove(filename)
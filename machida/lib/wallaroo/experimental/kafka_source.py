@@ -0,0 +1,368 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+At-least-once Kafka sources for `MultiSourceConnector`.
+
+A `KafkaFetcher` polls a single `KafkaConsumer` for batches of records and
+hands them out to a `KafkaPartitionSource` per partition. A source's point of
+reference is the offset of the next record to read from its partition, so
+resetting a source seeks its partition to the point of reference, and that
+offset is committed to Kafka once Wallaroo acks it.
+
+This module needs the kafka-python library to build a consumer, but the
+sources work with any object that has the `KafkaConsumer` methods they use.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque, namedtuple
+import logging
+
+from .connectors import BaseIter, BaseSource, _clock
+
+try:
+    from kafka import KafkaConsumer, OffsetAndMetadata, TopicPartition
+except ImportError:
+    KafkaConsumer = None
+    TopicPartition = namedtuple("TopicPartition", ["topic", "partition"])
+    OffsetAndMetadata = namedtuple("OffsetAndMetadata",
+                                   ["offset", "metadata"])
+
+
+# The point of reference Wallaroo uses for a stream it has no data for
+NO_POINT_OF_REF = 18446744073709551615
+
+
+class KafkaFetcher(object):
+    """
+    Polls a `KafkaConsumer` for up to `max_records` records at a time and
+    buffers them per partition for the partitions' sources.
+
+    The consumer should not commit offsets by itself: create it with
+    `enable_auto_commit=False` and a `group_id` for the sources to commit
+    acked offsets to.
+
+    After a poll returns no records, the consumer isn't polled again for
+    `idle_backoff` seconds, and `ready_in()` returns how long is left.
+    """
+    def __init__(self, consumer, max_records=500, idle_backoff=0.01,
+                 clock=_clock):
+        self.consumer = consumer
+        self.max_records = max_records
+        self.idle_backoff = idle_backoff
+        self._clock = clock
+        self._poll_after = 0
+        self._records = {}  # {TopicPartition: deque of ConsumerRecord}
+
+    def sources(self, topic, partitions=None):
+        """
+        Assign the consumer to `partitions` of `topic`, or all of them, and
+        return a `KafkaPartitionSource` for each.
+        """
+        if partitions is None:
+            # Fetch the cluster metadata for partitions_for_topic
+            self.consumer.topics()
+            partitions = self.consumer.partitions_for_topic(topic)
+            if not partitions:
+                raise ValueError("Topic {} has no partitions".format(topic))
+        topic_partitions = [TopicPartition(topic, p)
+                            for p in sorted(partitions)]
+        self.consumer.assign(topic_partitions)
+        for tp in topic_partitions:
+            self._records[tp] = deque()
+        return [KafkaPartitionSource(self, tp) for tp in topic_partitions]
+
+    def next_record(self, topic_partition):
+        """
+        Return the next record of `topic_partition`, polling the consumer
+        for another batch if none are buffered, or None if there are none.
+        """
+        records = self._records[topic_partition]
+        if not records and self.ready_in() <= 0:
+            self.fetch()
+        if records:
+            return records.popleft()
+        return None
+
+    def fetch(self):
+        batches = self.consumer.poll(timeout_ms=0,
+                                     max_records=self.max_records)
+        for tp, records in batches.items():
+            self._records[tp].extend(records)
+        if batches:
+            self._poll_after = 0
+        else:
+            self._poll_after = self._clock() + self.idle_backoff
+
+    def ready_in(self):
+        """
+        Return the number of seconds until the consumer may be polled again.
+        """
+        return max(0, self._poll_after - self._clock())
+
+    def has_records(self, topic_partition):
+        return bool(self._records[topic_partition])
+
+    def seek(self, topic_partition, offset):
+        self._records[topic_partition].clear()
+        self._poll_after = 0
+        self.consumer.seek(topic_partition, offset)
+
+    def start_offset(self, topic_partition):
+        """
+        Seek `topic_partition` to the offset last committed for it, or to
+        its beginning if none was, and return that offset.
+        """
+        self._records[topic_partition].clear()
+        self._poll_after = 0
+        committed = self.consumer.committed(topic_partition)
+        if committed is None:
+            self.consumer.seek_to_beginning(topic_partition)
+            return self.consumer.position(topic_partition)
+        self.consumer.seek(topic_partition, committed)
+        return committed
+
+    def commit(self, topic_partition, offset):
+        self.consumer.commit_async(
+            offsets={topic_partition: OffsetAndMetadata(offset, '')})
+
+    def close(self):
+        self.consumer.close()
+
+
+class KafkaPartitionSource(BaseIter, BaseSource):
+    """
+    A source for one Kafka partition, read through a shared `KafkaFetcher`.
+
+    `__next__` returns `(None, point_of_ref)` when no records are available
+    yet, which `MultiSourceConnector` treats as nothing to send for now, and
+    `ready_in()` returns how long until the fetcher polls Kafka again.
+    """
+    def __init__(self, fetcher, topic_partition):
+        self._fetcher = fetcher
+        self.topic_partition = topic_partition
+        self.name = "{}:{}".format(topic_partition.topic,
+                                   topic_partition.partition).encode()
+        self.key = str(topic_partition.partition).encode()
+        self._committed = None
+        self._position = fetcher.start_offset(topic_partition)
+
+    def __str__(self):
+        return ("KafkaPartitionSource(topic: {}, partition: {}, "
+                "point_of_ref: {})".format(self.topic_partition.topic,
+                                           self.topic_partition.partition,
+                                           self._position))
+
+    def point_of_ref(self):
+        return self._position
+
+    def reset(self, pos=0):
+        if pos == NO_POINT_OF_REF:
+            pos = self._fetcher.start_offset(self.topic_partition)
+        else:
+            self._fetcher.seek(self.topic_partition, pos)
+        logging.debug("resetting {} to offset {}".format(self, pos))
+        self._position = pos
+
+    def ready_in(self):
+        if self._fetcher.has_records(self.topic_partition):
+            return 0
+        return self._fetcher.ready_in()
+
+    def __next__(self):
+        record = self._fetcher.next_record(self.topic_partition)
+        if record is None:
+            return (None, self._position)
+        self._position = record.offset + 1
+        return (record.value, self._position)
+
+    def wallaroo_acked(self, point_of_ref):
+        if point_of_ref in (NO_POINT_OF_REF, self._committed):
+            return
+        self._fetcher.commit(self.topic_partition, point_of_ref)
+        self._committed = point_of_ref
+
+    def close(self):
+        # The consumer is shared, and closed by the fetcher
+        pass
+
+
+class _FakeBroker(object):
+    """
+    Partitions of records and committed offsets, kept in memory.
+    """
+    Record = namedtuple("Record", ["offset", "value"])
+
+    def __init__(self, topic, partitions):
+        self.topic = topic
+        self.partitions = [[_FakeBroker.Record(offset, value)
+                            for offset, value in enumerate(values)]
+                           for values in partitions]
+        self.committed = {}
+
+
+class _FakeConsumer(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.positions = {}
+        self.polls = 0
+
+    def topics(self):
+        return set([self.broker.topic])
+
+    def partitions_for_topic(self, topic):
+        return set(range(len(self.broker.partitions)))
+
+    def assign(self, topic_partitions):
+        self.positions = dict((tp, 0) for tp in topic_partitions)
+
+    def committed(self, tp):
+        return self.broker.committed.get(tp)
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    def seek_to_beginning(self, tp):
+        self.positions[tp] = 0
+
+    def position(self, tp):
+        return self.positions[tp]
+
+    def poll(self, timeout_ms=0, max_records=None):
+        self.polls += 1
+        batches = {}
+        for tp in sorted(self.positions):
+            log = self.broker.partitions[tp.partition]
+            records = log[self.positions[tp]:][:max_records]
+            if records:
+                batches[tp] = records
+                self.positions[tp] += len(records)
+                max_records -= len(records)
+            if not max_records:
+                break
+        return batches
+
+    def commit_async(self, offsets):
+        for tp, offset_and_metadata in offsets.items():
+            self.broker.committed[tp] = offset_and_metadata.offset
+
+
+def _read_all(source):
+    values = []
+    while True:
+        value, point_of_ref = next(source)
+        if value is None:
+            return values
+        values.append((value, point_of_ref))
+
+
+def test_batched_fetch():
+    broker = _FakeBroker("t", [[b"a", b"b", b"c", b"d"], [b"e", b"f"]])
+    consumer = _FakeConsumer(broker)
+    p0, p1 = KafkaFetcher(consumer, max_records=3).sources("t")
+    assert(p0.name == b"t:0" and p1.key == b"1")
+    assert(p0.point_of_ref() == 0)
+    assert(_read_all(p0) == [(b"a", 1), (b"b", 2), (b"c", 3), (b"d", 4)])
+    # The second poll also fetched partition 1's first record
+    assert(_read_all(p1) == [(b"e", 1), (b"f", 2)])
+    assert(consumer.polls < 6)
+    assert(broker.committed == {})
+
+
+def test_reset_seeks_to_point_of_ref():
+    broker = _FakeBroker("t", [[b"a", b"b", b"c", b"d"]])
+    source, = KafkaFetcher(_FakeConsumer(broker)).sources("t")
+    assert(next(source) == (b"a", 1))
+    source.reset(2)
+    assert(source.point_of_ref() == 2)
+    assert(_read_all(source) == [(b"c", 3), (b"d", 4)])
+    # Without a point of ref from Wallaroo, start from the committed offset
+    source.reset(NO_POINT_OF_REF)
+    assert(next(source) == (b"a", 1))
+    source.wallaroo_acked(3)
+    source.reset(NO_POINT_OF_REF)
+    assert(next(source) == (b"d", 4))
+    # A new fetcher for the same group starts from the committed offset too
+    source, = KafkaFetcher(_FakeConsumer(broker)).sources("t")
+    assert(source.point_of_ref() == 3)
+
+
+def test_backs_off_after_empty_poll():
+    broker = _FakeBroker("t", [[b"a"], []])
+    consumer = _FakeConsumer(broker)
+    now = [0.0]
+    fetcher = KafkaFetcher(consumer, idle_backoff=0.5, clock=lambda: now[0])
+    p0, p1 = fetcher.sources("t")
+    assert(p0.ready_in() == 0 and p1.ready_in() == 0)
+    assert(next(p0) == (b"a", 1))
+    assert(p1.ready_in() == 0)
+    # The next poll comes back empty, so the partitions wait to poll again
+    assert(next(p0) == (None, 1))
+    polls = consumer.polls
+    assert(p0.ready_in() == 0.5 and p1.ready_in() == 0.5)
+    assert(next(p1) == (None, 0) and next(p0) == (None, 1))
+    assert(consumer.polls == polls)
+    broker.partitions[1].append(_FakeBroker.Record(0, b"b"))
+    now[0] = 0.25
+    assert(p1.ready_in() == 0.25)
+    now[0] = 0.5
+    assert(p1.ready_in() == 0)
+    assert(next(p1) == (b"b", 1))
+    assert(consumer.polls == polls + 1)
+    # Seeking polls straight away
+    assert(next(p1) == (None, 1) and p1.ready_in() == 0.5)
+    p0.reset(0)
+    assert(p0.ready_in() == 0)
+    assert(next(p0) == (b"a", 1))
+
+
+def test_commits_after_wallaroo_acks():
+    from . import connector_wire_messages as cwm
+    from .connectors import MultiSourceConnector
+
+    broker = _FakeBroker("t", [[b"a", b"b", b"c"], [b"d", b"e"]])
+    consumer = _FakeConsumer(broker)
+    client = MultiSourceConnector("0.0.1", "cookie", "test", "instance",
+                                  "127.0.0.1", 0)
+    # Frames are only queued, never sent, without a connection
+    client._conn = None
+    sources = KafkaFetcher(consumer).sources("t")
+    for source in sources:
+        client.add_source(source)
+    ids = [client.get_id(source.name) for source in sources]
+    for stream_id in ids:
+        client._handle_notify_ack(cwm.NotifyAck(True, stream_id, 0))
+    client.credits = 10
+    client._fill()
+    sent = []
+    data = b"".join(bytes(chunk) for chunk in client._out._chunks)
+    while data:
+        size = cwm._U32.unpack_from(data, 0)[0]
+        sent.append(cwm.Frame.decode(data[4:4 + size]))
+        data = data[4 + size:]
+    messages = [(msg.message, msg.message_id) for msg in sent
+                if isinstance(msg, cwm.Message)]
+    assert(sorted(messages) ==
+           [(b"a", 1), (b"b", 2), (b"c", 3), (b"d", 1), (b"e", 2)])
+    assert(broker.committed == {})
+
+    client._handle_ack(cwm.Ack(5, [(ids[0], 2), (ids[1], 2)]))
+    assert(broker.committed == {TopicPartition("t", 0): 2,
+                                TopicPartition("t", 1): 2})
+
+    # Wallaroo restarted from an earlier point of ref: resend from there
+    client._handle_notify_ack(cwm.NotifyAck(True, ids[0], 2))
+    assert(sources[0].point_of_ref() == 2)
+    assert(next(sources[0]) == (b"c", 3))
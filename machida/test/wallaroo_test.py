@@ -1,3 +1,4 @@
+import os
 import pickle
 import struct
 import wallaroo
@@ -116,6 +117,180 @@ def test_my_state_computation_multi_serialization():
            (["hello", "world"], 1))
 
 
+#
+# Test computation_batch
+#
+
+
+@wallaroo.computation_batch(name="My Computation Batch", batch_size=3)
+def my_computation_batch(data):
+    return [d * 2 for d in data]
+
+
+def test_my_computation_batch():
+    assert(my_computation_batch.name() == "My Computation Batch")
+    assert(my_computation_batch.compute_batch(["a", "b"]) == ["aa", "bb"])
+    assert(my_computation_batch.batch_size == 3)
+    assert(my_computation_batch.batch_delay == wallaroo.milliseconds(1))
+    assert(isinstance(my_computation_batch, wallaroo.ComputationBatch))
+    assert(not isinstance(my_computation_batch, wallaroo.StateComputation))
+
+
+def test_my_computation_batch_serialization():
+    serialized = pickle.dumps(my_computation_batch)
+    deserialized = pickle.loads(serialized)
+    assert(deserialized.name() == "My Computation Batch")
+    assert(deserialized.compute_batch(["a", "b"]) == ["aa", "bb"])
+    assert(deserialized.batch_size == 3)
+
+
+@wallaroo.computation_batch(name="My Pooled Computation Batch", processes=2)
+def my_pooled_computation_batch(data):
+    return [d * 2 for d in data]
+
+
+def test_my_pooled_computation_batch():
+    data = list(range(11))
+    assert(my_pooled_computation_batch.processes == 2)
+    assert(my_pooled_computation_batch.compute_batch(data) ==
+           [d * 2 for d in data])
+    assert(my_pooled_computation_batch.compute_batch([5]) == [10])
+
+
+@wallaroo.computation_batch(name="My Pid Computation Batch", processes=3)
+def my_pid_computation_batch(data):
+    if any(d < 0 for d in data):
+        raise ValueError("negative input")
+    return [(d, os.getpid()) for d in data]
+
+
+def test_my_pid_computation_batch():
+    out = my_pid_computation_batch.compute_batch(list(range(9)))
+    assert([d for d, _ in out] == list(range(9)))
+    # One chunk is computed here, the others on two subprocesses
+    pids = [pid for _, pid in out]
+    assert(pids[:3] == [os.getpid()] * 3 and len(set(pids)) == 3)
+    workers = wallaroo._batch_pools["My Pid Computation Batch"]._workers
+    wallaroo._close_batch_pools()
+    assert(all(w.poll() is not None for w in workers))
+
+
+def test_pooled_computation_batch_errors():
+    try:
+        my_pid_computation_batch.compute_batch([1, 2, -3])
+    except RuntimeError as err:
+        assert("negative input" in str(err))
+    else:
+        assert(False)
+    # The pool is still in step with its workers
+    assert(my_pid_computation_batch.compute_batch([4, 5, 6])[2][0] == 6)
+
+    # An error in the chunk computed locally leaves it in step too
+    try:
+        my_pid_computation_batch.compute_batch([-1, 2, 3, 4, 5, 6])
+    except ValueError as err:
+        assert("negative input" in str(err))
+    else:
+        assert(False)
+    for data in ([5, 6, 7, 8, 9, 10], [100, 200, 300]):
+        out = my_pid_computation_batch.compute_batch(data)
+        assert([d for d, _ in out] == data)
+
+    # A dead worker is replaced on the next batch
+    pool = wallaroo._batch_pools["My Pid Computation Batch"]
+    for w in pool._workers:
+        w.kill()
+        w.wait()
+    try:
+        my_pid_computation_batch.compute_batch([1, 2, 3])
+    except (EOFError, IOError, OSError):
+        pass
+    else:
+        assert(False)
+    assert("My Pid Computation Batch" not in wallaroo._batch_pools)
+    out = my_pid_computation_batch.compute_batch([1, 2, 3])
+    assert([d for d, _ in out] == [1, 2, 3])
+    wallaroo._close_batch_pools()
+
+
+#
+# Test state_computation_batch
+#
+
+
+@wallaroo.state_computation_batch(name="My State Computation Batch",
+                                  state=list, batch_size=2,
+                                  batch_delay=wallaroo.microseconds(50))
+def my_state_computation_batch(data, state):
+    state.extend(data)
+    return [len(state)]
+
+
+def test_my_state_computation_batch():
+    state = my_state_computation_batch.initial_state()
+    assert(my_state_computation_batch.name() == "My State Computation Batch")
+    assert(my_state_computation_batch.compute_batch([1, 2], state) == [2])
+    assert(my_state_computation_batch.compute_batch([3], state) == [3])
+    assert(my_state_computation_batch.batch_delay == 50000)
+    assert(isinstance(my_state_computation_batch,
+                      wallaroo.StateComputationBatch))
+    assert(isinstance(my_state_computation_batch, wallaroo.StateComputation))
+
+
+def test_computation_batch_stage():
+    p = wallaroo.Pipeline(wallaroo._PipelineTree(("source", "s", None)))
+    p = p.to(my_state_computation_batch)
+    tree = p._pipeline_tree
+    stage = tree.vs[tree.root_idx][-1]
+    assert(stage == ("to_batch", my_state_computation_batch, 2, 50000, True))
+
+
+@wallaroo.computation(name="Drop Odd")
+def drop_odd(data):
+    if data % 2 == 0:
+        return data
+
+
+def test_fuse_computations():
+    p = wallaroo.Pipeline(wallaroo._PipelineTree(("source", "s", None)))
+    p = (p.to(my_computation2).to(drop_odd).to(my_computation)
+         .key_by(my_partition).to(my_computation2)
+         .to(my_computation_multi).to(my_computation))
+    tree = p._pipeline_tree.clone().fuse_computations()
+    stages = tree.vs[tree.root_idx]
+    assert([s[0] for s in stages] == ["source", "to", "key_by", "to", "to",
+                                      "to"])
+    fused = stages[1][1]
+    assert(fused.name() == "My Computation 2+Drop Odd+My Computation")
+    assert(fused.compute(2) == 4)
+    assert(stages[3][1] is my_computation2)
+    assert(stages[4][1] is my_computation_multi)
+    # The unfused pipeline is unchanged
+    assert(len(p._pipeline_tree.vs[tree.root_idx]) == 8)
+    # Computations are only fused when asked for
+    (_, root_idx, vs, _) = p.__to_tuple__("app")
+    assert(len(vs[root_idx]) == 8)
+    (_, root_idx, vs, _) = p.__to_tuple__("app", fuse_computations=True)
+    assert([s[0] for s in vs[root_idx]] == [s[0] for s in stages])
+    assert(vs[root_idx][1][1].name() == fused.name())
+
+    deserialized = pickle.loads(pickle.dumps(fused))
+    assert(deserialized.name() == fused.name())
+    assert(deserialized.compute(3) == 6)
+    assert(drop_odd.compute(3) is None)
+    assert(wallaroo._FusedComputation([drop_odd, my_computation2])
+           .compute(3) is None)
+
+
+def test_computation_batch_invalid_batch_size():
+    try:
+        wallaroo.computation_batch("Bad Batch", batch_size=0)
+    except wallaroo.WallarooParameterError:
+        pass
+    else:
+        assert False, "batch_size=0 should be rejected"
+
+
 #
 # Test state
 #
@@ -197,6 +372,28 @@ def test_my_partition_serialization():
     assert(deserialized.extract_key('abcde') == 'a')
 
 
+@wallaroo.key_extractor
+def symbol_key(data):
+    return data.split(':')[0]
+
+
+def test_key_extractor_interns_keys():
+    first = symbol_key.extract_key('IBM:1')
+    assert(first == 'IBM')
+    assert(symbol_key.extract_key('IBM:2') is first)
+    # Only the most recent keys are kept
+    symbol_key.key_cache_size = 4
+    for i in range(10):
+        symbol_key.extract_key('K{}:0'.format(i))
+    assert(len(symbol_key._recent_keys) + len(symbol_key._older_keys) <= 4)
+    assert(symbol_key.extract_key('K9:1') == 'K9')
+    # The interned keys aren't serialized
+    deserialized = pickle.loads(pickle.dumps(symbol_key))
+    assert(deserialized._recent_keys is None)
+    assert(deserialized.extract_key('IBM:3') == 'IBM')
+    del symbol_key.key_cache_size
+
+
 #
 # Test decoder
 #
@@ -209,6 +406,7 @@ def my_decoder(data):
 
 def test_my_decoder():
     assert(my_decoder.header_length() == 4)
+    assert(my_decoder.length_fmt == '>I')
     assert(my_decoder.payload_length(struct.pack('>I', 10)) == 10)
     assert(my_decoder.decode('hello') == "decoded: 'hello'")
 
@@ -221,6 +419,76 @@ def test_my_decoder_serialization():
     assert(deserialized.decode('hello') == "decoded: 'hello'")
 
 
+@wallaroo.decoder(header_length=2, length_fmt='>H', zero_copy=True)
+def my_zero_copy_decoder(data):
+    return struct.unpack_from('>I', data, 1)[0]
+
+
+def test_my_zero_copy_decoder():
+    assert(not my_decoder.zero_copy)
+    assert(my_zero_copy_decoder.zero_copy)
+    header = memoryview(struct.pack('>H', 5))
+    assert(my_zero_copy_decoder.payload_length(header) == 5)
+    frame = memoryview(b'\x00' + struct.pack('>I', 42))
+    assert(my_zero_copy_decoder.decode(frame) == 42)
+
+
+@wallaroo.decoder(header_length=4, length_fmt='>I',
+                  accept=lambda bs: bs[:1] == b'\x02')
+def my_filtering_decoder(data):
+    return data[1:]
+
+
+@wallaroo.decoder(header_length=4, length_fmt='>I', zero_copy=True,
+                  accept=b'\x02')
+def my_prefix_decoder(data):
+    return data[1:].tobytes()
+
+
+def test_decoder_accept():
+    assert(my_decoder.accept_prefix is None)
+    assert(my_filtering_decoder.accept_prefix is None)
+    assert(my_filtering_decoder.decode(b'\x02abc') == b'abc')
+    assert(my_filtering_decoder.decode(b'\x01abc') is None)
+    assert(my_prefix_decoder.accept_prefix == b'\x02')
+    assert(my_prefix_decoder.decode(memoryview(b'\x02abc')) == b'abc')
+    assert(my_prefix_decoder.decode(memoryview(b'\x01abc')) is None)
+    assert(my_prefix_decoder.decode(memoryview(b'')) is None)
+    deserialized = pickle.loads(pickle.dumps(my_filtering_decoder))
+    assert(deserialized.decode(b'\x01abc') is None)
+    try:
+        wallaroo.decoder(header_length=4, length_fmt='>I', accept=2)(
+            lambda data: data)
+    except wallaroo.WallarooParameterError:
+        pass
+    else:
+        assert False, "accept=2 should be rejected"
+
+
+class MyStructRecord(object):
+    __slots__ = ('kind', 'symbol', 'price')
+
+    def __init__(self, kind, symbol, price):
+        self.kind = kind
+        self.symbol = symbol
+        self.price = price
+
+
+my_struct_decoder = wallaroo.struct_decoder('>B4sd', MyStructRecord)
+
+
+def test_my_struct_decoder():
+    assert(my_struct_decoder.header_length() == 4)
+    assert(my_struct_decoder.length_fmt == '>I')
+    assert(my_struct_decoder.zero_copy)
+    rec = my_struct_decoder.decode(memoryview(struct.pack('>B4sd', 2, b'AAPL',
+                                                          1.5)))
+    assert((rec.kind, rec.symbol, rec.price) == (2, b'AAPL', 1.5))
+    deserialized = pickle.loads(pickle.dumps(my_struct_decoder))
+    assert(deserialized.decode(struct.pack('>B4sd', 2, b'AAPL', 1.5)).kind
+           == 2)
+
+
 #
 # Test encoder
 #
@@ -239,3 +507,211 @@ def test_my_encoder_serialization():
     serialized = pickle.dumps(my_encoder)
     deserialized = pickle.loads(serialized)
     assert(deserialized.encode('hello') == "encoded: 'hello'")
+
+
+my_struct_encoder = wallaroo.struct_encoder('>4sd', ['symbol', 'price'])
+
+
+def test_my_struct_encoder():
+    rec = MyStructRecord(2, b'AAPL', 1.5)
+    assert(my_struct_encoder.encode(rec) ==
+           struct.pack('>I4sd', 12, b'AAPL', 1.5))
+    single = wallaroo.struct_encoder('>d', ['price'], length_fmt=None)
+    assert(single.encode(rec) == struct.pack('>d', 1.5))
+    try:
+        wallaroo.struct_encoder('>4sd', ['symbol'])
+    except wallaroo.WallarooParameterError:
+        pass
+    else:
+        assert False, "mismatched fields should be rejected"
+
+
+#
+# Test register_type
+#
+
+
+class MyRegisteredType(object):
+    def __init__(self, symbol, bid, offer):
+        self.symbol = symbol
+        self.bid = bid
+        self.offer = offer
+        self.mid = (bid + offer) / 2.0
+
+
+wallaroo.register_type(MyRegisteredType, ['symbol', 'bid', 'offer'], '>4sdd')
+
+
+def test_register_type():
+    bs = wallaroo.serialize(MyRegisteredType(b'AAPL', 1.0, 2.0))
+    assert(len(bs) == 3 + struct.calcsize('>4sdd'))
+    obj = wallaroo.deserialize(bs)
+    assert(isinstance(obj, MyRegisteredType))
+    assert((obj.symbol, obj.bid, obj.offer, obj.mid) ==
+           (b'AAPL', 1.0, 2.0, 1.5))
+
+
+def test_register_type_falls_back_to_pickle():
+    bs = wallaroo.serialize({'a': 1})
+    assert(bs == pickle.dumps({'a': 1}, pickle.HIGHEST_PROTOCOL))
+    assert(wallaroo.deserialize(bs) == {'a': 1})
+    try:
+        wallaroo.register_type(MyRegisteredType, ['symbol'], '>4s')
+    except wallaroo.WallarooParameterError:
+        pass
+    else:
+        assert False, "registering a type twice should be rejected"
+
+
+#
+# Test State
+#
+
+
+class MySymbolState(wallaroo.State):
+    fields = [('last_bid', 'd'), ('last_offer', 'd'),
+              ('should_reject_trades', '?', True)]
+
+    def spread(self):
+        return self.last_offer - self.last_bid
+
+
+def test_state():
+    state = MySymbolState()
+    assert((state.last_bid, state.last_offer, state.should_reject_trades) ==
+           (0.0, 0.0, True))
+    assert(MySymbolState.__slots__ ==
+           ('last_bid', 'last_offer', 'should_reject_trades'))
+    assert(not hasattr(state, '__dict__'))
+    assert(state.is_dirty())
+    state.mark_clean()
+    state.last_offer = 2.5
+    assert(state.is_dirty() and state.spread() == 2.5)
+    assert(MySymbolState(1.0, last_offer=3.0).spread() == 2.0)
+    try:
+        MySymbolState(last_ask=1.0)
+    except TypeError:
+        pass
+    else:
+        assert False, "unknown fields should be rejected"
+
+
+def test_state_serialization():
+    state = MySymbolState(1.0, 2.0, False)
+    bs = wallaroo.serialize(state)
+    assert(len(bs) == 3 + struct.calcsize('>dd?'))
+    restored = wallaroo.deserialize(bs)
+    assert(isinstance(restored, MySymbolState))
+    assert((restored.last_bid, restored.last_offer,
+            restored.should_reject_trades) == (1.0, 2.0, False))
+    # A restored state matches its snapshot
+    assert(not restored.is_dirty())
+
+
+def test_state_invalid_fields():
+    try:
+        class BadState(wallaroo.State):
+            fields = [('a', 'dd')]
+    except wallaroo.WallarooParameterError:
+        pass
+    else:
+        assert False, "a field with two struct items should be rejected"
+
+
+#
+# Test VectorAggregation
+#
+
+
+class MyVectorAggregation(wallaroo.VectorAggregation):
+    fields = ('amount', 'user.age')
+
+    def output(self, key, columns):
+        return (key, len(columns), sum(columns['amount']),
+                max(columns['user.age']))
+
+
+class MyUser(object):
+    def __init__(self, age):
+        self.age = age
+
+
+class MyTransaction(object):
+    def __init__(self, amount, age):
+        self.amount = amount
+        self.user = MyUser(age)
+
+
+def test_vector_aggregation():
+    agg = MyVectorAggregation()
+    acc1 = agg.initial_accumulator()
+    acc2 = agg.initial_accumulator()
+    for i in range(3):
+        agg.update(MyTransaction(i, 20 + i), acc1)
+    agg.update(MyTransaction(10, 40), acc2)
+    combined = pickle.loads(pickle.dumps(agg.combine(acc1, acc2),
+                                         pickle.HIGHEST_PROTOCOL))
+    assert(agg.output('k', combined) == ('k', 4, 13.0, 40.0))
+    assert(len(agg.initial_accumulator()) == 0)
+    assert(isinstance(agg, wallaroo.Aggregation))
+
+
+def test_vector_aggregation_update_batch():
+    agg = MyVectorAggregation()
+    acc = agg.initial_accumulator()
+    agg.update(MyTransaction(1, 20), acc)
+    agg.update_batch([MyTransaction(i, 30 + i) for i in range(2, 5)], acc)
+    assert(agg.output('k', acc) == ('k', 4, 10.0, 34.0))
+    # A missing field leaves the columns as they were
+    try:
+        agg.update_batch([MyTransaction(5, 50), MyUser(60)], acc)
+    except AttributeError:
+        pass
+    else:
+        assert(False)
+    assert(agg.output('k', acc) == ('k', 4, 10.0, 34.0))
+    assert(len(acc['amount']) == len(acc['user.age']) == 4)
+
+
+def test_vector_aggregation_subtract():
+    agg = MyVectorAggregation()
+    acc1 = agg.initial_accumulator()
+    acc2 = agg.initial_accumulator()
+    agg.update(MyTransaction(1, 20), acc1)
+    agg.update(MyTransaction(2, 30), acc1)
+    agg.update(MyTransaction(10, 40), acc2)
+    window = agg.combine(acc1, acc2)
+    assert(agg.output('k', agg.subtract(window, acc1)) == ('k', 1, 10.0, 40.0))
+    assert(agg.output('k', window) == ('k', 3, 13.0, 40.0))
+
+
+def test_vector_aggregation_slides_in_place():
+    agg = MyVectorAggregation()
+    identity = agg.initial_accumulator()
+    panes = []
+    for p in range(6):
+        pane = agg.initial_accumulator()
+        for i in range(2):
+            agg.update(MyTransaction(10 * p + i, p), pane)
+        panes.append(pane)
+    # A window of three panes, sliding by one pane per trigger
+    window = agg.combine(agg.combine(identity, panes[0]), panes[1])
+    columns = window._columns
+    outputs = []
+    for p in range(2, 6):
+        full = agg.combine(window, panes[p])
+        outputs.append(agg.output('k', full))
+        window = agg.subtract(full, panes[p - 2])
+    assert(outputs == [('k', 6, 63.0, 2.0), ('k', 6, 123.0, 3.0),
+                       ('k', 6, 183.0, 4.0), ('k', 6, 243.0, 5.0)])
+    # Panes were appended to the window's columns rather than copied into
+    # new ones, and the inputs were left as they were
+    assert(len(columns[0]) > 6)
+    assert(len(identity) == 0 and len(identity._columns[0]) == 0)
+    assert([len(pane) for pane in panes] == [2] * 6)
+    # Appending to an accumulator that others were appended past copies it
+    agg.update(MyTransaction(100, 9), full)
+    assert(agg.output('k', full) == ('k', 7, 343.0, 9.0))
+    assert(agg.output('k', window) == ('k', 4, 182.0, 5.0))
+    restored = pickle.loads(pickle.dumps(window))
+    assert(agg.output('k', restored) == ('k', 4, 182.0, 5.0))
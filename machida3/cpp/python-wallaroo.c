@@ -19,9 +19,20 @@ Copyright 2017 The Wallaroo Authors.
 #include <Python.h>
 
 
+#include <stdlib.h>
+
 PyObject *g_user_deserialization_fn;
 PyObject *g_user_serialization_fn;
 
+/*
+ * Pony serialises an object graph in two passes: it first asks every object
+ * for the space it needs and then asks each one to write itself out. The
+ * bytes returned by the user's serialize() while sizing an object are kept
+ * here, keyed by the object's address, so that writing the object does not
+ * serialize it a second time. Entries are removed once they are written.
+ */
+PyObject *g_user_serialization_cache;
+
 extern PyObject *load_module(char *module_name)
 {
   PyObject *pName, *pModule;
@@ -97,18 +108,14 @@ extern size_t source_decoder_header_length(PyObject *source_decoder)
   }
 }
 
-extern size_t source_decoder_payload_length(PyObject *source_decoder, char *bytes, size_t size)
+static size_t call_payload_length(PyObject *payload_length_fn, PyObject *pBytes)
 {
-  PyObject *pFunc, *pValue, *pBytes;
+  PyObject *pValue;
 
-  pFunc = PyObject_GetAttrString(source_decoder, "payload_length");
-  pBytes = PyBytes_FromStringAndSize(bytes, size);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, pBytes, NULL);
+  pValue = PyObject_CallFunctionObjArgs(payload_length_fn, pBytes, NULL);
 
   size_t sz = PyLong_AsSsize_t(pValue);
 
-  Py_XDECREF(pFunc);
-  Py_XDECREF(pBytes);
   Py_XDECREF(pValue);
 
   /*
@@ -124,42 +131,192 @@ extern size_t source_decoder_payload_length(PyObject *source_decoder, char *byte
   }
 }
 
-extern PyObject *source_decoder_decode(PyObject *source_decoder, char *bytes, size_t size)
+extern size_t source_decoder_payload_length(PyObject *payload_length_fn, char *bytes, size_t size)
+{
+  PyObject *pBytes = PyBytes_FromStringAndSize(bytes, size);
+  size_t sz = call_payload_length(payload_length_fn, pBytes);
+
+  Py_XDECREF(pBytes);
+  return sz;
+}
+
+/*
+ * Decoders created with `zero_copy=True` are handed a read-only memoryview
+ * over the Pony receive buffer instead of a bytes copy of it. The buffer is
+ * only guaranteed to be alive for the duration of the call, so the view is
+ * released when the decoder returns and a reference the decoder kept to it
+ * raises ValueError when used. Slices and casts of the view, and objects
+ * such as numpy arrays that hold its buffer, can't be invalidated that way.
+ * They would keep pointing into memory that Pony reuses, so if any of them
+ * outlive the call, the call fails with a BufferError instead.
+ */
+static PyObject *decoder_view(char *bytes, size_t size)
+{
+  return PyMemoryView_FromMemory(bytes, size, PyBUF_READ);
+}
+
+static int decoder_view_escaped(PyObject *pView)
+{
+  PyMemoryViewObject *mv = (PyMemoryViewObject *)pView;
+
+  // Every memoryview derived from ours shares its managed buffer.
+  return mv->exports > 0 || mv->mbuf->exports > 1;
+}
+
+static int release_decoder_view(PyObject *pView)
+{
+  PyObject *type, *value, *traceback, *pResult;
+  int escaped = decoder_view_escaped(pView);
+
+  // If the decoder kept nothing, dropping our reference releases the view
+  // without the cost of a method call.
+  if (!escaped && Py_REFCNT(pView) == 1)
+  {
+    Py_DECREF(pView);
+    return 0;
+  }
+
+  // Don't let release() clobber an exception raised by the decoder.
+  PyErr_Fetch(&type, &value, &traceback);
+  if (!escaped)
+  {
+    pResult = PyObject_CallMethod(pView, "release", NULL);
+    if (pResult == NULL)
+    {
+      PyErr_Clear();
+      escaped = 1;
+    }
+    Py_XDECREF(pResult);
+  }
+  Py_DECREF(pView);
+
+  if (type)
+    PyErr_Restore(type, value, traceback);
+  else if (escaped)
+    PyErr_SetString(PyExc_BufferError,
+      "a zero_copy decoder kept a slice or buffer of its input; "
+      "copy it with bytes() instead");
+
+  return escaped ? -1 : 0;
+}
+
+extern int source_decoder_zero_copy(PyObject *source_decoder)
+{
+  PyObject *pValue = PyObject_GetAttrString(source_decoder, "zero_copy");
+
+  if (pValue == NULL)
+  {
+    PyErr_Clear();
+    return 0;
+  }
+
+  int zero_copy = PyObject_IsTrue(pValue) == 1;
+  Py_DECREF(pValue);
+  return zero_copy;
+}
+
+/*
+ * Return the decoder's `length_fmt` string, or NULL if it doesn't declare
+ * one, so that machida can parse common header formats without calling the
+ * decoder's payload_length().
+ */
+extern PyObject *source_decoder_length_fmt(PyObject *source_decoder)
+{
+  PyObject *pValue = PyObject_GetAttrString(source_decoder, "length_fmt");
+
+  if (pValue == NULL)
+  {
+    PyErr_Clear();
+    return NULL;
+  }
+
+  if (!(PyUnicode_Check(pValue) || PyBytes_Check(pValue)))
+  {
+    Py_DECREF(pValue);
+    return NULL;
+  }
+
+  return pValue;
+}
+
+/*
+ * Return the decoder's `accept` prefix, or NULL if it doesn't declare one,
+ * so that machida can drop frames that don't start with it without calling
+ * the decoder.
+ */
+extern PyObject *source_decoder_accept_prefix(PyObject *source_decoder)
+{
+  PyObject *pValue = PyObject_GetAttrString(source_decoder, "accept_prefix");
+
+  if (pValue == NULL)
+  {
+    PyErr_Clear();
+    return NULL;
+  }
+
+  if (!(PyBytes_Check(pValue)))
+  {
+    Py_DECREF(pValue);
+    return NULL;
+  }
+
+  return pValue;
+}
+
+extern size_t source_decoder_payload_length_view(PyObject *payload_length_fn, char *bytes, size_t size)
 {
-  PyObject *pFunc, *pBytes, *pValue;
+  PyObject *pView = decoder_view(bytes, size);
+  size_t sz = call_payload_length(payload_length_fn, pView);
+
+  // A failed release leaves an error set, which machida reports.
+  release_decoder_view(pView);
+  return sz;
+}
+
+extern PyObject *source_decoder_decode(PyObject *decode_fn, char *bytes, size_t size)
+{
+  PyObject *pBytes, *pValue;
 
-  pFunc = PyObject_GetAttrString(source_decoder, "decode");
   pBytes = PyBytes_FromStringAndSize(bytes, size);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, pBytes, NULL);
+  pValue = PyObject_CallFunctionObjArgs(decode_fn, pBytes, NULL);
 
-  Py_DECREF(pFunc);
   Py_DECREF(pBytes);
 
   return pValue;
 }
 
-extern PyObject *source_generator_initial_value(PyObject *source_generator)
+extern PyObject *source_decoder_decode_view(PyObject *decode_fn, char *bytes, size_t size)
 {
-  PyObject *pFunc, *pValue;
+  PyObject *pView, *pValue;
 
-  pFunc = PyObject_GetAttrString(source_generator, "initial_value");
-  pValue = PyObject_CallFunctionObjArgs(pFunc,  NULL);
-  Py_DECREF(pFunc);
+  pView = decoder_view(bytes, size);
+  pValue = PyObject_CallFunctionObjArgs(decode_fn, pView, NULL);
+
+  if (release_decoder_view(pView) != 0)
+  {
+    Py_XDECREF(pValue);
+    return NULL;
+  }
 
   return pValue;
 }
 
-extern PyObject *source_generator_apply(PyObject *source_generator, PyObject *data)
+extern PyObject *source_generator_initial_value(PyObject *source_generator)
 {
   PyObject *pFunc, *pValue;
 
-  pFunc = PyObject_GetAttrString(source_generator, "apply");
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
+  pFunc = PyObject_GetAttrString(source_generator, "initial_value");
+  pValue = PyObject_CallFunctionObjArgs(pFunc,  NULL);
   Py_DECREF(pFunc);
 
   return pValue;
 }
 
+extern PyObject *source_generator_apply(PyObject *apply_fn, PyObject *data)
+{
+  return PyObject_CallFunctionObjArgs(apply_fn, data, NULL);
+}
+
 extern PyObject *instantiate_python_class(PyObject *class)
 {
   return PyObject_CallFunctionObjArgs(class, NULL);
@@ -178,27 +335,26 @@ extern PyObject *get_name(PyObject *pObject)
   return pValue;
 }
 
-extern PyObject *computation_compute(PyObject *computation, PyObject *data,
-  char* method)
+/*
+** Resolve a bound method once so that the hot-path functions below can be
+** handed the callable directly instead of doing an attribute lookup (and
+** allocating a new bound method object) for every message. The caller owns
+** the returned reference and must re-resolve it if the underlying object is
+** replaced, e.g. after deserialisation.
+*/
+extern PyObject *get_method(PyObject *pObject, char *method)
 {
-  PyObject *pFunc, *pValue;
-
-  pFunc = PyObject_GetAttrString(computation, method);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
-  Py_DECREF(pFunc);
-
-  return pValue;
+  return PyObject_GetAttrString(pObject, method);
 }
 
-extern PyObject *sink_encoder_encode(PyObject *sink_encoder, PyObject *data)
+extern PyObject *computation_compute(PyObject *compute_fn, PyObject *data)
 {
-  PyObject *pFunc, *pValue;
-
-  pFunc = PyObject_GetAttrString(sink_encoder, "encode");
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
+  return PyObject_CallFunctionObjArgs(compute_fn, data, NULL);
+}
 
-  Py_DECREF(pFunc);
-  return pValue;
+extern PyObject *sink_encoder_encode(PyObject *encode_fn, PyObject *data)
+{
+  return PyObject_CallFunctionObjArgs(encode_fn, data, NULL);
 }
 
 extern void py_incref(PyObject *o)
@@ -211,16 +367,10 @@ extern void py_decref(PyObject *o)
   Py_DECREF(o);
 }
 
-extern PyObject *stateful_computation_compute(PyObject *computation,
-  PyObject *data, PyObject *state, char *method)
+extern PyObject *stateful_computation_compute(PyObject *compute_fn,
+  PyObject *data, PyObject *state)
 {
-  PyObject *pFunc, *pValue;
-
-  pFunc = PyObject_GetAttrString(computation, method);
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, state, NULL);
-  Py_DECREF(pFunc);
-
-  return pValue;
+  return PyObject_CallFunctionObjArgs(compute_fn, data, state, NULL);
 }
 
 extern PyObject *initial_state(PyObject *computation)
@@ -234,47 +384,60 @@ extern PyObject *initial_state(PyObject *computation)
   return pState;
 }
 
-extern PyObject *initial_accumulator(PyObject *aggregation)
+extern PyObject *initial_accumulator(PyObject *initial_accumulator_fn)
 {
-  PyObject *pFunc, *pState;
+  return PyObject_CallFunctionObjArgs(initial_accumulator_fn, NULL);
+}
 
-  pFunc = PyObject_GetAttrString(aggregation, "initial_accumulator");
-  pState = PyObject_CallFunctionObjArgs(pFunc, NULL);
-  Py_DECREF(pFunc);
+extern void aggregation_update(PyObject *update_fn, PyObject *data, PyObject *acc)
+{
+  PyObject *pValue;
 
-  return pState;
+  pValue = PyObject_CallFunctionObjArgs(update_fn, data, acc, NULL);
+  Py_XDECREF(pValue);
 }
 
-extern void aggregation_update(PyObject *aggregation, PyObject *data, PyObject *acc)
+/*
+ * Inputs of aggregations that implement update_batch are appended to a list
+ * per accumulator, without calling into Python, and passed to update_batch
+ * in one call once Python needs the accumulator.
+ */
+extern void aggregation_buffer_input(PyObject *pending, PyObject *data)
 {
-  PyObject *pFunc, *pState;
-
-  pFunc = PyObject_GetAttrString(aggregation, "update");
-  PyObject_CallFunctionObjArgs(pFunc, data, acc, NULL);
-  Py_DECREF(pFunc);
+  PyList_Append(pending, data);
 }
 
-extern PyObject *aggregation_combine(PyObject *aggregation, PyObject *acc1, PyObject *acc2)
+extern void aggregation_update_batch(PyObject *update_batch_fn, PyObject *pending, PyObject *acc)
 {
-  PyObject *pFunc, *pState;
+  PyObject *pValue;
 
-  pFunc = PyObject_GetAttrString(aggregation, "combine");
-  pState = PyObject_CallFunctionObjArgs(pFunc, acc1, acc2, NULL);
-  Py_DECREF(pFunc);
+  if (PyList_GET_SIZE(pending) == 0)
+    return;
 
-  return pState;
+  pValue = PyObject_CallFunctionObjArgs(update_batch_fn, pending, acc, NULL);
+  Py_XDECREF(pValue);
+  // The inputs are only passed once, even if update_batch failed
+  PyList_SetSlice(pending, 0, PyList_GET_SIZE(pending), NULL);
+}
+
+extern PyObject *aggregation_combine(PyObject *combine_fn, PyObject *acc1, PyObject *acc2)
+{
+  return PyObject_CallFunctionObjArgs(combine_fn, acc1, acc2, NULL);
 }
 
-extern PyObject *aggregation_output(PyObject *aggregation, char *key, PyObject *acc)
+extern PyObject *aggregation_subtract(PyObject *subtract_fn, PyObject *acc1, PyObject *acc2)
 {
-  PyObject *pFunc, *pData, *pKey;
+  return PyObject_CallFunctionObjArgs(subtract_fn, acc1, acc2, NULL);
+}
+
+extern PyObject *aggregation_output(PyObject *output_fn, char *key, PyObject *acc)
+{
+  PyObject *pData, *pKey;
 
   pKey = PyUnicode_FromString(key);
 
-  pFunc = PyObject_GetAttrString(aggregation, "output");
-  pData = PyObject_CallFunctionObjArgs(pFunc, pKey, acc, NULL);
+  pData = PyObject_CallFunctionObjArgs(output_fn, pKey, acc, NULL);
   Py_DECREF(pKey);
-  Py_DECREF(pFunc);
 
   return pData;
 }
@@ -290,15 +453,68 @@ extern int key_eq(PyObject *key, PyObject* other)
   return PyObject_RichCompareBool(key, other, Py_EQ);
 }
 
-extern PyObject *extract_key(PyObject *key_extractor, PyObject *data)
+extern PyObject *extract_key(PyObject *extract_key_fn, PyObject *data)
 {
-  PyObject *pFunc, *pValue;
+  return PyObject_CallFunctionObjArgs(extract_key_fn, data, NULL);
+}
 
-  pFunc = PyObject_GetAttrString(key_extractor, "extract_key");
-  pValue = PyObject_CallFunctionObjArgs(pFunc, data, NULL);
-  Py_DECREF(pFunc);
+extern size_t key_extractor_cache_size(PyObject *key_extractor)
+{
+  PyObject *pValue = PyObject_GetAttrString(key_extractor, "key_cache_size");
 
-  return pValue;
+  if (pValue == NULL)
+  {
+    PyErr_Clear();
+    return 0;
+  }
+
+  long size = PyLong_AsLong(pValue);
+  Py_DECREF(pValue);
+  if (size < 0)
+  {
+    PyErr_Clear();
+    return 0;
+  }
+  return (size_t)size;
+}
+
+extern int state_tracks_changes(PyObject *state)
+{
+  return PyObject_HasAttrString(state, "is_dirty") &&
+    PyObject_HasAttrString(state, "mark_clean");
+}
+
+extern int state_is_dirty(PyObject *state)
+{
+  PyObject *pValue = PyObject_CallMethod(state, "is_dirty", NULL);
+
+  if (pValue == NULL)
+  {
+    // Checkpoint the state if we can't tell whether it changed
+    PyErr_Clear();
+    return 1;
+  }
+
+  int dirty = PyObject_IsTrue(pValue);
+  Py_DECREF(pValue);
+  if (dirty < 0)
+  {
+    PyErr_Clear();
+    return 1;
+  }
+  return dirty;
+}
+
+extern void state_mark_clean(PyObject *state)
+{
+  PyObject *pValue = PyObject_CallMethod(state, "mark_clean", NULL);
+
+  if (pValue == NULL)
+  {
+    PyErr_Clear();
+    return;
+  }
+  Py_DECREF(pValue);
 }
 
 extern int set_command_line_args(PyObject *module, PyObject *tuple)
@@ -323,6 +539,41 @@ extern void set_user_serialization_fns(PyObject *module)
     g_user_serialization_fn = PyObject_GetAttrString(wallaroo, "serialize");
     Py_DECREF(wallaroo);
   }
+
+  g_user_serialization_cache = PyDict_New();
+}
+
+static PyObject *g_close_batch_pools_fn;
+
+static void close_batch_pools(void)
+{
+  PyObject *pResult = PyObject_CallFunctionObjArgs(g_close_batch_pools_fn, NULL);
+
+  if (pResult == NULL)
+    PyErr_Print();
+  else
+    Py_DECREF(pResult);
+}
+
+/*
+ * Machida leaves the interpreter running when it exits, so Python's own
+ * atexit handlers never run. Register the one that stops the worker
+ * processes of computation_batch(processes=n) with the C runtime instead.
+ */
+extern int register_batch_pool_cleanup(PyObject *module)
+{
+  PyObject *wallaroo = PyObject_GetAttrString(module, "wallaroo");
+
+  if (wallaroo == NULL)
+    return -1;
+
+  g_close_batch_pools_fn = PyObject_GetAttrString(wallaroo, "_close_batch_pools");
+  Py_DECREF(wallaroo);
+
+  if (g_close_batch_pools_fn == NULL)
+    return -1;
+
+  return atexit(close_batch_pools);
 }
 
 extern void *user_deserialization(char *bytes)
@@ -350,6 +601,10 @@ extern size_t user_serialization_get_size(PyObject *o)
   if (user_bytes)
   {
     size_t size = PyBytes_Size(user_bytes);
+
+    PyObject *key = PyLong_FromVoidPtr(o);
+    PyDict_SetItem(g_user_serialization_cache, key, user_bytes);
+    Py_DECREF(key);
     Py_DECREF(user_bytes);
 
     // return the size of the buffer plus the 4 bytes needed to record that size.
@@ -361,7 +616,22 @@ extern size_t user_serialization_get_size(PyObject *o)
 
 extern void user_serialization(PyObject *o, char *bytes)
 {
-  PyObject *user_bytes = PyObject_CallFunctionObjArgs(g_user_serialization_fn, o, NULL);
+  PyObject *key = PyLong_FromVoidPtr(o);
+  PyObject *user_bytes = PyDict_GetItem(g_user_serialization_cache, key);
+
+  if (user_bytes)
+  {
+    // Take ownership of the cached bytes before dropping the cache entry.
+    Py_INCREF(user_bytes);
+    PyDict_DelItem(g_user_serialization_cache, key);
+  }
+  else
+  {
+    // Nothing was cached for this object, which happens when the same
+    // Python object is wrapped by more than one Pony object in the graph.
+    user_bytes = PyObject_CallFunctionObjArgs(g_user_serialization_fn, o, NULL);
+  }
+  Py_DECREF(key);
 
   // This will be null if there was an exception.
   if (user_bytes)
@@ -364,6 +364,9 @@ class AsyncServer(asynchat.async_chat, object):
             self.write(notify_ack)
         elif isinstance(msg, cwm.Message):
             self.handle_message(msg)
+        elif isinstance(msg, cwm.MessageBatch):
+            for m in msg.messages:
+                self.handle_message(m)
         elif isinstance(msg, cwm.EosMessage):
             self.handle_eos_message(msg)
         elif isinstance(msg, cwm.Error):
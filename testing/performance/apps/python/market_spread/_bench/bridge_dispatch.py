@@ -0,0 +1,104 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Per-message method dispatch overhead of the machida C bridge.
+
+Machida calls into Python for every message at each of the market_spread
+stages: decode, extract_key, the state computation and the sink encoder.
+Before methods were cached, each of those calls did the equivalent of
+`getattr(obj, "method")(*args)`, allocating and freeing a bound method object
+per call. This benchmark replays the market_spread pipeline in-process both
+ways so that the difference can be measured without a running cluster.
+
+Usage:
+
+    python _bench/bridge_dispatch.py [number-of-messages]
+"""
+
+import sys
+
+import frames
+frames.setup_path()
+
+import market_spread as ms
+
+
+def run_uncached(payloads, states):
+    for bs in payloads:
+        data = getattr(ms.market_data_decoder, "decode")(bs)
+        key = getattr(ms.extract_symbol, "extract_key")(data)
+        state = states.get(key)
+        if state is None:
+            state = getattr(ms.check_market_data, "initial_state")()
+            states[key] = state
+        out = getattr(ms.check_market_data, "compute")(data, state)
+        if out is not None:
+            getattr(ms.order_result_encoder, "encode")(out)
+
+
+def run_cached(payloads, states):
+    decode = ms.market_data_decoder.decode
+    extract_key = ms.extract_symbol.extract_key
+    initial_state = ms.check_market_data.initial_state
+    compute = ms.check_market_data.compute
+    encode = ms.order_result_encoder.encode
+    for bs in payloads:
+        data = decode(bs)
+        key = extract_key(data)
+        state = states.get(key)
+        if state is None:
+            state = initial_state()
+            states[key] = state
+        out = compute(data, state)
+        if out is not None:
+            encode(out)
+
+
+def run_lookup_only(n, cached):
+    """
+    Isolate the dispatch cost itself by calling a trivial method.
+    """
+    comp = ms.check_market_data
+    if cached:
+        fn = comp.name
+        for _ in range(n):
+            fn()
+    else:
+        for _ in range(n):
+            getattr(comp, "name")()
+
+
+def main(n):
+    payloads = frames.market_data_payloads(n)
+    states = {}
+    # Warm up state so both runs see the same steady state.
+    run_cached(payloads[:1000], states)
+
+    frames.report(
+        "market_spread market data path ({} messages)".format(n), n,
+        [("getattr per call", frames.best_of(
+            lambda: run_uncached(payloads, states))),
+         ("cached bound methods", frames.best_of(
+            lambda: run_cached(payloads, states)))])
+    frames.report(
+        "dispatch only ({} calls)".format(n), n,
+        [("getattr per call", frames.best_of(
+            lambda: run_lookup_only(n, False))),
+         ("cached bound method", frames.best_of(
+            lambda: run_lookup_only(n, True)))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
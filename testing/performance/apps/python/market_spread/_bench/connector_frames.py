@@ -0,0 +1,103 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Connector protocol framing of market_spread market data.
+
+A source connector frames every message it sends to Wallaroo as a connector
+protocol Message. The "format strings" codec is the original one, which built
+a format string for each message and read fields back through a `BytesIO`.
+The "precompiled Struct" codec is `connector_wire_messages` as it is now:
+module-level `struct.Struct` layouts, the frame and message headers packed in
+one call, and fields read in place with `unpack_from`.
+
+Both codecs are checked to produce identical frames before timing.
+
+Usage:
+
+    python _bench/connector_frames.py [number-of-messages]
+"""
+
+from io import BytesIO
+import struct
+import sys
+
+import frames
+frames.setup_path()
+
+from wallaroo.experimental import connector_wire_messages as cwm
+
+
+def legacy_encode(msg):
+    sid = struct.pack('>Q', msg.stream_id)
+    messageid = struct.pack('>Q', msg.message_id)
+    event_time = struct.pack('>q', msg.event_time)
+    k = b'' if msg.key is None else msg.key
+    key = struct.pack('>H{}s'.format(len(k)), len(k), k)
+    m = msg.message if msg.message else b''
+    data = b''.join((sid, messageid, event_time, key, m))
+    return struct.pack('>IB', len(data) + 1, 5) + data
+
+
+def legacy_decode(bs):
+    frame_tag = struct.unpack('>B', bs[0:1])[0]
+    assert frame_tag == 5
+    reader = BytesIO(bs[1:])
+    stream_id = struct.unpack('>Q', reader.read(8))[0]
+    message_id = struct.unpack('>Q', reader.read(8))[0]
+    event_time = struct.unpack('>q', reader.read(8))[0]
+    key_length = struct.unpack('>H', reader.read(2))[0]
+    key = reader.read(key_length) if key_length > 0 else None
+    message = reader.read() or None
+    return cwm.Message(stream_id, message_id, event_time, key, message)
+
+
+def run_encode(encode, msgs):
+    for msg in msgs:
+        encode(msg)
+
+
+def run_decode(decode, framed):
+    # Decoders see each frame without its length header, as connectors read
+    # the header first.
+    for bs in framed:
+        decode(bs)
+
+
+def main(n):
+    payloads = frames.market_data_payloads(n)
+    msgs = [cwm.Message(1, i, i, bs[1:5], bs)
+            for i, bs in enumerate(payloads)]
+    framed = [cwm.Frame.encode(msg) for msg in msgs]
+    for msg, bs in zip(msgs[:1000], framed):
+        assert legacy_encode(msg) == bs
+        assert legacy_decode(bs[4:]) == cwm.Frame.decode(bs[4:]) == msg
+    framed = [bs[4:] for bs in framed]
+
+    frames.report(
+        "connector Message frame encode ({} messages)".format(n), n,
+        [("format strings", frames.best_of(
+            lambda: run_encode(legacy_encode, msgs))),
+         ("precompiled Struct", frames.best_of(
+            lambda: run_encode(cwm.Frame.encode, msgs)))])
+    frames.report(
+        "connector Message frame decode ({} messages)".format(n), n,
+        [("format strings", frames.best_of(
+            lambda: run_decode(legacy_decode, framed))),
+         ("precompiled Struct", frames.best_of(
+            lambda: run_decode(cwm.Frame.decode, framed)))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,154 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+MultiSourceConnector sending market_spread market data over loopback.
+
+A fake Wallaroo worker runs in a subprocess. It completes the handshake,
+opens the stream, and acks every 1000 messages, granting credits for them.
+The "one message per __next__" run uses the generic sender, which pulls and
+encodes messages one at a time. The "bursts per source" run is
+MultiSourceConnector's own sender, which encodes bursts of values straight
+into the output buffer.
+
+Usage:
+
+    python _bench/connector_send.py [number-of-messages]
+"""
+
+import multiprocessing
+import socket
+import struct
+import sys
+import time
+
+import frames
+frames.setup_path()
+
+from wallaroo.experimental import (AtLeastOnceSourceConnector,
+                                   connector_wire_messages as cwm)
+from wallaroo.experimental.connectors import (BaseIter, BaseSource,
+                                              MultiSourceConnector)
+
+
+MESSAGE_TAG = b"\x05"
+
+
+class PayloadSource(BaseIter, BaseSource):
+    def __init__(self, payloads):
+        self.name = b"market data"
+        self.key = None
+        self._payloads = payloads
+        self._pos = 0
+
+    def __str__(self):
+        return "PayloadSource({})".format(len(self._payloads))
+
+    def reset(self, pos=0):
+        self._pos = 0 if pos == 18446744073709551615 else pos
+
+    def point_of_ref(self):
+        return self._pos
+
+    def __next__(self):
+        if self._pos >= len(self._payloads):
+            raise StopIteration
+        self._pos += 1
+        return self._payloads[self._pos - 1], self._pos
+
+    def wallaroo_acked(self, point_of_ref):
+        pass
+
+    def close(self):
+        pass
+
+
+class PerMessageConnector(MultiSourceConnector):
+    _fill = AtLeastOnceSourceConnector._fill
+
+
+def fake_worker(listener, credits=5000, ack_every=1000):
+    conn, _ = listener.accept()
+    header = struct.Struct(">I")
+
+    def send(msg):
+        conn.sendall(cwm.Frame.encode(msg))
+
+    buf = b""
+    received = acked = 0
+    stream_id = None
+    handshake = True
+    while True:
+        data = conn.recv(1 << 20)
+        if not data:
+            break
+        buf += data
+        offset = 0
+        while len(buf) - offset >= 4:
+            size = header.unpack_from(buf, offset)[0]
+            if len(buf) - offset - 4 < size:
+                break
+            start = offset + 4
+            offset = start + size
+            if buf[start:start + 1] == MESSAGE_TAG:
+                # only count messages, decoding them would be the bottleneck
+                received += 1
+                continue
+            if handshake:
+                handshake = False
+                send(cwm.Ok(credits))
+                continue
+            msg = cwm.Frame.decode(buf[start:offset])
+            if isinstance(msg, cwm.Notify):
+                stream_id = msg.stream_id
+                send(cwm.NotifyAck(True, msg.stream_id, msg.point_of_ref))
+                send(cwm.Ack(1, []))
+            elif isinstance(msg, cwm.EosMessage):
+                send(cwm.Ack(received - acked, [(msg.stream_id, received)]))
+                acked = received
+        buf = buf[offset:]
+        if received - acked >= ack_every:
+            send(cwm.Ack(received - acked, [(stream_id, received)]))
+            acked = received
+
+
+def run(connector_class, payloads):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    worker = multiprocessing.Process(target=fake_worker, args=(listener,))
+    worker.daemon = True
+    worker.start()
+    client = connector_class("0.0.1", "cookie", "bench", "instance",
+                             "127.0.0.1", listener.getsockname()[1])
+    start = time.time()
+    client.connect()
+    client.add_source(PayloadSource(payloads))
+    client.join()
+    elapsed = time.time() - start
+    worker.join(5)
+    listener.close()
+    return elapsed
+
+
+def main(n):
+    payloads = frames.market_data_payloads(n)
+    frames.report(
+        "MultiSourceConnector over loopback ({} messages)".format(n), n,
+        [("one message per __next__", run(PerMessageConnector, payloads)),
+         ("bursts per source", run(MultiSourceConnector, payloads))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
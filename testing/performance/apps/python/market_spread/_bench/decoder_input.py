@@ -0,0 +1,79 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Cost of handing each received frame to a decoder as a bytes copy versus a
+read-only memoryview over the receive buffer.
+
+Machida copies every frame into a new bytes object before calling the
+decoder unless the decoder was declared with `zero_copy=True`, in which case
+it wraps the Pony buffer in a memoryview that is dropped after the call. The
+receive buffer is modelled here with a bytearray per frame.
+
+The market_spread frames are only 42 and 53 bytes long, so the copy being
+avoided is small; the last case decodes the header of a 16 KiB frame to show
+how the difference grows with frame size.
+
+Usage:
+
+    python _bench/decoder_input.py [number-of-messages]
+"""
+
+import struct
+import sys
+
+import frames
+frames.setup_path()
+
+import market_spread as ms
+
+
+def run_copy(buffers, decode):
+    for buf in buffers:
+        decode(bytes(buf))
+
+
+def run_view(buffers, decode):
+    for buf in buffers:
+        decode(memoryview(buf))
+
+
+LARGE_FRAME_HEADER = struct.Struct(">BI")
+
+
+def decode_large_frame_header(bs):
+    return LARGE_FRAME_HEADER.unpack_from(bs)
+
+
+def main(n):
+    market_data = [bytearray(p) for p in frames.market_data_payloads(n)]
+    orders = [bytearray(p) for p in frames.order_payloads(n)]
+    large = [bytearray(LARGE_FRAME_HEADER.pack(1, i)).ljust(16384, b"x")
+             for i in range(min(n, 20000))]
+
+    for title, buffers, decode in [
+            ("market data decoder", market_data,
+             ms.market_data_decoder.decode),
+            ("order decoder", orders, ms.order_decoder.decode),
+            ("16 KiB frame header", large, decode_large_frame_header)]:
+        frames.report(
+            "{} ({} messages)".format(title, len(buffers)), len(buffers),
+            [("bytes copy", frames.best_of(
+                lambda: run_copy(buffers, decode))),
+             ("memoryview", frames.best_of(
+                lambda: run_view(buffers, decode)))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,78 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Replaying a framed file of market_spread market data, as a file source
+connector does.
+
+"read() per frame" is `FramedFileReader`, which reads each frame's header and
+payload from the file. "mmap + index" is `MmapFramedFileReader`, which maps
+the file, indexes frame ends in chunks and returns `memoryview` slices of the
+mapping. Each run reads every frame of a freshly opened reader; for the mmap
+reader this includes building the index.
+
+Usage:
+
+    python _bench/file_replay.py [number-of-messages]
+"""
+
+import os
+import shutil
+from struct import pack
+import sys
+import tempfile
+
+import frames
+frames.setup_path()
+
+from wallaroo.experimental.connectors import (FramedFileReader,
+                                              MmapFramedFileReader)
+
+
+def replay(reader_class, filename):
+    reader = reader_class(filename)
+    try:
+        while True:
+            next(reader)
+    except StopIteration:
+        pass
+    reader.close()
+
+
+def main(n):
+    payloads = frames.market_data_payloads(n)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp, "market_data.msg")
+        with open(filename, "wb") as f:
+            for bs in payloads:
+                f.write(pack(">I", len(bs)) + bs)
+
+        reader = MmapFramedFileReader(filename)
+        for bs in payloads[:1000]:
+            assert bytes(next(reader)[0]) == bs
+        reader.close()
+
+        frames.report(
+            "framed file replay ({} messages)".format(n), n,
+            [("read() per frame", frames.best_of(
+                lambda: replay(FramedFileReader, filename))),
+             ("mmap + index", frames.best_of(
+                lambda: replay(MmapFramedFileReader, filename)))])
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,85 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Shared helpers for the market_spread microbenchmarks.
+
+The benchmarks import `market_spread` directly, so they need both this
+application directory and `machida/lib` on the path. `setup_path()` takes care
+of that when run from a wallaroo checkout.
+"""
+
+import os
+import random
+from struct import pack
+import sys
+import timeit
+
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+MACHIDA_LIB = os.path.abspath(os.path.join(APP_DIR, "..", "..", "..", "..",
+                                           "..", "machida", "lib"))
+
+SYMBOLS = [s.encode().rjust(4) for s in
+           ["AA", "BAC", "AAPL", "FCX", "SUNE", "FB", "RAD", "INTC", "GE",
+            "WMB", "S", "ATML", "YHOO", "F", "T", "MU", "PFE", "CSCO", "MEG",
+            "HUN"]]
+TRANSACT_TIME = b"20181231-12:00:00.000"
+
+
+def setup_path():
+    for p in (APP_DIR, MACHIDA_LIB):
+        if p not in sys.path:
+            sys.path.insert(0, p)
+
+
+def market_data_payloads(n, seed=1):
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        bid = 1000.0
+        offer = bid + rnd.random() * 0.1
+        out.append(pack(">B4s21sdd", 2, rnd.choice(SYMBOLS), TRANSACT_TIME,
+                        bid, offer))
+    return out
+
+
+def order_payloads(n, seed=2):
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        out.append(pack(">BBI6s4sdd21s", 1, rnd.choice([1, 2]),
+                        rnd.randint(1, 10), "{:06d}".format(i % 999999)
+                        .encode(), rnd.choice(SYMBOLS), 1000.0, 10.0,
+                        TRANSACT_TIME))
+    return out
+
+
+def best_of(fn, repeat=5):
+    """
+    Return the fastest wall clock time, in seconds, of `repeat` runs of `fn`.
+    """
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def report(title, n, results):
+    """
+    Print a table of per-message costs. `results` is a list of
+    `(label, seconds)` pairs; the first entry is used as the baseline.
+    """
+    print(title)
+    base = results[0][1]
+    for label, secs in results:
+        print("  {:<28} {:>9.1f} ns/msg  {:>6.2f}x".format(
+            label, secs * 1e9 / n, base / secs))
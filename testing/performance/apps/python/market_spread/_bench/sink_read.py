@@ -0,0 +1,153 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+SinkConnector receiving framed market_spread market data over loopback.
+
+A sender subprocess plays the Wallaroo worker: it connects to the sink and
+writes every message as one burst. The "bytes slicing" run is the original
+`SinkConnector.read`, which received 4096 bytes per wakeup and sliced the
+buffered bytes for every message. The "read()" and "read_batch()" runs are
+`SinkConnector` as it is now, which receives into a `bytearray` per connection
+and decodes every complete frame on each wakeup.
+
+Usage:
+
+    python _bench/sink_read.py [number-of-messages]
+"""
+
+from collections import deque
+import multiprocessing
+import socket
+import struct
+import sys
+import time
+
+import frames
+frames.setup_path()
+
+import wallaroo
+from wallaroo.experimental import SinkConnector, selectors
+import wallaroo.experimental
+
+
+@wallaroo.decoder(header_length=4, length_fmt=">I")
+def decode(bs):
+    return bs
+
+
+class BenchSink(SinkConnector):
+    def __init__(self):
+        # Skip loading an application to find the sink's decoder
+        self._decoder = decode
+        self._host = "127.0.0.1"
+        self._port = 0
+        self._acceptor = None
+        self._connections = []
+        self._buffers = {}
+        self._pending = deque()
+        self._selector = selectors.DefaultSelector() if selectors else None
+
+
+class SlicingSink(BenchSink):
+    def __init__(self):
+        super(SlicingSink, self).__init__()
+        self._pending = []
+        self._selector = None
+
+    def read(self, timeout=None):
+        while True:
+            for socket in self._pending:
+                ok, message = self._read_one(socket)
+                if ok: return message
+            self._select_any(timeout)
+
+    def _select_any(self, timeout=None):
+        readable, _, _ = wallaroo.experimental.select(
+            self._connections, [], self._connections, timeout)
+        for socket in readable:
+            if socket is self._acceptor:
+                conn, _addr = socket.accept()
+                self._setup_connection(conn)
+            else:
+                buffered = self._buffers[socket] + socket.recv(4096)
+                self._buffers[socket] = buffered
+                self._pending.append(socket)
+
+    def _read_one(self, socket):
+        buffered = self._buffers[socket]
+        header_len = self._decoder.header_length()
+        if len(buffered) < header_len:
+            self._buffers[socket] = buffered
+            return (False, None)
+        expected = self._decoder.payload_length(buffered[:header_len])
+        if len(buffered) < header_len + expected:
+            self._buffers[socket] = buffered
+            return (False, None)
+        data = buffered[header_len:header_len+expected]
+        buffered = buffered[header_len + expected:]
+        self._buffers[socket] = buffered
+        if len(buffered) < header_len:
+            self._pending.remove(socket)
+        return (True, self._decoder.decode(data))
+
+    def _setup_connection(self, conn):
+        conn.setblocking(0)
+        self._connections.append(conn)
+        self._buffers[conn] = b""
+
+
+def sender(port, payloads):
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(b"".join(struct.pack(">I", len(bs)) + bs
+                          for bs in payloads))
+    conn.close()
+
+
+def run(sink, payloads, read_all):
+    sink.listen(port=0)
+    worker = multiprocessing.Process(
+        target=sender, args=(sink._acceptor.getsockname()[1], payloads))
+    worker.daemon = True
+    worker.start()
+    start = time.time()
+    received = read_all(sink, len(payloads))
+    elapsed = time.time() - start
+    worker.join(5)
+    assert received == payloads
+    return elapsed
+
+
+def read_each(sink, n):
+    return [sink.read() for _ in range(n)]
+
+
+def read_batches(sink, n):
+    received = []
+    while len(received) < n:
+        received.extend(sink.read_batch(1000))
+    return received
+
+
+def main(n):
+    payloads = frames.market_data_payloads(n)
+    frames.report(
+        "SinkConnector over loopback ({} messages)".format(n), n,
+        [("bytes slicing", run(SlicingSink(), payloads, read_each)),
+         ("read()", run(BenchSink(), payloads, read_each)),
+         ("read_batch()", run(BenchSink(), payloads, read_batches))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
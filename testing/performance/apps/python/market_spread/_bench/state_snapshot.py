@@ -0,0 +1,64 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Snapshotting market_spread symbol state with the built-in serializer.
+
+The "pickled object" run serializes the application's `SymbolData`, a plain
+class, which the built-in serializer pickles. The "wallaroo.State" run
+serializes the same fields declared on a `wallaroo.State` subclass, which is
+written as a packed struct record. Both report the total snapshot size.
+
+Usage:
+
+    python _bench/state_snapshot.py [number-of-states]
+"""
+
+import random
+import sys
+
+import frames
+frames.setup_path()
+
+import market_spread as ms
+import wallaroo
+
+
+class SymbolState(wallaroo.State):
+    fields = [("last_bid", "d"), ("last_offer", "d"),
+              ("should_reject_trades", "?", True)]
+
+
+def snapshot(states):
+    return [wallaroo.serialize(s) for s in states]
+
+
+def main(n):
+    rnd = random.Random(1)
+    values = [(1000.0, 1000.0 + rnd.random() * 0.1, rnd.random() < 0.5)
+              for _ in range(n)]
+    objects = [ms.SymbolData(*v) for v in values]
+    states = [SymbolState(*v) for v in values]
+    for label, items in (("pickled object", objects),
+                         ("wallaroo.State", states)):
+        size = sum(len(bs) for bs in snapshot(items))
+        print("  {:<28} {:>9.1f} bytes/state".format(label, size / float(n)))
+    frames.report(
+        "snapshotting symbol state ({} states)".format(n), n,
+        [("pickled object", frames.best_of(lambda: snapshot(objects))),
+         ("wallaroo.State", frames.best_of(lambda: snapshot(states)))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,98 @@
+# Copyright 2018 The Wallaroo Authors.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+#  implied. See the License for the specific language governing
+#  permissions and limitations under the License.
+
+"""
+Hand-written market_spread codecs versus `wallaroo.struct_decoder` and
+`wallaroo.struct_encoder`.
+
+The "per-field slices" decoder is the original market_spread decoder, which
+unpacked each field from its own slice of the frame. The "unpack_from"
+decoder is the current hand-written one. The struct codecs are declared from
+the same layouts, decoding into a `__slots__` record.
+
+Usage:
+
+    python _bench/struct_codecs.py [number-of-messages]
+"""
+
+import struct
+import sys
+
+import frames
+frames.setup_path()
+
+import market_spread as ms
+import wallaroo
+
+
+def slices_market_data_decode(bs):
+    order_type = struct.unpack(">B", bs[0:1])[0]
+    if order_type != ms.FIXTYPE_MARKET_DATA:
+        raise ms.MarketSpreadError("Wrong Fix message type.")
+    symbol = struct.unpack(">4s", bs[1:5])[0]
+    transact_time = struct.unpack(">21s", bs[5:26])[0]
+    bid = struct.unpack(">d", bs[26:34])[0]
+    offer = struct.unpack(">d", bs[34:42])[0]
+    return ms.MarketDataMessage(symbol, transact_time, bid, offer)
+
+
+class MarketData(object):
+    __slots__ = ("symbol", "transact_time", "bid", "offer")
+
+    def __init__(self, symbol, transact_time, bid, offer):
+        self.symbol = symbol
+        self.transact_time = transact_time
+        self.bid = bid
+        self.offer = offer
+
+
+# The leading pad byte skips the FIX message type.
+struct_market_data_decoder = wallaroo.struct_decoder(">x4s21sdd", MarketData)
+
+struct_order_result_encoder = wallaroo.struct_encoder(
+    ">HI6s4sddddQ",
+    ["order.side", "order.account", "order.order_id", "order.symbol",
+     "order.qty", "order.price", "bid", "offer", "timestamp"])
+
+
+def run(decode, items):
+    for item in items:
+        decode(item)
+
+
+def main(n):
+    payloads = frames.market_data_payloads(n)
+    results = [ms.OrderResult(ms.order_decoder.decode(p), 1000.0, 1000.1, i)
+               for i, p in enumerate(frames.order_payloads(n))]
+    assert (ms.order_result_encoder.encode(results[0]) ==
+            struct_order_result_encoder.encode(results[0]))
+
+    frames.report(
+        "market data decoders ({} messages)".format(n), n,
+        [("per-field slices", frames.best_of(
+            lambda: run(slices_market_data_decode, payloads))),
+         ("hand-written unpack_from", frames.best_of(
+            lambda: run(ms.market_data_decoder.decode, payloads))),
+         ("struct_decoder", frames.best_of(
+            lambda: run(struct_market_data_decoder.decode, payloads)))])
+    frames.report(
+        "order result encoders ({} messages)".format(n), n,
+        [("hand-written", frames.best_of(
+            lambda: run(ms.order_result_encoder.encode, results))),
+         ("struct_encoder", frames.best_of(
+            lambda: run(struct_order_result_encoder.encode, results)))])
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
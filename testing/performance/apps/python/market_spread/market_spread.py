@@ -193,7 +193,11 @@ class MarketDataMessage(object):
         self.mid = (bid + offer) / 2.0
 
 
-@wallaroo.decoder(header_length=4, length_fmt=">I")
+ORDER_STRUCT = struct.Struct(">BBI6s4sdd21s")
+MARKET_DATA_STRUCT = struct.Struct(">B4s21sdd")
+
+
+@wallaroo.decoder(header_length=4, length_fmt=">I", zero_copy=True)
 def order_decoder(bs):
     """
     0 -  1b - FixType (U8)
@@ -205,23 +209,17 @@ def order_decoder(bs):
     24 -  8b - price (F64)
     32 - 21b - transact_time (String)
     """
-    order_type = struct.unpack(">B", bs[0:1])[0]
+    (order_type, side, account, order_id, symbol, qty, price,
+     transact_time) = ORDER_STRUCT.unpack_from(bs)
     if order_type != FIXTYPE_ORDER:
         raise MarketSpreadError("Wrong Fix message type. Did you connect "
                                 "the senders the wrong way around?")
-    side = struct.unpack(">B", bs[1:2])[0]
-    account = struct.unpack(">I", bs[2:6])[0]
-    order_id = struct.unpack("6s", bs[6:12])[0]
-    symbol = struct.unpack("4s", bs[12:16])[0]
-    qty = struct.unpack(">d", bs[16:24])[0]
-    price = struct.unpack(">d", bs[24:32])[0]
-    transact_time = struct.unpack("21s", bs[32:53])[0]
 
     return Order(side, account, order_id, symbol, qty, price,
                  transact_time)
 
 
-@wallaroo.decoder(header_length=4, length_fmt=">I")
+@wallaroo.decoder(header_length=4, length_fmt=">I", zero_copy=True)
 def market_data_decoder(bs):
     """
     0 -  1b - FixType (U8)
@@ -230,14 +228,11 @@ def market_data_decoder(bs):
     26 - 8b - bid_px (F64)
     34 - 8b - offer_px (F64)
     """
-    order_type = struct.unpack(">B", bs[0:1])[0]
+    (order_type, symbol, transact_time, bid,
+     offer) = MARKET_DATA_STRUCT.unpack_from(bs)
     if order_type != FIXTYPE_MARKET_DATA:
         raise MarketSpreadError("Wrong Fix message type. Did you connect "
                                 "the senders the wrong way around?")
-    symbol = struct.unpack(">4s", bs[1:5])[0]
-    transact_time = struct.unpack(">21s", bs[5:26])[0]
-    bid = struct.unpack(">d", bs[26:34])[0]
-    offer = struct.unpack(">d", bs[34:42])[0]
     return MarketDataMessage(symbol, transact_time, bid, offer)
 
 